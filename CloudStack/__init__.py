@@ -1,2 +1,42 @@
-from cloudstack import cloud, cloudsizes
-from hostname import HostName
+'''CloudStack helpers. The API client module, and the cs library behind it,
+is imported the first time a client is requested so that command line
+startup (--help, argument errors) stays fast. When the resident daemon
+(CloudStack.daemon) is running, clients are proxies to its warm clients.
+'''
+
+from CloudStack.hostname import HostName, group_by_env
+
+
+def cloud(fqdn, config):
+    '''Return the CloudStack object for a FQDN's environment'''
+    env = HostName(fqdn).cs_env
+    if not env:
+        raise Exception('Could not identify cloudstack environment from fqdn')
+    return cloud_env(env, config)
+
+
+def cloud_env(env, config):
+    '''Return the CloudStack object for a named config section, served by
+    the daemon when one is running
+    '''
+    from CloudStack import daemon
+    remote = daemon.client(env)
+    if remote is not None:
+        return remote
+    from CloudStack.cloudstack import cloud_env as _cloud_env
+    return _cloud_env(env, config)
+
+
+def clouds(fqdns, config):
+    '''Group FQDNs by environment with the CloudStack object for each'''
+    groups = group_by_env(fqdns)
+    if '' in groups:
+        unknown = ', '.join(hostname.fqdn for hostname in groups[''])
+        raise Exception('Could not identify cloudstack environment from fqdn: {}'.format(unknown))
+    return [(cloud_env(env, config), hostnames) for env, hostnames in groups.items()]
+
+
+def cloudsizes(config):
+    '''Return available CloudStack virtual sizes'''
+    from CloudStack.cloudstack import cloudsizes as _cloudsizes
+    return _cloudsizes(config)
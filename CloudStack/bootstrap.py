@@ -0,0 +1,180 @@
+'''Post-provision bootstrap of new VMs over SSH.
+All VMs are probed for SSH at once with non-blocking sockets, a host counting
+as up once sshd sends its banner. The configured commands then run on up to
+a fixed number of hosts in parallel, each output line prefixed with the
+hostname, followed by a per-host summary.
+    -- commands(config, default) Bootstrap commands from .cloud.cfg
+    -- wait_for_ssh(hosts, timeout) Wait for SSH on many hosts at once
+    -- run(hosts, commands, workers) Run the commands on every host
+    -- summary(results) Print the per-host outcome, returning the failures
+'''
+
+import errno
+import logging
+import select
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+# Seconds to wait for SSH on new VMs, and between connection attempts
+SSH_TIMEOUT = 600
+SSH_RETRY = 1.0
+# Hosts bootstrapped at the same time
+WORKERS = 8
+
+_PRINT_LOCK = threading.Lock()
+
+
+def commands(config, default=()):
+    '''Return the [Global] Bootstrap commands, one per line, or default'''
+    if config.has_option('Global', 'Bootstrap'):
+        return [line.strip() for line in config.get('Global', 'Bootstrap').splitlines()
+                if line.strip()]
+    return list(default)
+
+
+def say(label, line):
+    '''Print one line of output prefixed with its host'''
+    with _PRINT_LOCK:
+        print "[%s] %s" % (label, line)
+
+
+def _probe(ipaddress):
+    '''Start a non-blocking connection to port 22'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    err = sock.connect_ex((ipaddress, 22))
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        sock.close()
+        return None
+    return sock
+
+
+def wait_for_ssh(hosts, timeout=SSH_TIMEOUT):
+    '''Wait until every (label, ipaddress) host answers with an SSH banner.
+    Returns the labels that were still down after timeout seconds.
+    '''
+    deadline = time.time() + timeout
+    pending = dict(hosts)
+    # label: (socket, connected); labels absent are waiting to retry
+    probes = {}
+    retry_at = dict((label, 0) for label in pending)
+    while pending and time.time() < deadline:
+        now = time.time()
+        for label in pending:
+            if label not in probes and retry_at[label] <= now:
+                sock = _probe(pending[label])
+                if sock is None:
+                    retry_at[label] = now + SSH_RETRY
+                else:
+                    probes[label] = (sock, False)
+        connecting = [sock for sock, connected in probes.values() if not connected]
+        banners = [sock for sock, connected in probes.values() if connected]
+        if not probes:
+            time.sleep(SSH_RETRY)
+            continue
+        readable, writable, _ = select.select(banners, connecting, [], SSH_RETRY)
+        for label, (sock, connected) in probes.items():
+            if not connected:
+                if sock not in writable:
+                    continue
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    probes[label] = (sock, True)
+                    continue
+            else:
+                if sock not in readable:
+                    continue
+                try:
+                    banner = sock.recv(64)
+                except socket.error:
+                    banner = ''
+                if banner.startswith('SSH-'):
+                    sock.close()
+                    del probes[label]
+                    del pending[label]
+                    say(label, "ssh is up")
+                    continue
+            # Refused, reset or not sshd yet: try again shortly
+            sock.close()
+            del probes[label]
+            retry_at[label] = time.time() + SSH_RETRY
+    for sock, _ in probes.values():
+        sock.close()
+    return sorted(pending)
+
+
+def connect(ipaddress):
+    '''Open an SSH connection to a new VM as root, with key authentication'''
+    import paramiko
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(ipaddress, username='root', timeout=45)
+    return ssh
+
+
+def run_host(label, ipaddress, commands):
+    '''Run commands in order on one host, streaming prefixed output and
+    stopping at the first failure. Returns (label, exit status, failed
+    command, seconds).
+    '''
+    started = time.time()
+    command = None
+    try:
+        ssh = connect(ipaddress)
+    except Exception, error:
+        say(label, "connection failed: %s" % error)
+        return label, None, None, time.time() - started
+    try:
+        for command in commands:
+            say(label, "$ %s" % command)
+            channel = ssh.get_transport().open_session()
+            channel.set_combined_stderr(True)
+            channel.exec_command(command)
+            output = channel.makefile('r')
+            for line in output:
+                say(label, line.rstrip('\r\n'))
+            status = channel.recv_exit_status()
+            if status != 0:
+                return label, status, command, time.time() - started
+    except Exception, error:
+        logging.debug("Bootstrap of %s failed", label, exc_info=True)
+        say(label, "failed: %s" % error)
+        return label, None, command, time.time() - started
+    finally:
+        ssh.close()
+    return label, 0, None, time.time() - started
+
+
+def run(hosts, commands, workers=WORKERS):
+    '''Run commands on every (label, ipaddress) host, at most workers at a
+    time. Returns the run_host results in host order.
+    '''
+    if not hosts:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(hosts))))
+    try:
+        return pool.map(lambda host: run_host(host[0], host[1], commands), hosts)
+    finally:
+        pool.close()
+
+
+def summary(results, down=()):
+    '''Print the outcome per host and return the number of failed hosts'''
+    failed = 0
+    print "Bootstrap summary:"
+    for label in down:
+        failed += 1
+        print "  %-40s ssh never came up" % label
+    for label, status, command, elapsed in results:
+        if status == 0:
+            print "  %-40s ok (%.0fs)" % (label, elapsed)
+            continue
+        failed += 1
+        if status is None and command is None:
+            print "  %-40s could not connect" % label
+        elif status is None:
+            print "  %-40s error running '%s'" % (label, command)
+        else:
+            print "  %-40s exit %d from '%s' (%.0fs)" % (label, status, command, elapsed)
+    return failed
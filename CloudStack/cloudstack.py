@@ -1,60 +1,78 @@
 '''Utilities module for interacting with the CloudStack API.
-Contains a function for parsing the hostname and assigning the correct
-config (.cloud.cfg) section, as well as a function for returning
-available CloudStack virtual sizes.
+Contains a function for returning the shared client for a config
+(.cloud.cfg) section, as well as a function for returning available
+CloudStack virtual sizes.
 Contains one class (CloudStack) which inherits methods from the cs.CloudStack
-    -- fetchVMs(fqdn) Fetch all VMs matching the FQDN provided
+    -- fetchVMs(fqdn) Fetch all VMs matching the FQDN provided, from the local
+       inventory mirror when one is configured
     -- fetchStoragePool(ip) List all storage pools attached to IP
+    -- list_records(kind) Page through a listing as compact records
+    -- list_cached(kind) Hosts, pools or offerings, from the inventory mirror
+       when one is configured
     -- getSizes() List sizes available for provisioning
 '''
 
 import sys
+import threading
 import time
 
-from ConfigParser import (NoSectionError, NoOptionError)
-from urllib2 import HTTPError
-
 from cs import CloudStack as CStack
 from CloudStack.hostname import HostName
+from CloudStack.inventory import KINDS, open_inventory
+from CloudStack import ratelimit, records
+
+# Process-wide client registry, so every caller for an environment shares one
+# client and its inventory
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+# List arguments that are not fields of the objects listed
+LIST_OPTIONS = ('listall', 'isrecursive')
 
+# Seconds a catalog entry stays valid in long-lived processes (the daemon);
+# short script runs keep entries for the whole run
+CATALOG_TTL = 600
 
-def cloud(fqdn, config):
-    '''Parse a hostname and assign the corresponding config section,
-    returning a CloudStack object
+
+def cloud_env(env, config):
+    '''Return the CloudStack object for a named config section, reusing the
+    client already built for it in this process
     '''
-    hostname = HostName(fqdn)
-    env = hostname.cs_env
-    if not env:
-        raise Exception('Could not identify cloudstack environment from fqdn')
     if not config.has_section(env):
         raise Exception('.cloud.cfg does not have the required env: {}'.format(env))
-    return CloudStack(config.get(env, 'apiurl'), config.get(env, 'apikey'),
-                      config.get(env, 'secret'), config.get(env, 'zone'),
-                      config.get(env, 'account'), config.get(env, 'domain'))
+    key = (env, config.get(env, 'apiurl'), config.get(env, 'apikey'))
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = _build(env, config)
+        return _CLIENTS[key]
+
+
+def _build(env, config):
+    '''Create a CloudStack object for a config section'''
+    cloudstack = CloudStack(config.get(env, 'apiurl'), config.get(env, 'apikey'),
+                            config.get(env, 'secret'), config.get(env, 'zone'),
+                            config.get(env, 'account'), config.get(env, 'domain'))
+    if config.has_option('Global', 'ApiRetries'):
+        cloudstack.retries = config.getint('Global', 'ApiRetries')
+    if config.has_option('Global', 'InventoryMaxAge'):
+        cloudstack.use_inventory(open_inventory(env, config, cloudstack),
+                                 config.getint('Global', 'InventoryMaxAge'))
+    return cloudstack
 
 
 def cloudsizes(config):
-    '''Return available CloudStack virtual sizes'''
-    secs = config.sections()
-    secs.remove('Global')
+    '''Return available CloudStack virtual sizes, querying every site in
+    parallel and noting the sites that could not be reached
+    '''
+    from CloudStack.fanout import fanout, sites
+    results, errors = fanout(config, lambda cloudstack: cloudstack.get_sizes(), timeout=20)
     sizes = []
-    for env in secs:
+    for env in sites(config):
         sizes.append('---{} Sizes---'.format(env))
-        try:
-            apiurl = config.get(env, 'apiurl')
-            apikey = config.get(env, 'apikey')
-            secret = config.get(env, 'secret')
-            zone = config.get(env, 'zone')
-            account = config.get(env, 'account')
-            domain = config.get(env, 'domain')
-        except (NoSectionError, NoOptionError):
-            continue
-        if all([apiurl, apikey, secret, zone]):
-            cloudstack = CloudStack(apiurl, apikey, secret, zone, account, domain)
-            try:
-                sizes.extend(cloudstack.get_sizes())
-            except HTTPError:
-                continue
+        if env in errors:
+            sizes.append('  unavailable: {}'.format(errors[env]))
+        else:
+            sizes.extend(results[env])
     return sizes
 
 
@@ -67,13 +85,53 @@ class CloudStack(CStack):
         self.zone = zone
         self.account = account
         self.domain = domain
+        self.limiter = ratelimit.limiter_for(url)
+        self.retries = ratelimit.RETRIES
+        self.inventory = None
+        self.inventory_max_age = None
+        # Zones, domains, offerings and templates found so far, as
+        # (found at, entry), and their lifetime in seconds (None: forever)
+        self.catalog = {}
+        self.catalog_ttl = None
+
+    def _request(self, command, *args, **kwargs):
+        '''Send an API request through the endpoint's rate limiter, retrying
+        transient failures of read-only (list*/query*) commands
+        '''
+        idempotent = command.startswith('list') or command.startswith('query')
+        return ratelimit.call(self.limiter,
+                              lambda: super(CloudStack, self)._request(command, *args, **kwargs),
+                              idempotent, self.retries, command)
+
+    def use_inventory(self, inventory, max_age):
+        '''Serve lookups from a local inventory no older than max_age seconds'''
+        self.inventory = inventory
+        self.inventory_max_age = max_age
+
+    def _cached(self, kind, name):
+        '''Return a catalog entry, or None when absent or expired'''
+        entry = self.catalog.get((kind, name))
+        if entry is None:
+            return None
+        if self.catalog_ttl is not None and time.time() - entry[0] > self.catalog_ttl:
+            self.catalog.pop((kind, name), None)
+            return None
+        return entry[1]
+
+    def _remember(self, kind, name, value):
+        '''Store a catalog entry and return it'''
+        self.catalog[(kind, name)] = (time.time(), value)
+        return value
 
     def fetch_domain(self, domain):
         '''Retrieve domain from CS'''
-        domains = self.listDomains(listall='true').get('domain', [])
+        cached = self._cached('domain', domain)
+        if cached is not None:
+            return cached
+        domains = self.list_all('listDomains', 'domain', listall='true')
         for dom in domains:
             if domain in dom['name']:
-                return dom
+                return self._remember('domain', domain, dom)
         return None
 
     def fetch_network(self, domain, network):
@@ -86,67 +144,91 @@ class CloudStack(CStack):
 
     def fetch_zone(self, zone):
         '''Retrieve zone from CS'''
-        zones = self.listZones(listall='true').get('zone', [])
+        cached = self._cached('zone', zone)
+        if cached is not None:
+            return cached
+        zones = self.list_all('listZones', 'zone', listall='true')
         for zon in zones:
             if zone in zon['name']:
-                return zon
+                return self._remember('zone', zone, zon)
         return None
 
     def fetch_service_offering(self, name):
         '''Retrieve service offering from CS'''
-        services = self.listServiceOfferings(listall='true').get('serviceoffering', [])
-        for svc in services:
+        cached = self._cached('service_offering', name)
+        if cached is not None:
+            return cached
+        for svc in self.list_cached('serviceofferings', listall='true'):
             if svc['name'] == name:
-                return svc
+                return self._remember('service_offering', name, svc)
         return None
 
     def fetch_host(self, name, zoneid):
         '''Retrieve host from CS'''
         short_name = name.split(".")[0]
-        hosts = self.listHosts(listall='true', zoneid=zoneid).get('host', [])
-        for hst in hosts:
+        for hst in self.list_cached('hosts', listall='true', zoneid=zoneid):
             if hst['name'] == name or hst['name'] == short_name:
                 return hst
         return None
 
     def fetch_template(self, template):
         '''Retrieve template from CS'''
+        cached = self._cached('template', template)
+        if cached is not None:
+            return cached
         for fltr in ('featured', 'self', 'self-executable', 'executable', 'community'):
-            templates = self.listTemplates(listall='true', templatefilter=fltr).get('template', [])
-            for tmpl in templates:
+            for tmpl in self.list_all('listTemplates', 'template', listall='true',
+                                      templatefilter=fltr):
                 if tmpl['name'] == template:
-                    return tmpl
+                    return self._remember('template', template, tmpl)
         return None
 
     def list_available_templates(self):
         '''List all available VM templates'''
         alltemplates = []
         for fltr in ('featured', 'self', 'self-executable', 'executable', 'community'):
-            templates = self.listTemplates(listall='true', templatefilter=fltr).get('template', [])
-            alltemplates.append(templates)
+            alltemplates.extend(self.list_all('listTemplates', 'template', listall='true',
+                                              templatefilter=fltr))
         return alltemplates
 
+    def list_vms(self, full=False):
+        '''Return every VM in the configured zone and domain as records (see
+        CloudStack.records), from the inventory mirror when one is in use.
+        Callers reading fields beyond the kept ones pass full, so each record
+        holds its whole payload instead of fetching it per VM.
+        '''
+        if self.inventory:
+            self.inventory.ensure_fresh('vms', self.inventory_max_age)
+            return list(records.decode('vms', (virtm for virtm in self.inventory.all('vms')
+                                               if self.zone in virtm['zonename'] and
+                                               self.domain in virtm['domain']),
+                                       self, full=True))
+        zoneid = self.fetch_zone(self.zone)['id']
+        domainid = self.fetch_domain(self.domain)['id']
+        return list(self.list_records('vms', full=full, listall='true', zoneid=zoneid,
+                                      domainid=domainid))
+
     def fetch_vms(self, fqdn):
-        '''Return a list of VMs matching with the provided FQDN'''
+        '''Return the VMs (as records) matching the provided FQDN'''
         hostname = HostName(fqdn)
-        zoneid = self.fetchZone(self.ZONE)['id']
-        domainid = self.fetchDomain(self.DOMAIN)['id']
         host = hostname.name
-        vms = self.listVirtualMachines(listall='true', zoneid=zoneid,
-                                       domainid=domainid).get('virtualmachine', [])
-        hosts = []
-        for virtm in vms:
-            if virtm['name'] == host:
-                hosts.append(virtm)
-        return hosts
+        if self.inventory:
+            self.inventory.ensure_fresh('vms', self.inventory_max_age)
+            return list(records.decode('vms', (virtm for virtm in self.inventory.vms_by_name(host)
+                                               if self.zone in virtm['zonename'] and
+                                               self.domain in virtm['domain']),
+                                       self, full=True))
+        zoneid = self.fetch_zone(self.zone)['id']
+        domainid = self.fetch_domain(self.domain)['id']
+        # name= is a substring match on the server, so check it exactly here
+        return [virtm for virtm in self.list_records('vms', listall='true', zoneid=zoneid,
+                                                     domainid=domainid, name=host)
+                if virtm.name == host]
 
     def fetch_storage_pool(self, ipaddress):
         '''Return storage pools attached to the provided IP'''
-        pools = self.listStoragePools(listall='true').get('storagepool', [])
-        for pool in pools:
-            if pool['ipaddress'] == ipaddress:
-                return pool
-        return None
+        pools = self.list_cached('storagepools', listall='true', ipaddress=ipaddress)
+        return pools[0] if pools else None
 
     def wait_for_job(self, jobid):
         '''Wait for a job to finish'''
@@ -164,23 +246,106 @@ class CloudStack(CStack):
                     sys.exit(1)
                 return jobquery
 
+    def wait_for_jobs(self, jobs, on_done=None, interval=5):
+        '''Wait for several jobs at once. jobs maps jobid to a caller context;
+        on_done(context, jobquery) is called as each job succeeds and may
+        return (jobid, context) to chain a follow-up job. Returns a list of
+        (context, errortext) for the jobs that failed.
+        '''
+        pending = dict(jobs)
+        failed = []
+        while pending:
+            for jobid, context in pending.items():
+                jobquery = self.queryAsyncJobResult(jobid=jobid)
+                if jobquery['jobstatus'] == 0:
+                    continue
+                del pending[jobid]
+                if jobquery['jobresult'].get("errorcode"):
+                    failed.append((context, jobquery['jobresult']['errortext']))
+                    continue
+                chained = on_done(context, jobquery) if on_done else None
+                if chained:
+                    pending[chained[0]] = chained[1]
+            if pending:
+                print ".",
+                sys.stdout.flush()
+                time.sleep(interval)
+        print ""
+        return failed
+
+    def local_disk_offering(self, host, pool, offerings=None):
+        '''Return the local storage disk offering for a compute node, tagging
+        its storage pool and creating the offering if needed. offerings is an
+        optional name -> disk offering dict from an earlier listing.
+        '''
+        if host['name'] != pool.get('tags'):
+            print "Adding a tag to the storage pool"
+            self.updateStoragePool(id=pool['id'], tags=host['name'])
+            pool['tags'] = host['name']
+        if offerings is None:
+            diskoffering = self.listDiskOfferings(name=host['name']).get('diskoffering', '')
+            offerings = dict((off['name'], off) for off in diskoffering)
+        if host['name'] not in offerings:
+            print "Creating a disk offering for", host['name']
+            offerings[host['name']] = self.createDiskOffering(
+                displaytext=host['name'], name=host['name'], customized='true',
+                storagetype='local', tags=host['name']).get('diskoffering', [])
+        return offerings[host['name']]
+
     def get_sizes(self):
         '''Return the formatted list of available CloudStack virtual sizes'''
         packages = ["CloudStack Sizes:"]
-        for package in sorted(self.listServiceOfferings().get('serviceoffering', []),
+        for package in sorted(self.list_cached('serviceofferings'),
                               key=lambda k: "%02d %02d" % (k['cpunumber'], k['memory'] / 1024)):
             packages.append("  %-40s %d Core(s), %dGB" %
                             (package['name'], package['cpunumber'], package['memory'] / 1024))
         return packages
 
+    def list_all(self, command, key, pagesize=500, **kwargs):
+        '''Yield every object of a list command, one page at a time'''
+        page = 1
+        while True:
+            result = getattr(self, command)(page=page, pagesize=pagesize, **kwargs)
+            objects = result.get(key, [])
+            for obj in objects:
+                yield obj
+            if len(objects) < pagesize or page * pagesize >= result.get('count', 0):
+                return
+            page += 1
+
+    def list_records(self, kind, full=False, **kwargs):
+        '''Yield compact records (see CloudStack.records) of a kind, decoding
+        each page as it arrives. With full, records keep their whole payload.
+        '''
+        _, command, key = records.KINDS[kind]
+        return records.decode(kind, self.list_all(command, key, **kwargs), self, full)
+
+    def list_cached(self, kind, **kwargs):
+        '''Return every object of an inventory kind (CloudStack.inventory.KINDS)
+        matching the list arguments, from the inventory mirror when one is in
+        use. Kinds with a record type come back as records either way.
+        '''
+        if not self.inventory:
+            if kind in records.KINDS:
+                return list(self.list_records(kind, **kwargs))
+            command, key, _ = KINDS[kind]
+            return list(self.list_all(command, key, **kwargs))
+        self.inventory.ensure_fresh(kind, self.inventory_max_age)
+        objects = [obj for obj in self.inventory.all(kind)
+                   if all(unicode(obj.get(field)) == unicode(value)
+                          for field, value in kwargs.items() if field not in LIST_OPTIONS)]
+        if kind in records.KINDS:
+            return list(records.decode(kind, objects, self, full=True))
+        return objects
+
     def get_volumes(self, hostname, zoneid):
         '''Returns a list of volumes for a compute node.'''
         short_hostname = hostname.split(".")[0]
-        hostid = self.fetchHost(hostname, zoneid)['id']
+        hostid = self.fetch_host(hostname, zoneid)['id']
         volumes = []
-        for volume in self.listVolumes(listall='true', isrecursive='true',
-                                       zoneid=zoneid, hostid=hostid).get('volume', []):
-            storage = volume.get('storage', None)
+        for volume in self.list_records('volumes', listall='true', isrecursive='true',
+                                        zoneid=zoneid, hostid=hostid):
+            storage = volume.storage or ''
             if short_hostname in storage or hostname in storage:
                 volumes.append(volume)
         return volumes
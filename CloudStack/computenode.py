@@ -0,0 +1,532 @@
+'''Connection to a KVM compute node over SSH and the libvirt/qemu-img
+operations used to move image files between nodes.
+    -- qemu_features() Optional qemu-img/qemu-nbd features the node supports
+    -- stream_convert(file, format, new format, host, features) Convert an
+       image into place on another node in a single pass, with no local copy
+    -- disk_inventory(max_age) Every domain's disks, formats and sizes in one
+       remote command, cached per node
+'''
+
+import getpass
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from cStringIO import StringIO
+from xml.etree.cElementTree import iterparse
+
+# Parallel coroutines for qemu-img convert (-m, at most 16)
+CONVERT_COROUTINES = 8
+# Report the optional qemu features used here, one name per line:
+# 'coroutines' and 'unordered' for qemu-img convert -m and -W (qemu 2.9), and
+# 'fork' and 'pidfile' for qemu-nbd --fork and --pid-file
+QEMU_FEATURES_COMMAND = '''help=$(qemu-img --help 2>&1)
+echo "$help" | grep -q 'num_coroutines' && echo coroutines
+echo "$help" | grep -q -- '\[-W\]' && echo unordered
+help=$(qemu-nbd --help 2>&1)
+echo "$help" | grep -q -- '--fork' && echo fork
+echo "$help" | grep -q -- '--pid-file' && echo pidfile
+true
+'''
+
+# Suffix of converted copies written by convert_image
+CONVERTED_SUFFIX = '.conv'
+# Port range for the qemu-nbd exports used by stream_convert, bound to
+# localhost and reached from the destination through an ssh tunnel
+NBD_PORTS = (20000, 29999)
+
+# Bytes sent by probe_throughput, enough for TCP to leave slow start on
+# fast links
+PROBE_BYTES = 256 * 1024 ** 2
+# Write the probe sample to tmpfs before timing, from AES-CTR of zeros where
+# openssl is present as /dev/urandom is slow on older kernels, and open the
+# ssh connection as a control master so the timed transfer skips the
+# handshake. Prints the start and end times of the transfer.
+PROBE_COMMAND = '''sample=$(mktemp /dev/shm/probe.XXXXXX) || exit 1
+control=$sample.ssh
+trap 'ssh -o ControlPath=$control -O exit root@%(host)s 2>/dev/null; rm -f $sample' EXIT
+if command -v openssl > /dev/null; then
+    openssl enc -aes-128-ctr -nosalt -pass pass:probe < /dev/zero 2>/dev/null
+else
+    cat /dev/urandom
+fi | head -c %(nbytes)d > $sample || exit 1
+ssh -i /root/.ssh/id_rsa_compute -o ControlMaster=yes -o ControlPath=$control -fN \\
+    root@%(host)s || exit 1
+start=$(date +%%s.%%N)
+ssh -o ControlPath=$control root@%(host)s 'cat > /dev/null' < $sample || exit 1
+echo $start $(date +%%s.%%N)
+'''
+
+# Seconds a node's disk inventory is served from cache
+DISK_INVENTORY_MAX_AGE = 300
+
+# Dump every domain's XML wrapped in one document so a single streaming parse
+# reads the whole node, then after it one 'size blocks blocksize path' line per
+# disk file. The file paths are taken from the dumped XML, unescaped, and
+# stated by one stat process; the stats stay outside the XML as stat does not
+# escape file names.
+DISK_INVENTORY_COMMAND = '''xml=$(for dom in $(virsh list --all --name); do virsh dumpxml "$dom"; done)
+echo '<node>'
+printf '%s\\n' "$xml"
+echo '</node>'
+printf '%s\\n' "$xml" | sed -n "s/.*<source file='\\([^']*\\)'.*/\\1/p" |
+    sed "s/&lt;/</g; s/&gt;/>/g; s/&quot;/\\"/g; s/&apos;/'/g; s/&amp;/\\&/g" |
+    sort -u | xargs -r -d '\\n' stat -c '%s %b %B %n' 2>/dev/null
+true
+'''
+
+# hostip: (time collected, inventory)
+_DISK_INVENTORIES = {}
+_DISK_INVENTORIES_LOCK = threading.Lock()
+
+
+class ComputeNode(object):
+    '''Connection to source node and methods for interaction'''
+
+    def __init__(self, hostip):
+        '''Connect to remote server, through the daemon's warm connection
+        when one is running'''
+        from CloudStack.daemon import remote_ssh
+        self.hostip = hostip
+        self.features = None
+        self.direct = None
+        self.ssh = remote_ssh(hostip)
+        if self.ssh is None:
+            self.ssh = self.direct = self.connect()
+
+    def connect(self):
+        '''Open a direct SSH connection to the node'''
+        import paramiko
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            ssh.connect(self.hostip, username='root', timeout=20)
+        except paramiko.SSHException:
+            password = getpass.getpass(prompt="Please enter password for %s: " % self.hostip)
+            ssh.connect(self.hostip, username='root', password=password, timeout=20)
+        return ssh
+
+    def streaming(self):
+        '''SSH client for transfers whose output is read as it arrives. The
+        daemon only replies once a command has finished, so these always use
+        a direct connection.
+        '''
+        if self.direct is None:
+            self.direct = self.connect()
+        return self.direct
+
+    def get_disks(self, vminstance):
+        '''dumpxml of instance-name and parse every disk, returning a list of
+        {'device': target dev, 'file': source file path} in target order
+        '''
+        command = "virsh dumpxml %s" % vminstance
+        try:
+            _, stdout, stderr = self.ssh.exec_command(command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'virsh dumpxml': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.exception("Failed to parse for image file: %s", error)
+            sys.exit(2)
+        import xmltodict
+        output = stdout.read()
+        xmldict = xmltodict.parse(output)
+        alldisks = []
+        try:
+            disks = xmldict['domain']['devices']['disk']
+            if isinstance(disks, dict):
+                disks = [disks]
+            for disk in disks:
+                if disk['@device'] == 'disk':
+                    alldisks.append({'device': disk['target']['@dev'],
+                                     'file': disk['source']['@file']})
+        except KeyError:
+            logging.exception("Unable to image file from VM xml")
+            sys.exit(2)
+        if not alldisks:
+            logging.error("No image files found in the VM xml")
+            sys.exit(2)
+        return sorted(alldisks, key=lambda disk: disk['device'])
+
+    def get_volume_name(self, vminstance):
+        '''Return the root image file path of an instance'''
+        return self.get_disks(vminstance)[0]['file']
+
+    def get_volume_type(self, storagefile):
+        '''Determine image file type (qcow2 or raw)'''
+        command = "qemu-img info %s |grep 'file format'" % storagefile
+        try:
+            _, stdout, stderr = self.ssh.exec_command(command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'qemu-img info': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.exception("Failed to determine image type: %s", error)
+            sys.exit(2)
+        output = stdout.read()
+        query = re.compile("file format: (.*)")
+        vol_type = query.search(output).group(1)
+        return vol_type
+
+    def image_info(self, storagefile):
+        '''Return (format, virtual size, allocated bytes) of an image file'''
+        command = "qemu-img info --output=json %s" % storagefile
+        try:
+            _, stdout, stderr = self.ssh.exec_command(command)
+            output = stdout.read()
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'qemu-img info': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.exception("Failed to read image info: %s", error)
+            sys.exit(2)
+        info = json.loads(output)
+        return info['format'], info['virtual-size'], info.get('actual-size', info['virtual-size'])
+
+    def qemu_features(self):
+        '''Return the set of optional qemu features (see
+        QEMU_FEATURES_COMMAND) the node supports, probed once per connection.
+        A node that cannot be probed is assumed to support none of them.
+        '''
+        if self.features is not None:
+            return self.features
+        try:
+            _, stdout, stderr = self.ssh.exec_command(QEMU_FEATURES_COMMAND)
+            output = stdout.read()
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error probing qemu: %s" % stderr.read())
+            self.features = frozenset(output.split())
+        except RuntimeError, error:
+            logging.warn("Failed to probe qemu features on %s: %s", self.hostip, error)
+            self.features = frozenset()
+        return self.features
+
+    def probe_throughput(self, new_host_ip, nbytes=PROBE_BYTES):
+        '''Stream nbytes of incompressible data to the destination host over
+        the same ssh path rsync uses, returning bytes per second
+        '''
+        command = PROBE_COMMAND % {'host': new_host_ip, 'nbytes': nbytes}
+        try:
+            _, stdout, stderr = self.streaming().exec_command(command)
+            output = stdout.read()
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error streaming test data: %s" % stderr.read())
+        except RuntimeError, error:
+            logging.warn("Failed to probe throughput to %s: %s", new_host_ip, error)
+            return None
+        start, end = [float(stamp) for stamp in output.split()]
+        return nbytes / max(end - start, 0.001)
+
+    def get_backing_file(self, storagefile):
+        '''Parse backing file path for qcow2 image'''
+        command = "qemu-img info %s |grep 'backing file'" % storagefile
+        try:
+            _, stdout, stderr = self.ssh.exec_command(command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'qemu-img info': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.exception("Failed to determine backing file: %s", error)
+            sys.exit(2)
+        output = stdout.read()
+        query = re.compile(r"backing file: (.*) \(.*$")
+        query2 = re.compile("backing file: (.*)")
+        search = query.search(output)
+        if not search:
+            search = query2.search(output)
+        if not search:
+            logging.error("Unable to parse backing file")
+            sys.exit(2)
+        backing_file = search.group(1).split('/')[5]
+        return backing_file
+
+    def convert_image(self, storagefile, ori_type, new_format):
+        '''Convert image format into a new file next to the original, which
+        is left untouched, returning the converted file's path
+        '''
+        converted = storagefile + CONVERTED_SUFFIX
+        command = "qemu-img convert %s-f %s -O %s %s %s" % (
+            convert_options(self.qemu_features()), ori_type, new_format, storagefile,
+            converted)
+        try:
+            _, stdout, stderr = self.ssh.exec_command(command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'qemu-img convert': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.exception("Failed to convert image file: %s", error)
+            sys.exit(2)
+        return converted
+
+    def tar_volume(self, vmname, storagefile, suffix=''):
+        '''tar raw sparse image. With a suffix the file read is storagefile
+        plus suffix (such as a converted copy), stored under the image name.
+        '''
+        imagetar = vmname + '.tgz'
+        filename = storagefile.split('/')[5]
+        command = "cd /var/lib/libvirt/images; bsdtar -cf %s %s" % (imagetar, filename)
+        if suffix:
+            command = "cd /var/lib/libvirt/images; bsdtar -cf %s -s ',%s$,,' %s%s" % (
+                imagetar, suffix.replace('.', '\\.'), filename, suffix)
+        try:
+            _, stdout, stderr = self.ssh.exec_command(command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'bsdtar -cf': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.exception("Failed to archive image file: %s", error)
+            sys.exit(2)
+        return imagetar
+
+    def can_stream(self):
+        '''True if qemu-nbd here can export an image for stream_convert'''
+        return 'fork' in self.qemu_features()
+
+    def stream_convert(self, storagefile, ori_type, new_format, new_host_ip, label=None,
+                       features=frozenset()):
+        '''Convert an image straight into place on the destination host: the
+        image is exported read-only with qemu-nbd on this node, tunnelled over
+        the compute ssh key, and read by qemu-img convert on the destination,
+        whose qemu_features() are given as features. Nothing is written
+        locally and the image is read once. Returns False if the stream could
+        not be completed, so the caller can fall back to archive and rsync.
+        '''
+        port = random.randint(*NBD_PORTS)
+        remote = "qemu-img convert -p %s-f raw -O %s nbd://127.0.0.1:%d %s" % (
+            convert_options(features), new_format, port, storagefile)
+        if 'pidfile' in self.qemu_features():
+            pidfile = "/tmp/qemu-nbd-%d.pid" % port
+            export = "qemu-nbd --read-only --fork --pid-file %s" % pidfile
+            stop = "kill $(cat %s) 2>/dev/null; rm -f %s" % (pidfile, pidfile)
+        else:
+            export = "qemu-nbd --read-only --fork"
+            stop = "pkill -f '^qemu-nbd .*-p %d ' 2>/dev/null" % port
+        command = ("%s -f %s -b 127.0.0.1 -p %d %s && "
+                   "ssh -i /root/.ssh/id_rsa_compute -o ExitOnForwardFailure=yes "
+                   "-R %d:127.0.0.1:%d root@%s '%s'; status=$?; %s; exit $status" % (
+                       export, ori_type, port, storagefile, port, port, new_host_ip,
+                       remote, stop))
+        try:
+            _, stdout, stderr = self.streaming().exec_command(command)
+            while not stdout.channel.exit_status_ready():
+                if stdout.channel.recv_ready():
+                    output = stdout.channel.recv(1024).strip()
+                    if label:
+                        sys.stdout.write("[%s] %s\n" % (label, output.split('\r')[-1]))
+                    else:
+                        sys.stdout.write("\r%s" % output)
+                    sys.stdout.flush()
+                else:
+                    time.sleep(0.2)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error streaming to %s: %s" % (new_host_ip, stderr.read()))
+        except RuntimeError, error:
+            logging.warn("Failed to stream image file: %s", error)
+            return False
+        print ''
+        return True
+
+    def clean_file(self, filename):
+        '''Delete a remote file'''
+        command = "cd /var/lib/libvirt/images; rm -f %s " % filename
+        try:
+            _, stdout, stderr = self.ssh.exec_command(command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'rm -f': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.warn("Failed to cleanup archive file: %s", error)
+
+    def untar_volume(self, imagetar):
+        '''Extract tar archive of raw image file'''
+        command = "cd /var/lib/libvirt/images; tar -xSf %s" % imagetar
+        try:
+            _, stdout, stderr = self.ssh.exec_command(command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'tar -xSf': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.exception("Failed to extract image archive: %s", error)
+            sys.exit(2)
+        return
+
+    def rsync_volume(self, new_host_ip, imagefile, nocompress, label=None):
+        '''rsync image archive to destination compute host. With a label,
+        progress is written as prefixed lines so parallel transfers can share
+        the terminal.
+        '''
+        imagepath = '/var/lib/libvirt/images/' + imagefile
+        if nocompress:
+            command = "rsync -v -e 'ssh -i /root/.ssh/id_rsa_compute' \
+            --progress %s root@%s:%s" % (imagepath, new_host_ip, imagepath)
+        else:
+            command = "rsync -avz -e 'ssh -i /root/.ssh/id_rsa_compute' \
+                --progress %s root@%s:%s" % (imagepath, new_host_ip, imagepath)
+        try:
+            _, stdout, stderr = self.streaming().exec_command(command)
+            while not stdout.channel.exit_status_ready():
+                if stdout.channel.recv_ready():
+                    output = stdout.channel.recv(1024).strip()
+                    if label:
+                        sys.stdout.write("[%s] %s\n" % (label, output.split('\r')[-1]))
+                    else:
+                        sys.stdout.write("\r%s" % output)
+                    sys.stdout.flush()
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'rynsc': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.exception("Failed to rsync image archive: %s", error)
+            sys.exit(2)
+        print ''
+        return
+
+    def copy_dhclient(self, oldfile, newfile):
+        '''Copy dhclient leases between images'''
+        out_command = "virt-copy-out -a %s /var/lib/dhcp/dhclient.eth0.leases \
+            /tmp" % oldfile
+        in_command = "virt-copy-in -a %s /tmp/dhclient.eth0.leases /var/lib/dhcp" % newfile
+        try:
+            _, stdout, stderr = self.ssh.exec_command(out_command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise Exception("Error with 'virt-copy-out': %s" % stderr.read())
+            _, stdout, stderr = self.ssh.exec_command(in_command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'virt-copy-in': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.exception("Failed to copy dhcp lease file: %s", error)
+            sys.exit(2)
+        return
+
+    def copy_hostname(self, oldfile, newfile):
+        '''Copy /etc/hostname between images'''
+        out_command = "virt-copy-out -a %s /etc/hostname /tmp" % oldfile
+        in_command = "virt-copy-in -a %s /tmp/hostname /etc" % newfile
+        try:
+            _, stdout, stderr = self.ssh.exec_command(out_command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise Exception("Error with 'virt-copy-out': %s" % stderr.read())
+            _, stdout, stderr = self.ssh.exec_command(in_command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'virt-copy-in': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.exception("Failed to copy hostname file: %s", error)
+            sys.exit(2)
+        return
+
+    def replace_volume(self, oldfile, newfile):
+        '''Overwrite a file'''
+        command = "mv -f %s %s" % (newfile, oldfile)
+        try:
+            _, stdout, stderr = self.ssh.exec_command(command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'mv -f': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.exception("Failed to replace volume file: %s", error)
+            sys.exit(2)
+        return
+
+    def close(self):
+        '''Close the SSH connections'''
+        self.ssh.close()
+        if self.direct is not None and self.direct is not self.ssh:
+            self.direct.close()
+        return
+
+    def disk_inventory(self, max_age=DISK_INVENTORY_MAX_AGE):
+        '''Return {instance name: [disk, ...]} for every domain defined on the
+        node, each disk a dict of device, file, format, size (apparent bytes)
+        and allocated (bytes on disk). Collected in one remote command and
+        reused for max_age seconds; returns None if the node cannot be read.
+        '''
+        with _DISK_INVENTORIES_LOCK:
+            cached = _DISK_INVENTORIES.get(self.hostip)
+        if cached and time.time() - cached[0] <= max_age:
+            return cached[1]
+        started = time.time()
+        try:
+            _, stdout, stderr = self.ssh.exec_command(DISK_INVENTORY_COMMAND)
+            output = stdout.read()
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'virsh dumpxml': %s" % stderr.read())
+            inventory = parse_disk_inventory(output)
+        except (RuntimeError, SyntaxError, ValueError), error:
+            logging.warn("Failed to read disk inventory from %s: %s", self.hostip, error)
+            return None
+        with _DISK_INVENTORIES_LOCK:
+            _DISK_INVENTORIES[self.hostip] = (started, inventory)
+        return inventory
+
+    def disk_usage(self, path='/var/lib/libvirt/images'):
+        '''Return (used, size) bytes of the filesystem holding path'''
+        command = "df -B1 --output=used,size %s | tail -1" % path
+        try:
+            _, stdout, stderr = self.ssh.exec_command(command)
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError("Error with 'df': %s" % stderr.read())
+        except RuntimeError, error:
+            logging.warn("Failed to read disk usage: %s", error)
+            return None, None
+        used, size = stdout.read().split()
+        return int(used), int(size)
+
+
+def convert_options(features):
+    '''qemu-img convert options for parallel, out of order writes, as far
+    as a node's qemu_features() allow, with a trailing space
+    '''
+    options = ''
+    if 'coroutines' in features:
+        options += '-m %d ' % CONVERT_COROUTINES
+        if 'unordered' in features:
+            options += '-W '
+    return options
+
+
+def parse_disk_inventory(output):
+    '''Parse DISK_INVENTORY_COMMAND output, releasing each domain element
+    once its disks are read
+    '''
+    # Any '</node>' inside the document is escaped, so the first one ends it
+    document, _, stats = output.partition('</node>')
+    domains = {}
+    sizes = {}
+    for line in stats.splitlines():
+        if line.strip():
+            size, blocks, blocksize, path = line.split(' ', 3)
+            sizes[path] = (int(size), int(blocks) * int(blocksize))
+    root = None
+    for event, elem in iterparse(StringIO(document + '</node>'), events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event != 'end':
+            continue
+        if elem.tag == 'domain':
+            disks = []
+            for disk in elem.iterfind('devices/disk'):
+                source = disk.find('source')
+                if disk.get('device') != 'disk' or source is None or not source.get('file'):
+                    continue
+                driver = disk.find('driver')
+                disks.append({'device': disk.find('target').get('dev'),
+                              'file': source.get('file'),
+                              'format': driver.get('type') if driver is not None else None})
+            domains[elem.findtext('name')] = sorted(disks, key=lambda disk: disk['device'])
+            root.clear()
+    for disks in domains.values():
+        for disk in disks:
+            disk['size'], disk['allocated'] = sizes.get(disk['file'], (None, None))
+    return domains
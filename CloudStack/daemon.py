@@ -0,0 +1,275 @@
+'''Optional resident daemon that keeps CloudStack clients (with their catalog
+and inventory caches) and compute node SSH transports warm between script
+runs, serving them over a Unix socket.
+
+Requests and replies are single lines of JSON:
+    {"op": "call", "env": "sea", "method": "fetch_vms", "args": [...], "kwargs": {...}}
+    {"op": "ssh", "host": "10.0.0.5", "command": "virsh list"}
+    {"op": "client", "env": "sea"} / {"op": "ping"} / {"op": "shutdown"}
+
+Scripts use it through client() and RemoteSSH, which return None / are not
+used when no daemon is listening, so everything falls back to direct mode.
+Compact records are rebuilt on the calling side, so they behave as in direct
+mode. SSH through the daemon requires key authentication, as there is no
+terminal to prompt for a password on, and only suits short commands: output
+comes back once a command ends, so transfers that show progress (rsync,
+streamed conversions) keep a direct connection.
+    -- serve(config, path) Run the daemon in the foreground
+    -- client(env) A proxy CloudStack object, or None
+'''
+
+import json
+import logging
+import os
+import socket
+import SocketServer
+import threading
+import types
+
+from CloudStack import records
+
+# Set in the daemon process (and by users who want direct mode) so clients
+# are never routed back through a socket
+DISABLE_ENV = 'CLOUDSTACK_NO_DAEMON'
+
+# CloudStack methods that run in the calling process: they print progress,
+# sleep between polls or mutate arguments owned by the caller
+LOCAL_METHODS = ('wait_for_job', 'wait_for_jobs', 'local_disk_offering')
+
+
+class RemoteError(Exception):
+    '''An exception raised inside the daemon while serving a request'''
+    pass
+
+
+def socket_path():
+    '''Unix socket location, from $CLOUDSTACK_SOCKET or the default'''
+    return os.path.expanduser(os.environ.get('CLOUDSTACK_SOCKET', '~/.cloudstack.sock'))
+
+
+def request(path, message, client=None):
+    '''Send one request to the daemon and return its result, rebuilding any
+    records in it with client to fetch their full payloads
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        conn.sendall(json.dumps(message) + '\n')
+        reply = conn.makefile('r').readline()
+    finally:
+        conn.close()
+    if not reply:
+        raise RemoteError('No reply from daemon at {}'.format(path))
+    reply = json.loads(reply, object_hook=lambda obj: records.load(obj, client)
+                       if '__record__' in obj else obj)
+    if not reply['ok']:
+        raise RemoteError(reply['error'])
+    return reply['result']
+
+
+def available(path):
+    '''True if a daemon answers on the socket'''
+    if os.environ.get(DISABLE_ENV) or not os.path.exists(path):
+        return False
+    try:
+        return request(path, {'op': 'ping'}) == 'pong'
+    except (socket.error, RemoteError, ValueError):
+        return False
+
+
+class RemoteCloudStack(object):
+    '''Stand-in for a CloudStack object whose calls are served by the daemon'''
+
+    def __init__(self, path, env):
+        self.path = path
+        self.env = env
+        attrs = request(path, {'op': 'client', 'env': env})
+        self.zone = attrs['zone']
+        self.account = attrs['account']
+        self.domain = attrs['domain']
+        self.inventory = None
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        if method in LOCAL_METHODS:
+            from CloudStack.cloudstack import CloudStack
+            return types.MethodType(getattr(CloudStack, method).__func__, self)
+
+        def remote(*args, **kwargs):
+            '''Run the method on the daemon's client'''
+            return request(self.path, {'op': 'call', 'env': self.env, 'method': method,
+                                       'args': args, 'kwargs': kwargs}, self)
+        return remote
+
+
+class _Output(object):
+    '''Completed command output shaped like a paramiko ChannelFile'''
+
+    def __init__(self, data, exit_status):
+        self.data = data
+        self.channel = self
+        self.exit_status = exit_status
+
+    def read(self):
+        return self.data
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_ready(self):
+        return False
+
+
+class RemoteSSH(object):
+    '''Stand-in for paramiko.SSHClient running commands on the daemon's
+    warm transport to a compute node
+    '''
+
+    def __init__(self, path, hostip):
+        self.path = path
+        self.hostip = hostip
+
+    def exec_command(self, command):
+        '''Run a command, returning (stdin, stdout, stderr) once it finishes'''
+        result = request(self.path, {'op': 'ssh', 'host': self.hostip, 'command': command})
+        return (None, _Output(result['stdout'], result['exit_status']),
+                _Output(result['stderr'], result['exit_status']))
+
+    def close(self):
+        '''The daemon keeps the connection open'''
+        pass
+
+
+_CLIENTS = {}
+
+
+def client(env):
+    '''Return a RemoteCloudStack for env if a daemon is running, else None'''
+    path = socket_path()
+    if (path, env) not in _CLIENTS:
+        _CLIENTS[(path, env)] = RemoteCloudStack(path, env) if available(path) else None
+    return _CLIENTS[(path, env)]
+
+
+def remote_ssh(hostip):
+    '''Return a RemoteSSH for hostip if a daemon is running, else None'''
+    path = socket_path()
+    if available(path):
+        return RemoteSSH(path, hostip)
+    return None
+
+
+def _encode(obj):
+    '''JSON fallback for compact records, which travel whole (Record.dump())'''
+    if isinstance(obj, records.Record):
+        return obj.dump()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    '''Serve JSON line requests on one connection'''
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                result = self.server.dispatch(json.loads(line))
+                reply = {'ok': True, 'result': result}
+            except Exception, error:
+                logging.debug("Request failed: %s", line, exc_info=True)
+                reply = {'ok': False, 'error': '{}: {}'.format(type(error).__name__, error)}
+            self.wfile.write(json.dumps(reply, default=_encode) + '\n')
+            self.wfile.flush()
+
+
+class Daemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''Unix socket server holding warm clients and SSH connections'''
+
+    daemon_threads = True
+
+    def __init__(self, config, path):
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        self.config = config
+        self.nodes = {}
+        self.nodes_lock = threading.Lock()
+
+    def client(self, env):
+        '''Return the shared client for env, expiring its catalog entries so
+        renamed or deleted zones, offerings and templates are picked up
+        '''
+        from CloudStack.cloudstack import cloud_env, CATALOG_TTL
+        cloudstack = cloud_env(env, self.config)
+        cloudstack.catalog_ttl = CATALOG_TTL
+        return cloudstack
+
+    def dispatch(self, message):
+        '''Handle one decoded request'''
+        oper = message['op']
+        if oper == 'ping':
+            return 'pong'
+        if oper == 'shutdown':
+            threading.Thread(target=self.shutdown).start()
+            return 'bye'
+        if oper == 'client':
+            cloudstack = self.client(message['env'])
+            return {'zone': cloudstack.zone, 'account': cloudstack.account,
+                    'domain': cloudstack.domain}
+        if oper == 'call':
+            if message['method'].startswith('_'):
+                raise ValueError('Private method: {}'.format(message['method']))
+            cloudstack = self.client(message['env'])
+            result = getattr(cloudstack, message['method'])(*message.get('args', []),
+                                                           **message.get('kwargs', {}))
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+            return result
+        if oper == 'ssh':
+            return self.run_ssh(message['host'], message['command'])
+        raise ValueError('Unknown op: {}'.format(oper))
+
+    def node(self, hostip):
+        '''Return a connected ComputeNode, reconnecting dead transports'''
+        from CloudStack.computenode import ComputeNode
+        with self.nodes_lock:
+            node = self.nodes.get(hostip)
+            transport = node and node.ssh.get_transport()
+            if transport is None or not transport.is_active():
+                node = self.nodes[hostip] = ComputeNode(hostip)
+            return node
+
+    def run_ssh(self, hostip, command):
+        '''Run a command on a compute node and collect its output'''
+        _, stdout, stderr = self.node(hostip).ssh.exec_command(command)
+        output = stdout.read().decode('utf-8', 'replace')
+        errors = stderr.read().decode('utf-8', 'replace')
+        return {'exit_status': stdout.channel.recv_exit_status(),
+                'stdout': output, 'stderr': errors}
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        for node in self.nodes.values():
+            node.close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def serve(config, path):
+    '''Run the daemon in the foreground until asked to shut down'''
+    if os.path.exists(path):
+        if available(path):
+            raise RuntimeError('A daemon is already listening on {}'.format(path))
+        os.unlink(path)
+    os.environ[DISABLE_ENV] = '1'
+    old_umask = os.umask(0077)
+    try:
+        server = Daemon(config, path)
+    finally:
+        os.umask(old_umask)
+    logging.info("Listening on %s", path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,139 @@
+'''Time estimates for migrate_node.py moves and scheduling of migration
+batches into maintenance windows.
+A move is modelled as the phases migrate_node.py runs: API jobs take a fixed
+time, local image work (format conversion, archive, extract) runs at disk
+rates for each volume in parallel, and the rsync of every archive shares the
+measured (or assumed) throughput between the two compute nodes. Streamed
+disks skip the local work and move at the slower of the link and conversion.
+    -- phases(disks, imageformat, throughput, destroy) Seconds per phase
+    -- downtime(estimate) Seconds the VM is unavailable
+    -- move_seconds(nbytes, throughput) Estimate for a planned move
+    -- dependencies(moves) Order moves that share a host
+    -- schedule(moves, lanes, window) Pack moves into windows and lanes
+'''
+
+MB = 1024.0 ** 2
+
+# Local image rates (bytes per second) on the compute nodes
+CONVERT_RATE = 150 * MB
+ARCHIVE_RATE = 300 * MB
+# Node to node throughput assumed when none was measured
+DEFAULT_THROUGHPUT = 50 * MB
+
+# Seconds taken by the API jobs and waits of a migration
+STOP_SECONDS = 30
+EXPUNGE_SECONDS = 60
+DEPLOY_SECONDS = 120
+VOLUME_SECONDS = 30
+START_SECONDS = 90
+SSH_SECONDS = 60
+
+
+def phases(disks, imageformat, throughput=DEFAULT_THROUGHPUT, destroy=True):
+    '''Return [(phase, seconds)] for moving disks, a list of dicts with the
+    image 'format' and 'allocated' bytes and optionally 'stream', to a node
+    using imageformat
+    '''
+    streamed = [disk['allocated'] for disk in disks if disk.get('stream')]
+    archived = [disk for disk in disks if not disk.get('stream')]
+    converted = [disk['allocated'] for disk in archived if disk['format'] != imageformat]
+    allocated = [disk['allocated'] for disk in archived]
+    estimate = [('stop vm', STOP_SECONDS)]
+    if converted:
+        estimate.append(('convert', max(converted) / CONVERT_RATE))
+    if allocated:
+        estimate.append(('archive', max(allocated) / ARCHIVE_RATE))
+    estimate.append(('transfer', sum(allocated) / float(throughput) +
+                     sum(streamed) / min(float(throughput), CONVERT_RATE)))
+    if destroy:
+        estimate.append(('destroy old vm', EXPUNGE_SECONDS))
+    else:
+        estimate.append(('restart old vm', START_SECONDS))
+    estimate.append(('deploy new vm', DEPLOY_SECONDS))
+    if len(disks) > 1:
+        estimate.append(('data volumes', VOLUME_SECONDS))
+    if allocated:
+        estimate.append(('extract', max(allocated) / ARCHIVE_RATE))
+    estimate.append(('start new vm', START_SECONDS))
+    estimate.append(('wait for ssh', SSH_SECONDS))
+    return estimate
+
+
+def downtime(estimate):
+    '''Seconds the VM is down: until the old VM restarts when it is kept,
+    otherwise until the new VM answers on ssh
+    '''
+    seconds = 0
+    for phase, duration in estimate:
+        seconds += duration
+        if phase == 'restart old vm':
+            break
+    return seconds
+
+
+def move_seconds(nbytes, throughput=DEFAULT_THROUGHPUT):
+    '''Estimated seconds for a planned move of nbytes without conversion'''
+    disk = {'format': None, 'allocated': nbytes}
+    return sum(duration for _, duration in phases([disk], None, throughput))
+
+
+def duration(seconds):
+    '''Format seconds as 1h02m03s'''
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '%dh%02dm%02ds' % (seconds / 3600, seconds % 3600 / 60, seconds % 60)
+    if seconds >= 60:
+        return '%dm%02ds' % (seconds / 60, seconds % 60)
+    return '%ds' % seconds
+
+
+def dependencies(moves):
+    '''Number each move (in planner order) with an 'id' and list in 'after'
+    the ids of the earlier moves that share its source or destination host.
+    A move into a host must wait for the moves out of it that made room, and
+    two moves touching one host must not run at once.
+    '''
+    hosts = []
+    for num, move in enumerate(moves):
+        touched = set((move['source'], move['destination']))
+        move['id'] = num
+        move['after'] = [dep for dep, other in enumerate(hosts) if other & touched]
+        hosts.append(touched)
+    return moves
+
+
+def schedule(moves, lanes=1, window=None):
+    '''Assign each move (a dict with 'seconds', 'source' and 'destination',
+    in planner order) a 'window' and 'lane' and a 'start' offset within its
+    window, recording its dependencies as in dependencies(). Of the moves
+    whose dependencies are placed, the longest is taken first and put on the
+    lane where it can start soonest (LPT), no earlier than the end of its
+    dependencies; a move that would overrun the window goes to the next one.
+    Returns the moves in execution order.
+    '''
+    dependencies(moves)
+    windows = []
+    # id: (window, end) of each placed move
+    placed = {}
+    pending = sorted(moves, key=lambda move: move['seconds'], reverse=True)
+    while pending:
+        move = next(move for move in pending
+                    if all(dep in placed for dep in move['after']))
+        pending.remove(move)
+        first = max([placed[dep][0] for dep in move['after']] or [0])
+        for num in xrange(first, len(windows) + 1):
+            if num == len(windows):
+                windows.append([0.0] * lanes)
+            ends = windows[num]
+            ready = max([placed[dep][1] for dep in move['after']
+                         if placed[dep][0] == num] or [0.0])
+            lane = min(xrange(lanes), key=lambda idx: max(ends[idx], ready))
+            start = max(ends[lane], ready)
+            if window is None or start + move['seconds'] <= window or not any(ends):
+                break
+        move['window'] = num
+        move['lane'] = lane
+        move['start'] = start
+        ends[lane] = start + move['seconds']
+        placed[move['id']] = (num, ends[lane])
+    return sorted(moves, key=lambda move: (move['window'], move['start'], move['id']))
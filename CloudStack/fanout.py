@@ -0,0 +1,70 @@
+'''Run a query against every configured CloudStack site at once.
+Each site runs in its own thread with a shared deadline, so a fleet-wide
+lookup takes as long as the slowest site rather than the sum of them. Sites
+that fail or miss the deadline are reported alongside the results instead
+of being dropped.
+    -- sites(config) Config sections that describe a CloudStack site
+    -- fanout(config, query, timeout) Return ({site: result}, {site: error})
+    -- merged(results) Yield (site, item) across list results
+'''
+
+import threading
+import time
+
+import CloudStack
+
+REQUIRED = ('apiurl', 'apikey', 'secret', 'zone')
+
+
+def sites(config):
+    '''Return the config sections that hold a complete site definition'''
+    found = []
+    for env in config.sections():
+        if env == 'Global':
+            continue
+        if all(config.has_option(env, opt) and config.get(env, opt) for opt in REQUIRED):
+            found.append(env)
+    return found
+
+
+def fanout(config, query, timeout=60, only=None):
+    '''Call query(cloudstack) for every site (or the sites in only) in
+    parallel. Returns (results, errors) dicts keyed by site; a site still
+    running after timeout seconds is reported as an error.
+    '''
+    results = {}
+    errors = {}
+    lock = threading.Lock()
+
+    def worker(env):
+        '''Run the query for one site'''
+        try:
+            result = query(CloudStack.cloud_env(env, config))
+        except Exception, error:
+            with lock:
+                errors[env] = '{}: {}'.format(type(error).__name__, error)
+            return
+        with lock:
+            results[env] = result
+
+    threads = []
+    for env in only or sites(config):
+        thread = threading.Thread(target=worker, args=(env,), name=env)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    with lock:
+        for thread in threads:
+            if thread.name not in results and thread.name not in errors:
+                errors[thread.name] = 'timed out after {}s'.format(timeout)
+        return dict(results), dict(errors)
+
+
+def merged(results):
+    '''Yield (site, item) for every item of list results, in site order'''
+    for env in sorted(results):
+        for item in results[env] or []:
+            yield env, item
@@ -1,5 +1,8 @@
 '''Build a hostname with defined properties from a FQDN'''
 
+from collections import OrderedDict
+
+
 class HostName(object):
     '''Represents a properly formatted hostname'''
 
@@ -10,6 +13,10 @@ class HostName(object):
     def __init__(self, fqdn):
         self.fqdn = fqdn
         self.name, _, self.domain = self.fqdn.partition('.')
+        # Parsed once, the properties below are read many times
+        self.domain_parts = self.domain.split('.')
+        self._site = None
+        self._env = None
 
     @property
     def vm_name(self):
@@ -20,9 +27,8 @@ class HostName(object):
     def base_name(self):
         '''Host domain base'''
         # ex] example.com, otherexample.net
-        domain_parts = self.domain.split('.')
-        if len(domain_parts) >= 2:
-            return domain_parts[-2]
+        if len(self.domain_parts) >= 2:
+            return self.domain_parts[-2]
         return ''
 
     @property
@@ -34,19 +40,33 @@ class HostName(object):
     @property
     def site(self):
         '''Host site'''
-        domain_parts = self.domain.split('.')
-        if not domain_parts:
-            return ''
-        elif domain_parts[-1] in self.sites:
-            return domain_parts[-1]
-        else:
-            return ''
+        if self._site is None:
+            if self.domain_parts[-1] in self.sites:
+                self._site = self.domain_parts[-1]
+            else:
+                self._site = ''
+        return self._site
 
     @property
     def env(self):
         '''Host environment'''
-        name = self.name[:-3]
-        for env in self.envs:
-            if name.endswith(env):
-                return env
-        return ''
+        if self._env is None:
+            self._env = ''
+            name = self.name[:-3]
+            for env in self.envs:
+                if name.endswith(env):
+                    self._env = env
+                    break
+        return self._env
+
+
+def group_by_env(fqdns):
+    '''Parse many FQDNs in one pass, returning an ordered mapping of
+    CloudStack environment to the HostNames in it. Hosts with no
+    recognisable environment are grouped under ''.
+    '''
+    groups = OrderedDict()
+    for fqdn in fqdns:
+        hostname = HostName(fqdn)
+        groups.setdefault(hostname.cs_env, []).append(hostname)
+    return groups
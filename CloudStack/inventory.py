@@ -0,0 +1,234 @@
+'''Local SQLite mirror of a CloudStack environment's inventory.
+Holds VMs, hosts, volumes, storage pools and offerings for one .cloud.cfg
+section, indexed by name, IP address, host and instance name. A kind is
+listed in full the first time it is synced; later syncs read listEvents since
+the previous sync and only re-list the kinds of object those events touched.
+    -- sync(full, kinds) Refresh the mirror, or some kinds of it, from the API
+    -- fresh(kind, max_age) Check whether a kind was synced recently enough
+    -- ensure_fresh(kind, max_age) Sync just one kind when it is too old
+    -- vms_by_name(name) / vm_by_ip(ip) / vm_by_instance(name) / vms_on_host(id)
+    -- open_inventory(env, config, cloudstack) Open the mirror for a config section
+'''
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# kind: (API command, response key, extra list arguments)
+KINDS = {
+    'vms': ('listVirtualMachines', 'virtualmachine', {}),
+    'hosts': ('listHosts', 'host', {}),
+    'volumes': ('listVolumes', 'volume', {}),
+    'storagepools': ('listStoragePools', 'storagepool', {}),
+    'serviceofferings': ('listServiceOfferings', 'serviceoffering', {}),
+    'diskofferings': ('listDiskOfferings', 'diskoffering', {}),
+}
+
+# Event type prefixes and the kinds they invalidate
+EVENT_KINDS = (
+    ('VM.', ('vms', 'volumes', 'hosts')),
+    ('VOLUME.', ('volumes', 'storagepools', 'hosts')),
+    ('HOST.', ('hosts',)),
+    ('MAINT.', ('hosts',)),
+    ('STORAGE.', ('storagepools',)),
+    ('SERVICE.OFFERING.', ('serviceofferings',)),
+    ('DISK.OFFERING.', ('diskofferings',)),
+)
+
+# Seconds of overlap when asking for events, to cover clock skew with the server
+EVENT_OVERLAP = 300
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT,
+    ipaddress TEXT,
+    hostid TEXT,
+    instancename TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (kind, id)
+);
+CREATE INDEX IF NOT EXISTS objects_name ON objects (kind, name);
+CREATE INDEX IF NOT EXISTS objects_ip ON objects (kind, ipaddress);
+CREATE INDEX IF NOT EXISTS objects_host ON objects (kind, hostid);
+CREATE INDEX IF NOT EXISTS objects_instance ON objects (kind, instancename);
+CREATE TABLE IF NOT EXISTS synced (
+    kind TEXT PRIMARY KEY,
+    at REAL NOT NULL
+);
+'''
+
+
+def _ipaddress(obj):
+    '''Primary IP of an API object (VM nic or host address)'''
+    nics = obj.get('nic')
+    if nics:
+        return nics[0].get('ipaddress')
+    return obj.get('ipaddress')
+
+
+def _utc_offset(created):
+    '''UTC offset in seconds of an API timestamp (2018-06-12T14:20:08-0700)'''
+    match = re.search(r'([+-])(\d{2}):?(\d{2})$', created)
+    if not match:
+        return None
+    offset = int(match.group(2)) * 3600 + int(match.group(3)) * 60
+    return -offset if match.group(1) == '-' else offset
+
+
+class Inventory(object):
+    '''SQLite inventory store for one CloudStack environment'''
+
+    def __init__(self, cloudstack, path):
+        self.cloudstack = cloudstack
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.offset = None
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def synced(self, kind):
+        '''Time a kind was last synced, or None'''
+        with self.lock:
+            row = self.db.execute('SELECT at FROM synced WHERE kind = ?', (kind,)).fetchone()
+        return row and row[0]
+
+    def fresh(self, kind, max_age):
+        '''True if the kind was synced within max_age seconds'''
+        synced = self.synced(kind)
+        return synced is not None and time.time() - synced <= max_age
+
+    def load(self, kind):
+        '''Replace every object of a kind with a fresh API listing'''
+        command, key, extra = KINDS[kind]
+        started = time.time()
+        objects = self.cloudstack.list_all(command, key, listall='true', **extra)
+        rows = [(kind, obj['id'], obj.get('name'), _ipaddress(obj), obj.get('hostid'),
+                 obj.get('instancename'), json.dumps(obj)) for obj in objects]
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM objects WHERE kind = ?', (kind,))
+                self.db.executemany('INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                self.db.execute('INSERT OR REPLACE INTO synced VALUES (?, ?)', (kind, started))
+        return len(rows)
+
+    def server_offset(self):
+        '''Seconds east of UTC of the management server's clock, read from
+        the timestamp of an event; listEvents takes startdate in that zone
+        '''
+        if self.offset is None:
+            events = self.cloudstack.listEvents(listall='true', page=1,
+                                                pagesize=1).get('event', [])
+            self.offset = _utc_offset(events[0].get('created', '')) if events else None
+            if self.offset is None:
+                logging.debug("No event timestamps, assuming the server uses local time")
+                self.offset = -(time.altzone if time.localtime().tm_isdst else time.timezone)
+        return self.offset
+
+    def changed_kinds(self, since):
+        '''Kinds touched by events since the given time'''
+        startdate = time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.gmtime(since - EVENT_OVERLAP + self.server_offset()))
+        events = self.cloudstack.list_all('listEvents', 'event', listall='true',
+                                          startdate=startdate)
+        kinds = set()
+        for event in events:
+            for prefix, touched in EVENT_KINDS:
+                if event.get('type', '').startswith(prefix):
+                    kinds.update(touched)
+        return kinds
+
+    def sync(self, full=False, kinds=None):
+        '''Full listing of kinds never synced (or all of them with full=True),
+        then an event-driven refresh of the rest. kinds limits the sync to
+        some kinds (default: all of them). Returns the kinds reloaded.
+        '''
+        kinds = sorted(kinds or KINDS)
+        synced = dict((kind, self.synced(kind)) for kind in kinds)
+        if full:
+            reload_kinds = set(kinds)
+        else:
+            reload_kinds = set(kind for kind in kinds if synced[kind] is None)
+            known = [at for kind, at in synced.items() if at is not None]
+            if known:
+                now = time.time()
+                reload_kinds.update(kind for kind in self.changed_kinds(min(known))
+                                    if kind in synced)
+                # Nothing changed: just move the sync marks forward
+                with self.lock:
+                    with self.db:
+                        self.db.executemany('UPDATE synced SET at = ? WHERE kind = ?',
+                                            [(now, kind) for kind in kinds
+                                             if kind not in reload_kinds])
+        for kind in sorted(reload_kinds):
+            logging.debug("Inventory reloaded %d %s", self.load(kind), kind)
+        return reload_kinds
+
+    def ensure_fresh(self, kind, max_age):
+        '''Sync the kind alone if it is older than max_age, serving stale data
+        on API errors
+        '''
+        if self.fresh(kind, max_age):
+            return
+        try:
+            self.sync(kinds=[kind])
+        except Exception, error:
+            if self.synced(kind) is None:
+                raise
+            logging.warn("Inventory refresh failed, using data from %s: %s",
+                         time.ctime(self.synced(kind)), error)
+
+    def find(self, kind, column, value):
+        '''Return decoded objects of a kind where an indexed column matches'''
+        if column not in ('id', 'name', 'ipaddress', 'hostid', 'instancename'):
+            raise ValueError('Not an indexed column: {}'.format(column))
+        with self.lock:
+            rows = self.db.execute('SELECT data FROM objects WHERE kind = ? AND %s = ?' % column,
+                                   (kind, value)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def all(self, kind):
+        '''Return every decoded object of a kind'''
+        with self.lock:
+            rows = self.db.execute('SELECT data FROM objects WHERE kind = ?',
+                                   (kind,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def vms_by_name(self, name):
+        '''VMs with the given short name'''
+        return self.find('vms', 'name', name)
+
+    def vm_by_ip(self, ipaddress):
+        '''VM whose primary NIC has the given IP, or None'''
+        vms = self.find('vms', 'ipaddress', ipaddress)
+        return vms[0] if vms else None
+
+    def vm_by_instance(self, instancename):
+        '''VM with the given libvirt instance name, or None'''
+        vms = self.find('vms', 'instancename', instancename)
+        return vms[0] if vms else None
+
+    def vms_on_host(self, hostid):
+        '''VMs running on a compute node'''
+        return self.find('vms', 'hostid', hostid)
+
+    def close(self):
+        '''Close the database'''
+        self.db.close()
+
+
+def open_inventory(env, config, cloudstack):
+    '''Open the local inventory mirror for a config section'''
+    directory = '~/.cloud_inventory'
+    if config.has_option('Global', 'InventoryDir'):
+        directory = config.get('Global', 'InventoryDir')
+    path = os.path.join(os.path.expanduser(directory), env + '.db')
+    return Inventory(cloudstack, path)
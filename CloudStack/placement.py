@@ -0,0 +1,130 @@
+'''Capacity-aware placement of new VMs onto compute nodes.
+A Placer takes a single snapshot of the zone's hosts (CPU and memory
+allocation) and their local storage pools, then scores every host for a
+service offering in one pass over column lists. Each placement is committed
+back into the model so a batch of builds spreads across the zone without
+re-querying the API.
+    -- place(offering, disk, affinitygroup) Pick and reserve the best host
+'''
+
+# Weight applied to the gap between CPU and memory utilization; higher values
+# favour hosts whose resources fill evenly over the tightest fit.
+BALANCE_WEIGHT = 0.5
+
+
+def _percent(value):
+    '''Convert an API percentage string ("42.5%") to a fraction'''
+    try:
+        return float(str(value).rstrip('%')) / 100.0
+    except ValueError:
+        return 0.0
+
+
+class Placer(object):
+    '''Snapshot of compute node capacity for a zone, used to choose hosts'''
+
+    def __init__(self, cloudstack, zoneid):
+        self.cloudstack = cloudstack
+        self.zoneid = zoneid
+        self.hosts = []
+        self.cpu_total = []
+        self.cpu_used = []
+        self.mem_total = []
+        self.mem_used = []
+        self.disk_total = []
+        self.disk_used = []
+        self.groups = {}
+        self.snapshot()
+
+    def snapshot(self):
+        '''Load host and local storage allocation in two listings'''
+        hosts = self.cloudstack.list_cached('hosts', listall='true', zoneid=self.zoneid,
+                                            type='Routing')
+        pools = self.cloudstack.list_cached('storagepools', listall='true',
+                                            zoneid=self.zoneid)
+        local = {}
+        for pool in pools:
+            if pool.get('scope') == 'HOST':
+                local[pool['ipaddress']] = pool
+        del self.hosts[:]
+        for column in (self.cpu_total, self.cpu_used, self.mem_total,
+                       self.mem_used, self.disk_total, self.disk_used):
+            del column[:]
+        for host in hosts:
+            if host.get('state') != 'Up' or host.get('resourcestate') != 'Enabled':
+                continue
+            cpu_total = float(host.get('cpuwithoverprovisioning') or
+                              host['cpunumber'] * host['cpuspeed'])
+            mem_total = float(host.get('memorywithoverprovisioning') or
+                              host['memorytotal'])
+            pool = local.get(host['ipaddress'], {})
+            self.hosts.append(host)
+            self.cpu_total.append(cpu_total)
+            self.cpu_used.append(cpu_total * _percent(host.get('cpuallocated', 0)))
+            self.mem_total.append(mem_total)
+            self.mem_used.append(float(host.get('memoryallocated', 0)))
+            self.disk_total.append(float(pool.get('disksizetotal', 0)))
+            self.disk_used.append(float(pool.get('disksizeallocated', 0)))
+
+    def group_hosts(self, groupname):
+        '''Return (type, set of host IDs) already used by an affinity group'''
+        if groupname in self.groups:
+            return self.groups[groupname]
+        # Groups created by provision.assign_affinity are anti-affinity
+        grouptype, hostids = 'host anti-affinity', set()
+        groups = self.cloudstack.listAffinityGroups(listall='true',
+                                                    name=groupname).get('affinitygroup', [])
+        if groups:
+            group = groups[0]
+            grouptype = group['type']
+            if group.get('virtualmachineIds'):
+                vms = self.cloudstack.list_records('vms', listall='true',
+                                                   affinitygroupid=group['id'])
+                hostids = set(vm['hostid'] for vm in vms if vm.get('hostid'))
+        self.groups[groupname] = (grouptype, hostids)
+        return self.groups[groupname]
+
+    def score(self, offering, disk=0, affinitygroup=None):
+        '''Score every host for the offering, returning (score, index) pairs
+        for hosts with room. Higher scores are denser, more even fits.
+        '''
+        cpu = float(offering['cpunumber'] * offering['cpuspeed'])
+        mem = float(offering['memory']) * 1024 * 1024
+        if offering.get('storagetype') != 'local':
+            disk = 0
+        grouptype, grouphosts = None, set()
+        if affinitygroup:
+            grouptype, grouphosts = self.group_hosts(affinitygroup)
+        scores = []
+        for idx, host in enumerate(self.hosts):
+            if grouptype == 'host anti-affinity' and host['id'] in grouphosts:
+                continue
+            if grouptype == 'host affinity' and grouphosts and host['id'] not in grouphosts:
+                continue
+            cpu_free = self.cpu_total[idx] - self.cpu_used[idx]
+            mem_free = self.mem_total[idx] - self.mem_used[idx]
+            disk_free = self.disk_total[idx] - self.disk_used[idx]
+            if cpu > cpu_free or mem > mem_free or (disk and disk > disk_free):
+                continue
+            cpu_util = (self.cpu_used[idx] + cpu) / self.cpu_total[idx]
+            mem_util = (self.mem_used[idx] + mem) / self.mem_total[idx]
+            scores.append((cpu_util + mem_util - BALANCE_WEIGHT * abs(cpu_util - mem_util),
+                           idx))
+        return scores
+
+    def place(self, offering, disk=0, affinitygroup=None):
+        '''Choose a host for the offering and reserve its resources in the
+        model. Returns the host dict, or None if nothing fits.
+        '''
+        scores = self.score(offering, disk, affinitygroup)
+        if not scores:
+            return None
+        _, idx = max(scores)
+        self.cpu_used[idx] += offering['cpunumber'] * offering['cpuspeed']
+        self.mem_used[idx] += float(offering['memory']) * 1024 * 1024
+        if offering.get('storagetype') == 'local':
+            self.disk_used[idx] += disk
+        host = self.hosts[idx]
+        if affinitygroup:
+            self.group_hosts(affinitygroup)[1].add(host['id'])
+        return host
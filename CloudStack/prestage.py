@@ -0,0 +1,172 @@
+'''Copy a template onto compute nodes' primary storage ahead of bulk builds.
+A host is warmed by deploying a small throwaway VM from the template onto it
+and expunging the VM once it has started, which leaves the template copy in
+the host's storage pool. Warms run in parallel, with the start of each copy
+held back by a token bucket on template bytes so secondary storage is not
+saturated. A deploy that fails part way has its VM expunged as well.
+Hosts running a VM from the template hold a copy and are skipped, as are hosts
+recorded in the state file as warmed within the last STAGED_MAX_AGE seconds.
+The record can go stale: primary storage cleanup (storage.cleanup.enabled)
+removes template copies no VM uses, so a host warmed but left idle past the
+cleanup interval is cold again and the age limit should not exceed it.
+    -- target_hosts(cloudstack, zoneid, pattern) Enabled compute nodes to warm
+    -- warm_hosts(cloudstack, zoneid, templateid, path, max_age) Host IDs
+       holding the template
+    -- record_staged(path, templateid, hostid) Note a warmed host in the state
+       file
+    -- prestage(cloudstack, request, hosts, nbytes, bandwidth, workers) Warm
+       hosts in parallel, yielding each outcome
+'''
+
+import fnmatch
+import json
+import os
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from CloudStack.ratelimit import TokenBucket
+
+# Seconds between job status polls
+POLL_INTERVAL = 5
+# Concurrent warms
+WORKERS = 4
+# Seconds a host recorded as warmed is trusted to still hold the copy; keep
+# below the management server's storage.cleanup.interval (default one day)
+STAGED_MAX_AGE = 12 * 3600
+
+
+def target_hosts(cloudstack, zoneid, pattern=None):
+    '''Return the enabled, up compute nodes of a zone, optionally only
+    those whose name matches a shell pattern
+    '''
+    hosts = []
+    for host in cloudstack.list_cached('hosts', listall='true', zoneid=zoneid,
+                                       type='Routing'):
+        if host['state'] != 'Up' or host['resourcestate'] != 'Enabled':
+            continue
+        if pattern and not fnmatch.fnmatchcase(host['name'], pattern):
+            continue
+        hosts.append(host)
+    return sorted(hosts, key=lambda host: host['name'])
+
+
+def staged_path(env, config):
+    '''State file recording the hosts warmed in a config section'''
+    directory = '~/.cloud_prestage'
+    if config.has_option('Global', 'PrestageDir'):
+        directory = config.get('Global', 'PrestageDir')
+    return os.path.join(os.path.expanduser(directory), env + '.json')
+
+
+def read_staged(path):
+    '''Return {templateid: {hostid: time warmed}} from a state file'''
+    try:
+        with open(path) as statefile:
+            return json.load(statefile)
+    except (IOError, ValueError):
+        return {}
+
+
+def record_staged(path, templateid, hostid):
+    '''Record that a host was warmed with the template just now'''
+    state = read_staged(path)
+    state.setdefault(templateid, {})[hostid] = int(time.time())
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'w') as statefile:
+        json.dump(state, statefile, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def warm_hosts(cloudstack, zoneid, templateid, path=None, max_age=STAGED_MAX_AGE):
+    '''Return the IDs of hosts running a VM deployed from the template, plus
+    those recorded in the state file at path as warmed within max_age seconds
+    '''
+    warm = set(virtm['hostid'] for virtm in
+               cloudstack.list_records('vms', listall='true', zoneid=zoneid,
+                                       templateid=templateid)
+               if virtm.get('hostid'))
+    if path:
+        now = time.time()
+        warm.update(hostid for hostid, warmed in
+                    read_staged(path).get(templateid, {}).items()
+                    if now - warmed <= max_age)
+    return warm
+
+
+def smallest_offering(cloudstack):
+    '''Return the local storage service offering with the least memory and
+    CPU, so the throwaway VM's root disk lands in the host's own pool
+    '''
+    offerings = cloudstack.list_cached('serviceofferings')
+    local = [off for off in offerings if off.get('storagetype') == 'local']
+    return min(local or offerings, key=lambda off: (off['memory'], off['cpunumber']))
+
+
+def wait(cloudstack, jobid):
+    '''Poll a job quietly, returning (jobresult, errortext)'''
+    while True:
+        jobquery = cloudstack.queryAsyncJobResult(jobid=jobid)
+        if jobquery['jobstatus'] != 0:
+            result = jobquery.get('jobresult', {})
+            return result, result.get('errortext') if result.get('errorcode') else None
+        time.sleep(POLL_INTERVAL)
+
+
+def discard(cloudstack, name):
+    '''Expunge the VM left behind by a failed warm, if any, returning an
+    error text when it could not be removed
+    '''
+    try:
+        for virtm in cloudstack.list_records('vms', listall='true', name=name):
+            if virtm['name'] != name:
+                continue
+            _, error = wait(cloudstack, cloudstack.destroyVirtualMachine(id=virtm['id'],
+                                                                         expunge='true')['jobid'])
+            if error:
+                return error
+    except Exception, error:
+        return '{}: {}'.format(type(error).__name__, error)
+    return None
+
+
+def warm(cloudstack, request, host, bucket, nbytes):
+    '''Warm one host, returning (host, seconds, error)'''
+    bucket.take(nbytes)
+    started = time.time()
+    req = dict(request, hostid=host['id'],
+               name='prestage-%s' % uuid.uuid4().hex[:8])
+    try:
+        result, error = wait(cloudstack, cloudstack.deployVirtualMachine(**req)['jobid'])
+        if not error:
+            vmid = result['virtualmachine']['id']
+            _, error = wait(cloudstack, cloudstack.destroyVirtualMachine(id=vmid,
+                                                                         expunge='true')['jobid'])
+            if error:
+                error = 'warmed, but could not expunge %s: %s' % (req['name'], error)
+            return host, time.time() - started, error
+    except Exception, error:
+        error = '{}: {}'.format(type(error).__name__, error)
+    # The deploy can fail after the VM record exists (e.g. while starting it)
+    leftover = discard(cloudstack, req['name'])
+    if leftover:
+        error = '%s; could not expunge %s: %s' % (error, req['name'], leftover)
+    return host, time.time() - started, error
+
+
+def prestage(cloudstack, request, hosts, nbytes, bandwidth, workers=WORKERS):
+    '''Warm every host with deploy request (template, offering, network and
+    ownership filled in), starting at most bandwidth bytes per second of
+    template copies. Yields (host, seconds, error) as each host finishes.
+    '''
+    if not hosts:
+        return
+    bucket = TokenBucket(bandwidth, nbytes)
+    pool = ThreadPool(max(1, min(workers, len(hosts))))
+    try:
+        for outcome in pool.imap_unordered(
+                lambda host: warm(cloudstack, request, host, bucket, nbytes), hosts):
+            yield outcome
+    finally:
+        pool.close()
@@ -0,0 +1,176 @@
+'''Client-side rate limiting and retry for management server API calls.
+Every endpoint gets one Limiter shared by all clients in the process: a token
+bucket caps the request rate, and the number of requests in flight follows
+AIMD, growing by roughly one per window of successful calls and halving,
+at most once per window, on throttling (429), gateway errors (502-504),
+connection errors or a latency spike against the best recent latency of the
+same command. Only those are retried, for idempotent list*/query* commands,
+with full jitter backoff; CloudStack's own errors (530 internal or not found,
+531 permission denied, 533-535 capacity) are answers, not congestion.
+    -- limiter_for(endpoint) The shared Limiter for an endpoint
+    -- call(limiter, func, idempotent, retries, command) Run one API call under
+       the limiter
+    -- TokenBucket(rate, burst) Plain token bucket, e.g. for bytes per second
+'''
+
+import random
+import re
+import socket
+import threading
+import time
+
+# Requests per second and burst size of each endpoint's token bucket
+RATE = 20.0
+BURST = 40
+# Bounds for concurrent requests in flight per endpoint
+INITIAL_CONCURRENCY = 4
+MAX_CONCURRENCY = 32
+# Latency above this multiple of the best recent latency of the same command
+# counts as congestion
+LATENCY_FACTOR = 3.0
+# Multiplicative decrease on congestion or errors
+DECREASE = 0.5
+# HTTP statuses that mean the server or a proxy in front of it is overloaded
+TRANSIENT_CODES = (429, 502, 503, 504)
+# Retry backoff (seconds): uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+RETRIES = 4
+BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+class Limiter(object):
+    '''Token bucket plus AIMD concurrency window for one endpoint'''
+
+    def __init__(self, rate=RATE, burst=BURST, max_concurrency=MAX_CONCURRENCY):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(INITIAL_CONCURRENCY, max_concurrency))
+        self.active = 0
+        # Best recent latency of each command, as listings of thousands of
+        # records take far longer than job polls on a healthy server
+        self.best = {}
+        # When the window was last cut; only requests sent after it can cut
+        # it again, so a burst of failures halves it once
+        self.cut = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        '''Block until a request may be sent'''
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+            while True:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.cond.wait((1 - self.tokens) / self.rate)
+
+    def release(self, latency, congested=False, command=None):
+        '''Record a finished request and adjust the concurrency window. A
+        latency of None (a request that failed for its own reasons) leaves
+        the window alone.
+        '''
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+            if latency is None:
+                return
+            now = time.time()
+            if not congested:
+                # Let the baseline drift up so a lasting change is not penalized forever
+                best = self.best.get(command)
+                best = self.best[command] = latency if best is None else min(latency, best * 1.05)
+                congested = latency > LATENCY_FACTOR * best
+            if congested:
+                if now - latency >= self.cut:
+                    self.limit = max(1.0, self.limit * DECREASE)
+                    self.cut = now
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+
+
+class TokenBucket(object):
+    '''Thread-safe token bucket refilled at rate tokens per second'''
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, amount):
+        '''Block until amount tokens are available and take them. Amounts
+        above the burst size are allowed and leave the bucket in debt.
+        '''
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= min(amount, self.burst):
+                    self.tokens -= amount
+                    return
+                wait = (min(amount, self.burst) - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def limiter_for(endpoint):
+    '''Return the process-wide Limiter for an API endpoint'''
+    with _LIMITERS_LOCK:
+        if endpoint not in _LIMITERS:
+            _LIMITERS[endpoint] = Limiter()
+        return _LIMITERS[endpoint]
+
+
+def status_code(error):
+    '''HTTP status of an API error, if it carries one'''
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None):
+        return response.status_code
+    match = re.search(r'HTTP (\d{3})', str(error))
+    return int(match.group(1)) if match else None
+
+
+def transient(error):
+    '''True for throttling, gateway and connection errors'''
+    code = status_code(error)
+    if code is not None:
+        return code in TRANSIENT_CODES
+    return isinstance(error, (socket.error, IOError))
+
+
+def call(limiter, func, idempotent, retries=RETRIES, command=None):
+    '''Run func() under the limiter, retrying transient failures of
+    idempotent calls with jittered exponential backoff. Latency is judged
+    against earlier calls of the same command.
+    '''
+    attempt = 0
+    while True:
+        limiter.acquire()
+        started = time.time()
+        try:
+            result = func()
+        except Exception, error:
+            congested = transient(error)
+            limiter.release(time.time() - started if congested else None, congested, command)
+            if not (idempotent and congested) or attempt >= retries:
+                raise
+            attempt += 1
+            time.sleep(random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt)))
+            continue
+        limiter.release(time.time() - started, command=command)
+        return result
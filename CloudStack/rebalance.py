@@ -0,0 +1,163 @@
+'''Plan VM migrations that bring compute nodes under a target utilization.
+Host capacity comes from a placement snapshot (CPU, memory, local storage);
+each VM is costed by the allocated bytes of its local volumes, which is what
+migrate_node actually copies. The planner is a greedy bin-packing heuristic:
+the most overloaded host sheds first, preferring the cheapest single VM that
+clears its excess, otherwise the VM with the most relief per byte moved, and
+each VM lands on the best-fitting host that stays under target.
+    -- Planner(cloudstack, zoneid).plan(target) Return a list of moves
+    -- write_plan(filename, ...) / read_plan(filename) Plan file I/O
+'''
+
+import json
+import logging
+import time
+
+from CloudStack.placement import Placer
+
+
+def volume_bytes(volume):
+    '''Bytes a volume occupies on disk, falling back to its virtual size'''
+    physical = volume.get('physicalsize')
+    if physical is None:
+        return int(volume.get('size', 0))
+    return int(physical)
+
+
+class Planner(object):
+    '''Host and VM model of a zone for rebalance planning'''
+
+    def __init__(self, cloudstack, zoneid):
+        self.placer = Placer(cloudstack, zoneid)
+        self.index = dict((host['id'], idx) for idx, host in enumerate(self.placer.hosts))
+        # Per VM columns: host index, cpu, memory, virtual disk, bytes to move
+        self.vms = []
+        self.vm_host = []
+        self.vm_cpu = []
+        self.vm_mem = []
+        self.vm_disk = []
+        self.vm_bytes = []
+        disk, moved = {}, {}
+        estimated = 0
+        for volume in cloudstack.list_records('volumes', listall='true', zoneid=zoneid):
+            vmid = volume.get('virtualmachineid')
+            if not vmid or volume.get('storagetype') != 'local':
+                continue
+            if volume.get('physicalsize') is None:
+                estimated += 1
+            disk[vmid] = disk.get(vmid, 0) + int(volume.get('size', 0))
+            moved[vmid] = moved.get(vmid, 0) + volume_bytes(volume)
+        if estimated:
+            logging.warn("%d volumes report no physical size, using virtual size", estimated)
+        for virtm in cloudstack.list_records('vms', listall='true', zoneid=zoneid):
+            idx = self.index.get(virtm.get('hostid'))
+            if idx is None or virtm.get('state') != 'Running':
+                continue
+            self.vms.append(virtm)
+            self.vm_host.append(idx)
+            self.vm_cpu.append(float(virtm['cpunumber'] * virtm['cpuspeed']))
+            self.vm_mem.append(float(virtm['memory']) * 1024 * 1024)
+            self.vm_disk.append(float(disk.get(virtm['id'], 0)))
+            self.vm_bytes.append(moved.get(virtm['id'], 0))
+
+    def utilization(self, idx, cpu=0.0, mem=0.0, disk=0.0):
+        '''Dominant utilization of a host after adding the given resources'''
+        placer = self.placer
+        utils = [(placer.cpu_used[idx] + cpu) / placer.cpu_total[idx],
+                 (placer.mem_used[idx] + mem) / placer.mem_total[idx]]
+        if placer.disk_total[idx]:
+            utils.append((placer.disk_used[idx] + disk) / placer.disk_total[idx])
+        return max(utils)
+
+    def destination(self, vmi, target):
+        '''Best-fit host for a VM that stays under target, or None'''
+        best = None
+        for idx in xrange(len(self.placer.hosts)):
+            if idx == self.vm_host[vmi]:
+                continue
+            util = self.utilization(idx, self.vm_cpu[vmi], self.vm_mem[vmi], self.vm_disk[vmi])
+            if util <= target and (best is None or util > best[0]):
+                best = (util, idx)
+        return best and best[1]
+
+    def move(self, vmi, dest):
+        '''Apply a move to the model'''
+        placer = self.placer
+        src = self.vm_host[vmi]
+        for used, amount in ((placer.cpu_used, self.vm_cpu[vmi]),
+                             (placer.mem_used, self.vm_mem[vmi]),
+                             (placer.disk_used, self.vm_disk[vmi])):
+            used[src] -= amount
+            used[dest] += amount
+        self.vm_host[vmi] = dest
+
+    def plan(self, target):
+        '''Return the list of moves needed to bring hosts under target'''
+        hosts = self.placer.hosts
+        resident = dict((idx, []) for idx in xrange(len(hosts)))
+        for vmi, idx in enumerate(self.vm_host):
+            resident[idx].append(vmi)
+        moves = []
+        over = sorted((idx for idx in resident if self.utilization(idx) > target),
+                      key=self.utilization, reverse=True)
+        for src in over:
+            stuck = set()
+            while self.utilization(src) > target:
+                candidates = []
+                for vmi in resident[src]:
+                    if vmi in stuck:
+                        continue
+                    after = self.utilization(src, -self.vm_cpu[vmi], -self.vm_mem[vmi],
+                                             -self.vm_disk[vmi])
+                    relief = self.utilization(src) - after
+                    if relief <= 0:
+                        continue
+                    clears = after <= target
+                    # Clearing moves rank first by fewest bytes, others by bytes per relief
+                    cost = self.vm_bytes[vmi] if clears else self.vm_bytes[vmi] / relief
+                    candidates.append((not clears, cost, vmi))
+                if not candidates:
+                    logging.warn("Unable to bring %s under target", hosts[src]['name'])
+                    break
+                candidates.sort()
+                placed = False
+                for _, _, vmi in candidates:
+                    dest = self.destination(vmi, target)
+                    if dest is None:
+                        stuck.add(vmi)
+                        continue
+                    self.move(vmi, dest)
+                    resident[src].remove(vmi)
+                    resident[dest].append(vmi)
+                    virtm = self.vms[vmi]
+                    moves.append({'vm': virtm['name'],
+                                  'vmid': virtm['id'],
+                                  'instancename': virtm.get('instancename'),
+                                  'source': hosts[src]['name'],
+                                  'destination': hosts[dest]['name'],
+                                  'bytes': self.vm_bytes[vmi]})
+                    placed = True
+                    break
+                if not placed:
+                    logging.warn("No destination has room for load on %s", hosts[src]['name'])
+                    break
+        return moves
+
+
+def write_plan(filename, env, zone, target, moves):
+    '''Write a migration plan to a JSON file'''
+    plan = {'env': env,
+            'zone': zone,
+            'target': target,
+            'created': int(time.time()),
+            'bytes': sum(move['bytes'] for move in moves),
+            'moves': moves}
+    with open(filename, 'w') as planfile:
+        json.dump(plan, planfile, indent=2, sort_keys=True)
+    return plan
+
+
+def read_plan(filename):
+    '''Load a migration plan written by write_plan'''
+    with open(filename) as planfile:
+        return json.load(planfile)
@@ -0,0 +1,198 @@
+'''Compact records for large API listings.
+Each record type keeps only the fields these scripts use, in __slots__, so a
+listing of tens of thousands of objects holds no per-object dicts. Records
+still read like the API dicts (record['name'], record.get('hostid')); a field
+outside the kept set is served from the full payload, fetched from the API by
+ID the first time it is needed, unless the record was decoded with it.
+    -- VM, Host, Volume, StoragePool Record types
+    -- decode(kind, objects, client, full) Turn API dicts into records
+    -- load(data, client) Rebuild a record sent as Record.dump()
+'''
+
+
+# Values of the SHARED fields seen so far, so each distinct zone, domain,
+# host or offering name or ID is held once however many records refer to it
+_VALUES = {}
+
+
+def _compact(value, shared=False):
+    '''Store ASCII text as a byte string, a quarter of the size of unicode on
+    wide builds, and reuse an equal value already held for shared fields
+    '''
+    if isinstance(value, unicode):
+        try:
+            value = value.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    if shared and isinstance(value, basestring):
+        value = _VALUES.setdefault(value, value)
+    return value
+
+
+class Record(object):
+    '''Base for compact API records'''
+
+    __slots__ = ('_client', '_raw')
+    FIELDS = ()
+    # Fields with few distinct values across a listing
+    SHARED = ()
+    # Key in KINDS, for records sent whole between processes
+    KIND = None
+    # (list command, response key) used to fetch the full payload
+    SOURCE = (None, None)
+
+    def __init__(self, obj, client=None, full=False):
+        self._client = client
+        self._raw = obj if full else None
+        for field in self.FIELDS:
+            setattr(self, field, _compact(obj.get(field), field in self.SHARED))
+
+    @property
+    def raw(self):
+        '''The full API payload, fetched by ID on first use'''
+        if self._raw is None:
+            if self._client is None:
+                raise KeyError('No client to fetch the full record for {}'.format(self.id))
+            command, key = self.SOURCE
+            found = getattr(self._client, command)(listall='true', id=self.id).get(key, [])
+            self._raw = found[0] if found else {}
+        return self._raw
+
+    def __getitem__(self, field):
+        if field in self.FIELDS:
+            return getattr(self, field)
+        return self.raw[field]
+
+    def __setitem__(self, field, value):
+        if field in self.FIELDS:
+            setattr(self, field, value)
+        else:
+            self.raw[field] = value
+
+    def __contains__(self, field):
+        return field in self.FIELDS or field in self.raw
+
+    def get(self, field, default=None):
+        '''dict.get() over the kept fields, then the full payload'''
+        if field in self.FIELDS:
+            value = getattr(self, field)
+            return default if value is None else value
+        try:
+            return self.raw.get(field, default)
+        except KeyError:
+            return default
+
+    def as_dict(self):
+        '''The kept fields as a plain dict'''
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def dump(self):
+        '''The record as a JSON-ready dict, including the full payload if it
+        was fetched, for load() to rebuild it as it was
+        '''
+        return {'__record__': self.KIND, 'fields': self.as_dict(), 'raw': self._raw}
+
+    def __repr__(self):
+        return '<{} {} {}>'.format(type(self).__name__, self.id, getattr(self, 'name', ''))
+
+
+class Nic(Record):
+    '''A VM network interface'''
+
+    FIELDS = ('id', 'ipaddress', 'networkid', 'macaddress', 'isdefault')
+    __slots__ = FIELDS
+    SHARED = ('networkid', 'isdefault')
+
+
+class VM(Record):
+    '''A virtual machine'''
+
+    FIELDS = ('id', 'name', 'displayname', 'instancename', 'state', 'hostid', 'hostname',
+              'zoneid', 'zonename', 'domainid', 'domain', 'account', 'cpunumber', 'cpuspeed',
+              'memory', 'serviceofferingid', 'serviceofferingname', 'templateid',
+              'templatename', 'nic')
+    # NICs are held as plain tuples of values, which the garbage collector
+    # stops tracking, and handed out as Nic records
+    __slots__ = tuple(field for field in FIELDS if field != 'nic') + ('_nics',)
+    SHARED = ('state', 'hostid', 'hostname', 'zoneid', 'zonename', 'domainid', 'domain',
+              'account', 'serviceofferingid', 'serviceofferingname', 'templateid',
+              'templatename')
+    KIND = 'vms'
+    SOURCE = ('listVirtualMachines', 'virtualmachine')
+
+    @property
+    def nic(self):
+        '''The network interfaces, as Nic records'''
+        return tuple(Nic(dict(zip(Nic.FIELDS, values))) for values in self._nics)
+
+    @nic.setter
+    def nic(self, nics):
+        self._nics = tuple(tuple(_compact(nic.get(field), field in Nic.SHARED)
+                                 for field in Nic.FIELDS) for nic in nics or ())
+
+    def as_dict(self):
+        record = super(VM, self).as_dict()
+        record['nic'] = [nic.as_dict() for nic in self.nic]
+        return record
+
+
+class Host(Record):
+    '''A compute node'''
+
+    FIELDS = ('id', 'name', 'ipaddress', 'state', 'resourcestate', 'type', 'version',
+              'zoneid', 'hosttags', 'cpunumber', 'cpuspeed', 'cpuallocated',
+              'cpuwithoverprovisioning', 'memorytotal', 'memoryallocated',
+              'memorywithoverprovisioning')
+    __slots__ = FIELDS
+    SHARED = ('state', 'resourcestate', 'type', 'version', 'zoneid', 'hosttags')
+    KIND = 'hosts'
+    SOURCE = ('listHosts', 'host')
+
+
+class Volume(Record):
+    '''A disk volume'''
+
+    FIELDS = ('id', 'name', 'type', 'size', 'physicalsize', 'path', 'storageid', 'storage',
+              'storagetype', 'virtualmachineid', 'deviceid', 'zoneid', 'diskofferingid')
+    __slots__ = FIELDS
+    SHARED = ('type', 'storageid', 'storage', 'storagetype', 'zoneid', 'diskofferingid')
+    KIND = 'volumes'
+    SOURCE = ('listVolumes', 'volume')
+
+
+class StoragePool(Record):
+    '''A primary storage pool'''
+
+    FIELDS = ('id', 'name', 'ipaddress', 'scope', 'tags', 'zoneid', 'disksizetotal',
+              'disksizeallocated', 'disksizeused')
+    __slots__ = FIELDS
+    SHARED = ('scope', 'zoneid')
+    KIND = 'storagepools'
+    SOURCE = ('listStoragePools', 'storagepool')
+
+
+# kind: (record type, list command, response key)
+KINDS = {
+    'vms': (VM, 'listVirtualMachines', 'virtualmachine'),
+    'hosts': (Host, 'listHosts', 'host'),
+    'volumes': (Volume, 'listVolumes', 'volume'),
+    'storagepools': (StoragePool, 'listStoragePools', 'storagepool'),
+}
+
+
+def decode(kind, objects, client=None, full=False):
+    '''Yield records of a kind for an iterable of API dicts. With full, each
+    record keeps its dict as the full payload instead of fetching it.
+    '''
+    record = KINDS[kind][0]
+    for obj in objects:
+        yield record(obj, client, full)
+
+
+def load(data, client=None):
+    '''Rebuild a record from Record.dump(), fetching any payload it lacks
+    through client
+    '''
+    record = KINDS[data['__record__']][0](data['fields'], client)
+    record._raw = data['raw']
+    return record
@@ -0,0 +1,81 @@
+'''Per compute node storage report for a zone.
+Built from one host listing, one storage pool listing and one paged volume
+listing, joined in memory: volumes to pools by storage ID (or pool name),
+pools to hosts by IP address. Real filesystem usage can optionally be read
+from every node over SSH in parallel.
+    -- storage_report(cloudstack, zoneid) Allocated vs. used vs. capacity per host
+    -- add_disk_usage(rows, workers) Fill in on-disk usage and the hypervisor's
+       own domain and image figures over SSH
+'''
+
+import logging
+from multiprocessing.pool import ThreadPool
+
+from CloudStack.computenode import ComputeNode
+
+
+def storage_report(cloudstack, zoneid):
+    '''Return one row per compute node with its local storage figures'''
+    hosts = cloudstack.list_cached('hosts', listall='true', zoneid=zoneid, type='Routing')
+    pools = cloudstack.list_cached('storagepools', listall='true', zoneid=zoneid)
+    rows = {}
+    for host in hosts:
+        rows[host['ipaddress']] = {'host': host['name'],
+                                   'ipaddress': host['ipaddress'],
+                                   'pools': 0,
+                                   'volumes': 0,
+                                   'allocated': 0,
+                                   'used': 0,
+                                   'capacity': 0,
+                                   'disk_used': None,
+                                   'disk_size': None,
+                                   'domains': None,
+                                   'image_allocated': None}
+    pool_rows = {}
+    pool_names = {}
+    for pool in pools:
+        row = rows.get(pool.get('ipaddress'))
+        if row is None or pool.get('scope') != 'HOST':
+            continue
+        row['pools'] += 1
+        row['used'] += int(pool.get('disksizeused', 0))
+        row['capacity'] += int(pool.get('disksizetotal', 0))
+        pool_rows[pool['id']] = row
+        pool_names[pool['name']] = row
+    for volume in cloudstack.list_records('volumes', listall='true', zoneid=zoneid):
+        row = pool_rows.get(volume.get('storageid')) or pool_names.get(volume.get('storage'))
+        if row is None:
+            continue
+        row['volumes'] += 1
+        row['allocated'] += int(volume.get('size', 0))
+    return sorted(rows.values(), key=lambda row: row['host'])
+
+
+def _disk_usage(row):
+    '''Read filesystem usage for one report row'''
+    try:
+        node = ComputeNode(row['ipaddress'])
+    except Exception, error:
+        logging.warn("Unable to connect to %s: %s", row['host'], error)
+        return row
+    try:
+        row['disk_used'], row['disk_size'] = node.disk_usage()
+        domains = node.disk_inventory()
+        if domains is not None:
+            row['domains'] = len(domains)
+            row['image_allocated'] = sum(disk['allocated'] or 0 for disks in domains.values()
+                                         for disk in disks)
+    finally:
+        node.close()
+    return row
+
+
+def add_disk_usage(rows, workers=16):
+    '''Fill disk_used/disk_size and domains/image_allocated for each row,
+    connecting to nodes in parallel
+    '''
+    pool = ThreadPool(max(1, min(workers, len(rows))))
+    try:
+        return pool.map(_disk_usage, rows)
+    finally:
+        pool.close()
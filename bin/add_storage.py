@@ -2,6 +2,9 @@
 '''Add an extra storage volume to a CloudStack node. The script builds a new
 volume of type "Datadisk" according to the provided size parameter, and attaches it
 to the provided host. This volume can be formatted and mounted as normal.
+With --batch, a file of "hostname size" lines is processed at once: VMs, hosts,
+storage pools and disk offerings are listed once per environment and all
+volumes are created and attached concurrently.
 '''
 
 import argparse
@@ -16,12 +19,94 @@ import CloudStack
 def parse_arguments():
     '''Parse arguments/options'''
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("hostname", type=str, help="The FQDN of the VM requiring storage")
-    parser.add_argument("size", type=int, help="Size in GB")
+    parser.add_argument("hostname", type=str, nargs='?',
+                        help="The FQDN of the VM requiring storage")
+    parser.add_argument("size", type=int, nargs='?', help="Size in GB")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="File of 'hostname size' lines ('-' for stdin)")
     args = parser.parse_args()
+    if not args.batch and (args.hostname is None or args.size is None):
+        parser.error("hostname and size are required unless --batch is given")
     return args
 
 
+def read_batch(filename):
+    '''Parse (hostname, size) pairs from a batch file'''
+    batchfile = sys.stdin if filename == '-' else open(filename)
+    pairs = []
+    for num, line in enumerate(batchfile, 1):
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        try:
+            hostname, size = line.split()
+            pairs.append((hostname, int(size)))
+        except ValueError:
+            logging.error("Line %d of %s is not 'hostname size': %s", num, filename, line)
+            sys.exit(1)
+    return pairs
+
+
+def resolve(cloudstack, pairs):
+    '''Resolve VMs, compute nodes, pools and disk offerings for each pair with
+    one listing of each, returning a list of request dicts
+    '''
+    vms = {}
+    for virtm in cloudstack.list_vms():
+        vms.setdefault(virtm['name'], []).append(virtm)
+    hosts = dict((host['id'], host) for host in
+                 cloudstack.list_cached('hosts', listall='true', type='Routing'))
+    pools = {}
+    for pool in cloudstack.list_cached('storagepools', listall='true'):
+        pools.setdefault(pool['ipaddress'], pool)
+    offerings = dict((off['name'], off) for off in
+                     cloudstack.list_cached('diskofferings', listall='true'))
+    requests = []
+    for hostname, size in pairs:
+        matches = vms.get(CloudStack.HostName(hostname).name, [])
+        if len(matches) != 1:
+            logging.error("Expected one VM matching %s, found %d", hostname, len(matches))
+            sys.exit(1)
+        virtm = matches[0]
+        host = hosts.get(virtm.get('hostid'))
+        if host is None or host['ipaddress'] not in pools:
+            logging.error("Unable to find the compute node storage for %s", hostname)
+            sys.exit(1)
+        diskoffering = cloudstack.local_disk_offering(host, pools[host['ipaddress']], offerings)
+        requests.append({'hostname': hostname, 'size': str(size), 'vm': virtm,
+                         'diskoffering': diskoffering})
+    return requests
+
+
+def add_volumes(cloudstack, requests):
+    '''Create every volume, attaching each one as soon as it is created.
+    Returns the list of failures.
+    '''
+    def on_done(context, jobquery):
+        '''Chain the attach onto a finished create'''
+        stage, req = context
+        if stage == 'create':
+            volume = jobquery['jobresult']['volume']
+            print "\nVolume %s[%s] is created" % (volume['name'], volume['id'])
+            request = cloudstack.attachVolume(id=volume['id'],
+                                              virtualmachineid=req['vm']['id'])
+            return request['jobid'], ('attach', req)
+        print "\nVolume attached to", req['hostname']
+        return None
+
+    jobs = {}
+    for req in requests:
+        virtm = req['vm']
+        print "Requesting a volume of %sGB for %s" % (req['size'], req['hostname'])
+        request = cloudstack.createVolume(name=req['hostname'] + '-data',
+                                          diskOfferingId=req['diskoffering']['id'],
+                                          size=req['size'], zoneId=virtm['zoneid'],
+                                          account=virtm['account'],
+                                          domainid=virtm['domainid'])
+        jobs[request['jobid']] = ('create', req)
+    return cloudstack.wait_for_jobs(jobs, on_done)
+
+
 def main():
     '''Main process that handles arguments, builds CloudStack object,
     and calls the methods to create the volume
@@ -30,42 +115,21 @@ def main():
     config = ConfigParser.ConfigParser()
     config.read(os.path.expanduser('~/.cloud.cfg'))
     args = parse_arguments()
-    hostname = args.hostname
-    size = str(args.size)
-    cloudstack = CloudStack.cloud(hostname, config)
-    vms = cloudstack.fetch_vms(hostname)
-    if len(vms) > 1:
-        logging.error("Too many VMs found")
-        sys.exit(1)
-    virtm = vms[0]
-    host_id = virtm['hostid']
-    host = cloudstack.listHosts(id=host_id)['host'][0]
-    # Check for existing storage pools
-    storagepools = cloudstack.listStoragePools(ipaddress=host['ipaddress']).get('storagepool', [])
-    if storagepools:
-        storagepool = storagepools[0]
-    if host['name'] != storagepool.get('tags'):
-        print "Adding a tag to the storage pool"
-        cloudstack.updateStoragePool(id=storagepool['id'], tags=host['name'])
-    diskoffering = cloudstack.listDiskOfferings(name=host['name']).get('diskoffering', '')
-    if not diskoffering:
-        print "Creating a disk offering for", host['name']
-        diskoffering = cloudstack.createDiskOffering(displaytext=host['name'], name=host['name'],
-                                                     customized='true', storagetype='local',
-                                                     tags=host['name']).get('diskoffering', [])
+    if args.batch:
+        pairs = read_batch(args.batch)
     else:
-        diskoffering = diskoffering[0]
-    # Create the new volume and attach to the VM
-    print "Requesting a volume of %sGB" % size,
-    request = cloudstack.createVolume(name=hostname + '-data', diskOfferingId=diskoffering['id'],
-                                      size=size, zoneId=virtm['zoneid'], account=virtm['account'],
-                                      domainid=virtm['domainid'])
-    result = cloudstack.wait_for_job(request['jobid'])['jobresult']
-    volume = result['volume']
-    print "Volume %s[%s] is created" % (volume['name'], volume['id'])
-    print "Mounting volume to node",
-    request = cloudstack.attachVolume(id=volume['id'], virtualmachineid=virtm['id'])
-    cloudstack.wait_for_job(request['jobid'])
+        pairs = [(args.hostname, args.size)]
+    sizes = {}
+    for hostname, size in pairs:
+        sizes.setdefault(hostname, []).append(size)
+    failed = []
+    for cloudstack, hostnames in CloudStack.clouds([hostname for hostname, _ in pairs], config):
+        group = [(hostname.fqdn, sizes[hostname.fqdn].pop(0)) for hostname in hostnames]
+        failed.extend(add_volumes(cloudstack, resolve(cloudstack, group)))
+    for (stage, req), errortext in failed:
+        logging.error("Failed to %s volume for %s: %s", stage, req['hostname'], errortext)
+    if failed:
+        sys.exit(1)
     print "Completed"
 
 
@@ -0,0 +1,55 @@
+#!/usr/bin/env python2.7
+'''Run the resident CloudStack daemon, which keeps API clients, their caches
+and compute node SSH connections warm for the other scripts. Scripts use it
+automatically while it is running and connect directly otherwise.
+'''
+
+import argparse
+import ConfigParser
+import logging
+import os
+import sys
+
+from CloudStack import daemon
+
+
+def parse_arguments():
+    '''Parse arguments/options'''
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--stop", action='store_true', help="Stop the running daemon")
+    group.add_argument("--status", action='store_true',
+                       help="Report whether the daemon is running")
+    parser.add_argument("--socket", default=daemon.socket_path(),
+                        help="Unix socket path (default %(default)s,\n"
+                             "or set CLOUDSTACK_SOCKET)")
+    parser.add_argument("--debug", action='store_true', help="Log failed requests")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    '''Main process that handles arguments and runs or controls the daemon'''
+    args = parse_arguments()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    running = daemon.available(args.socket)
+    if args.status:
+        print "Daemon is %s on %s" % ("running" if running else "not running", args.socket)
+        sys.exit(0 if running else 1)
+    if args.stop:
+        if not running:
+            logging.error("No daemon is running on %s", args.socket)
+            sys.exit(1)
+        daemon.request(args.socket, {'op': 'shutdown'})
+        print "Daemon stopped"
+        return
+    config = ConfigParser.RawConfigParser()
+    config.read(os.path.expanduser('~/.cloud.cfg'))
+    try:
+        daemon.serve(config, args.socket)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
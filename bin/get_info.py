@@ -1,43 +1,109 @@
 #!/usr/bin/env python2.7
-'''Query and display CloudStack values for a given VM
+'''Query and display CloudStack values for one or more VMs. Hostnames may
+contain shell-style wildcards in the short name (web*.example.sea); hosts are
+grouped by CloudStack environment and each environment is listed once.
 '''
 
 import argparse
+import collections
 import ConfigParser
+import csv
+import fnmatch
+import json
 import logging
 import os
 import sys
 
 import CloudStack
 
+# Columns used for CSV output when --fields is not given
+CSV_FIELDS = ('name', 'id', 'instancename', 'state', 'hostname', 'nic.0.ipaddress',
+              'serviceofferingname', 'templatename')
+
 
 def parse_arguments():
     '''Parse arguments/options'''
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("hostname", type=str, help="The FQDN of the query VM")
+    parser.add_argument("hostname", type=str, nargs='+',
+                        help="The FQDN(s) or patterns of the query VMs")
+    parser.add_argument("--format", choices=('text', 'json', 'csv'), default='text',
+                        help="Output as text, JSON Lines or CSV (default text)")
+    parser.add_argument("--fields",
+                        help="Comma separated fields to output, dotted paths\n"
+                             "reach into lists and dicts (ex] nic.0.ipaddress)")
     args = parser.parse_args()
     return args
 
 
+def field(virtm, path):
+    '''Resolve a dotted field path within a VM dict'''
+    value = virtm
+    for part in path.split('.'):
+        if isinstance(value, list):
+            try:
+                value = value[int(part)]
+            except (ValueError, IndexError):
+                return None
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+    return value
+
+
+def project(virtm, fields):
+    '''Return the VM restricted to the selected fields, in order'''
+    if not fields:
+        return virtm
+    return [(name, field(virtm, name)) for name in fields]
+
+
+def match_vms(cloudstack, hostnames):
+    '''Yield ([fqdn, ...], vm) for each VM matching any of the HostNames,
+    listing every pattern it matches, from a single listing of the environment
+    '''
+    for virtm in cloudstack.list_vms(full=True):
+        matched = [hostname.fqdn for hostname in hostnames
+                   if fnmatch.fnmatchcase(virtm['name'], hostname.name)]
+        if matched:
+            yield matched, virtm.raw
+
+
 def main():
-    '''Main process that handles arguments, builds CloudStack object,
-    and calls the methods to search and display the host
+    '''Main process that handles arguments, builds CloudStack objects,
+    and calls the methods to search and display the hosts
     '''
     logging.basicConfig(level=logging.INFO)
     config = ConfigParser.RawConfigParser()
     config.read(os.path.expanduser('~/.cloud.cfg'))
     args = parse_arguments()
-    hostname = args.hostname
-    cloudstack = CloudStack.cloud(hostname, config)
-    vms = cloudstack.fetch_vms(hostname)
-    if not vms:
+    fields = args.fields.split(',') if args.fields else None
+    writer = None
+    if args.format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(fields or CSV_FIELDS)
+    found = set()
+    for cloudstack, hostnames in CloudStack.clouds(args.hostname, config):
+        for matched, virtm in match_vms(cloudstack, hostnames):
+            found.update(matched)
+            if args.format == 'json':
+                record = project(virtm, fields)
+                print json.dumps(record if not fields else collections.OrderedDict(record))
+            elif args.format == 'csv':
+                writer.writerow([unicode(value).encode('utf-8') if value is not None else ''
+                                 for _, value in project(virtm, fields or CSV_FIELDS)])
+            else:
+                record = project(virtm, fields)
+                items = record.iteritems() if not fields else record
+                for key, value in items:
+                    print "%s: %s" % (key, value)
+                print ""
+            sys.stdout.flush()
+    missing = [hostname for hostname in args.hostname if hostname not in found]
+    for hostname in missing:
         logging.error("Did not find VM matching %s", hostname)
+    if missing:
         sys.exit(2)
-    elif len(vms) > 1:
-        print "Found multiple VMs matching '%s'" % hostname
-    for virtm in vms:
-        for key, value in virtm.iteritems():
-            print "%s: %s" % (key, value)
 
 
 if __name__ == '__main__':
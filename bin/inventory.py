@@ -0,0 +1,48 @@
+#!/usr/bin/env python2.7
+'''Sync the local inventory mirror of one or more CloudStack sites. Suitable
+for cron; the first run lists everything, later runs only re-list what
+listEvents reports as changed.
+'''
+
+import argparse
+import ConfigParser
+import logging
+import os
+import time
+
+import CloudStack
+from CloudStack.fanout import sites as configured_sites
+from CloudStack.inventory import open_inventory
+
+
+def parse_arguments():
+    '''Parse arguments/options'''
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("site", nargs='*',
+                        help="The .cloud.cfg sections to sync (default: all)")
+    parser.add_argument("--full", action='store_true',
+                        help="Re-list everything instead of following events")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    '''Main process that handles arguments and syncs each site'''
+    logging.basicConfig(level=logging.INFO)
+    config = ConfigParser.RawConfigParser()
+    config.read(os.path.expanduser('~/.cloud.cfg'))
+    args = parse_arguments()
+    sites = args.site or configured_sites(config)
+    for site in sites:
+        cloudstack = CloudStack.cloud_env(site, config)
+        store = cloudstack.inventory or open_inventory(site, config, cloudstack)
+        started = time.time()
+        kinds = store.sync(full=args.full)
+        print "%s: reloaded %s in %.1fs" % (site, ", ".join(sorted(kinds)) or "nothing",
+                                           time.time() - started)
+        store.close()
+    print "Completed"
+
+
+if __name__ == '__main__':
+    main()
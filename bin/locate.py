@@ -0,0 +1,70 @@
+#!/usr/bin/env python2.7
+'''Search every configured CloudStack site at once for VMs by IP address or
+name, or for compute nodes by agent version. Sites are queried in parallel;
+sites that fail or time out are listed after the results.
+'''
+
+import argparse
+import ConfigParser
+import fnmatch
+import logging
+import os
+import sys
+
+from CloudStack.fanout import fanout, merged
+
+
+def parse_arguments():
+    '''Parse arguments/options'''
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--ip", help="Find the VM with this IP address")
+    group.add_argument("--name", help="Find VMs whose short name matches this pattern")
+    group.add_argument("--agent-version", dest="version",
+                       help="Find compute nodes running this agent version")
+    parser.add_argument("--timeout", type=int, default=60,
+                        help="Seconds to wait for each site (default 60)")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    '''Main process that handles arguments and prints the merged matches'''
+    logging.basicConfig(level=logging.INFO)
+    config = ConfigParser.RawConfigParser()
+    config.read(os.path.expanduser('~/.cloud.cfg'))
+    args = parse_arguments()
+    if args.version:
+        def query(cloudstack):
+            '''Compute nodes on the requested agent version'''
+            hosts = cloudstack.list_cached('hosts', listall='true', type='Routing')
+            return [host for host in hosts if host.get('version') == args.version]
+    else:
+        def query(cloudstack):
+            '''VMs matching the requested IP or name'''
+            found = []
+            for virtm in cloudstack.list_vms():
+                if args.ip and any(nic.get('ipaddress') == args.ip
+                                   for nic in virtm.get('nic', [])):
+                    found.append(virtm)
+                elif args.name and fnmatch.fnmatchcase(virtm['name'], args.name):
+                    found.append(virtm)
+            return found
+    results, errors = fanout(config, query, args.timeout)
+    matches = 0
+    for site, obj in merged(results):
+        matches += 1
+        if args.version:
+            print "%-10s %-30s %-16s %s" % (site, obj['name'], obj['ipaddress'], obj['state'])
+        else:
+            ipaddress = obj['nic'][0]['ipaddress'] if obj.get('nic') else ''
+            print "%-10s %-30s %-16s %-12s %s" % (site, obj['name'], ipaddress,
+                                                  obj['state'], obj.get('hostname', ''))
+    for site in sorted(errors):
+        logging.error("Site %s failed: %s", site, errors[site])
+    if not matches:
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
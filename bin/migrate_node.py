@@ -4,17 +4,15 @@
 
 import argparse
 import ConfigParser
-import getpass
 import logging
 import os
-import re
-import socket
 import sys
+import threading
 import time
-import xmltodict
 
 import CloudStack
-import paramiko
+from CloudStack import bootstrap, estimate
+from CloudStack.computenode import CONVERTED_SUFFIX, PROBE_BYTES, ComputeNode
 
 
 def parse_arguments():
@@ -27,286 +25,177 @@ def parse_arguments():
     parser.add_argument("--hostname", help="Migrate with a new hostname")
     parser.add_argument("--nodestroy", action='store_true',
                         help="Do not destroy the original VM")
+    parser.add_argument("--transfer", choices=('auto', 'stream', 'archive'), default='auto',
+                        help="How images are moved: 'stream' converts on the fly through\n"
+                             "qemu-nbd with no local copy, 'archive' converts, tars and\n"
+                             "rsyncs; 'auto' streams only images whose format changes")
+    parser.add_argument("--dry-run", action='store_true',
+                        help="Measure the images and the link to the destination, print\n"
+                             "the estimated time per phase and downtime, and exit")
     parser.add_argument("--debug", action='store_true',
                         help="Turn on debugging")
     args = parser.parse_args()
     return args
 
 
-class ComputeNode(object):
-    '''Connection to source node and methods for interaction'''
-
-    def __init__(self, hostip):
-        '''Connect to remote server'''
-        self.hostip = hostip
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        try:
-            self.ssh.connect(self.hostip, username='root', timeout=20)
-        except paramiko.SSHException:
-            password = getpass.getpass(prompt="Please enter password for %s: " % hostip)
-            self.ssh.connect(self.hostip, username='root', password=password, timeout=20)
-
-    def get_volume_name(self, vminstance):
-        '''dumpxml of instance-name and parse source file path'''
-        # command = "virsh dumpxml %s |grep 'source file='" % vminstance
-        command = "virsh dumpxml %s" % vminstance
-        try:
-            _, stdout, stderr = self.ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError("Error with 'virsh dumpxml': %s" % stderr.read())
-        except RuntimeError, error:
-            logging.exception("Failed to parse for image file: %s", error)
-            sys.exit(2)
-        output = stdout.read()
-        xmldict = xmltodict.parse(output)
-        alldisks = []
-        try:
-            for disk in xmldict['domain']['devices']['disk']:
-                if disk['@device'] == 'disk':
-                    alldisks.append(disk)
-        except KeyError:
-            logging.exception("Unable to image file from VM xml")
-            sys.exit(2)
-        if len(alldisks) > 1:
-            print '''
-            Found more than one image file, probably an attached disk.
-            This node must be manually migrated, the ability to handle extra
-            volumes is not integrated into this script.
-            '''
-            sys.exit(4)
-        else:
-            storagefile = alldisks[0]['source']['@file']
-            return storagefile
-
-    def get_volume_type(self, storagefile):
-        '''Determine image file type (qcow2 or raw)'''
-        command = "qemu-img info %s |grep 'file format'" % storagefile
-        try:
-            _, stdout, stderr = self.ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError("Error with 'qemu-img info': %s" % stderr.read())
-        except RuntimeError, error:
-            logging.exception("Failed to determine image type: %s", error)
-            sys.exit(2)
-        output = stdout.read()
-        query = re.compile("file format: (.*)")
-        vol_type = query.search(output).group(1)
-        return vol_type
-
-    def get_backing_file(self, storagefile):
-        '''Parse backing file path for qcow2 image'''
-        command = "qemu-img info %s |grep 'backing file'" % storagefile
-        try:
-            _, stdout, stderr = self.ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError("Error with 'qemu-img info': %s" % stderr.read())
-        except RuntimeError, error:
-            logging.exception("Failed to determine backing file: %s", error)
-            sys.exit(2)
-        output = stdout.read()
-        query = re.compile(r"backing file: (.*) \(.*$")
-        query2 = re.compile("backing file: (.*)")
-        search = query.search(output)
-        if not search:
-            search = query2.search(output)
-        if not search:
-            logging.error("Unable to parse backing file")
-            sys.exit(2)
-        backing_file = search.group(1).split('/')[5]
-        return backing_file
-
-    def convert_image(self, storagefile, ori_type, new_format, nodestroy):
-        '''Convert image format'''
-        if nodestroy:
-            opt = "cp"
-        else:
-            opt = "mv"
-        command_copy = "cd /var/lib/libvirt/images; %s %s %s.ori" % (opt, storagefile, storagefile)
-        command_conv = "cd /var/lib/libvirt/images; \
-            qemu-img convert -f %s -O %s %s.ori %s" % (ori_type,
-                                                       new_format,
-                                                       storagefile,
-                                                       storagefile)
-        try:
-            _, stdout, stderr = self.ssh.exec_command(command_copy)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise Exception("Error moving image file: %s" % stderr.read())
-            _, stdout, stderr = self.ssh.exec_command(command_conv)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError("Error with 'qemu-img convert': %s" % stderr.read())
-        except RuntimeError, error:
-            logging.exception("Failed to convert image file: %s", error)
-            sys.exit(2)
-        return
+def run_parallel(func, items):
+    '''Run func over items in threads, returning the results in order and
+    exiting if any of them failed
+    '''
+    results = [None] * len(items)
+    errors = []
 
-    def tar_volume(self, vmname, storagefile):
-        '''tar raw sparse image'''
-        imagetar = vmname + '.tgz'
-        filename = storagefile.split('/')[5]
-        command = "cd /var/lib/libvirt/images; bsdtar -cf %s %s" % (imagetar, filename)
+    def worker(idx, item):
+        '''Store one result, catching sys.exit() from ComputeNode methods'''
         try:
-            _, stdout, stderr = self.ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError("Error with 'bsdtar -cf': %s" % stderr.read())
-        except RuntimeError, error:
-            logging.exception("Failed to archive image file: %s", error)
-            sys.exit(2)
-        return imagetar
+            results[idx] = func(item)
+        except BaseException, error:
+            errors.append(error)
 
-    def clean_file(self, filename):
-        '''Delete a remote file'''
-        command = "cd /var/lib/libvirt/images; rm -f %s " % filename
-        try:
-            _, stdout, stderr = self.ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError("Error with 'rm -f': %s" % stderr.read())
-        except RuntimeError, error:
-            logging.warn("Failed to cleanup archive file: %s", error)
+    threads = [threading.Thread(target=worker, args=(idx, item))
+               for idx, item in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        logging.error("%d of %d volume operations failed", len(errors), len(items))
+        sys.exit(2)
+    return results
 
-    def untar_volume(self, imagetar):
-        '''Extract tar archive of raw image file'''
-        command = "cd /var/lib/libvirt/images; tar -xSf %s" % imagetar
-        try:
-            _, stdout, stderr = self.ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError("Error with 'tar -xSf': %s" % stderr.read())
-        except RuntimeError, error:
-            logging.exception("Failed to extract image archive: %s", error)
-            sys.exit(2)
-        return
 
-    def rsync_volume(self, new_host_ip, imagefile, nocompress):
-        '''rsync image archive to destination compute host'''
-        imagepath = '/var/lib/libvirt/images/' + imagefile
-        if nocompress:
-            command = "rsync -v -e 'ssh -i /root/.ssh/id_rsa_compute' \
-            --progress %s root@%s:%s" % (imagepath, new_host_ip, imagepath)
-        else:
-            command = "rsync -avz -e 'ssh -i /root/.ssh/id_rsa_compute' \
-                --progress %s root@%s:%s" % (imagepath, new_host_ip, imagepath)
-        try:
-            _, stdout, stderr = self.ssh.exec_command(command)
-            while not stdout.channel.exit_status_ready():
-                if stdout.channel.recv_ready():
-                    output = stdout.channel.recv(1024).strip()
-                    sys.stdout.write("\r%s" % output)
-                    sys.stdout.flush()
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError("Error with 'rynsc': %s" % stderr.read())
-        except RuntimeError, error:
-            logging.exception("Failed to rsync image archive: %s", error)
-            sys.exit(2)
-        print ''
-        return
-
-    def copy_dhclient(self, oldfile, newfile):
-        '''Copy dhclient leases between images'''
-        out_command = "virt-copy-out -a %s /var/lib/dhcp/dhclient.eth0.leases \
-            /tmp" % oldfile
-        in_command = "virt-copy-in -a %s /tmp/dhclient.eth0.leases /var/lib/dhcp" % newfile
-        try:
-            _, stdout, stderr = self.ssh.exec_command(out_command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise Exception("Error with 'virt-copy-out': %s" % stderr.read())
-            _, stdout, stderr = self.ssh.exec_command(in_command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError("Error with 'virt-copy-in': %s" % stderr.read())
-        except RuntimeError, error:
-            logging.exception("Failed to copy dhcp lease file: %s", error)
+def map_volumes(cloud, virtm, disks):
+    '''Attach the CloudStack volume to each disk of a VM, matched on the
+    image file name, returning the disks with the root volume first
+    '''
+    volumes = cloud.listVolumes(listall='true', virtualmachineid=virtm['id']).get('volume', [])
+    bypath = dict((volume['path'], volume) for volume in volumes)
+    for disk in disks:
+        volume = bypath.get(os.path.basename(disk['file']))
+        if volume is None:
+            logging.error("No CloudStack volume found for image file %s", disk['file'])
             sys.exit(2)
-        return
+        disk['volume'] = volume
+    return sorted(disks, key=lambda disk: (disk['volume']['type'] != 'ROOT',
+                                           disk['volume'].get('deviceid', 0)))
 
-    def copy_hostname(self, oldfile, newfile):
-        '''Copy /etc/hostname between images'''
-        out_command = "virt-copy-out -a %s /etc/hostname /tmp" % oldfile
-        in_command = "virt-copy-in -a %s /tmp/hostname /etc" % newfile
-        try:
-            _, stdout, stderr = self.ssh.exec_command(out_command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise Exception("Error with 'virt-copy-out': %s" % stderr.read())
-            _, stdout, stderr = self.ssh.exec_command(in_command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError("Error with 'virt-copy-in': %s" % stderr.read())
-        except RuntimeError, error:
-            logging.exception("Failed to copy hostname file: %s", error)
-            sys.exit(2)
-        return
 
-    def replace_volume(self, oldfile, newfile):
-        '''Overwrite a file'''
-        command = "mv -f %s %s" % (newfile, oldfile)
-        try:
-            _, stdout, stderr = self.ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError("Error with 'mv -f': %s" % stderr.read())
-        except RuntimeError, error:
-            logging.exception("Failed to replace volume file: %s", error)
+def check_transfer(sourcecompute, destcompute, transfer):
+    '''Probe qemu on both nodes before anything is stopped, returning the
+    transfer mode to use and the destination's qemu features. Streaming needs
+    qemu-nbd --fork on the source: 'auto' falls back to archive without it,
+    and 'stream' exits while the VM is still running.
+    '''
+    features = destcompute.qemu_features()
+    for node, used in ((sourcecompute, ('coroutines', 'unordered', 'pidfile')),
+                       (destcompute, ('coroutines', 'unordered'))):
+        missing = [name for name in used if name not in node.qemu_features()]
+        if missing:
+            print "qemu on %s lacks %s, running without them" % (node.hostip,
+                                                                 ", ".join(missing))
+    if transfer != 'archive' and not sourcecompute.can_stream():
+        if transfer == 'stream':
+            logging.error("qemu-nbd on %s cannot fork an export, use --transfer archive",
+                          sourcecompute.hostip)
             sys.exit(2)
-        return
+        print "qemu-nbd on %s cannot fork an export, transferring by archive" % (
+            sourcecompute.hostip)
+        transfer = 'archive'
+    return transfer, features
 
-    def close(self):
-        '''Close the SSH connection'''
-        self.ssh.close()
-        return
 
+def transfer_disk(sourcecompute, vmname, disk, new_host_ip, imageformat, nocompress,
+                  transfer, label=None, features=frozenset()):
+    '''Move one disk to the destination in the image format it needs. The
+    image is streamed through qemu-nbd and converted on the way when transfer
+    is 'stream', or 'auto' and the format changes; otherwise (or if the
+    stream fails) it is converted, archived and rsynced. features are the
+    destination's qemu features. Returns the archive name, or None for a
+    streamed disk.
+    '''
+    storagefile = disk['file']
+    vol_type = sourcecompute.get_volume_type(storagefile)
+    if transfer == 'stream' or (transfer == 'auto' and vol_type != imageformat):
+        print "... streaming %s from '%s' to '%s'" % (disk['device'], vol_type, imageformat)
+        if sourcecompute.stream_convert(storagefile, vol_type, imageformat, new_host_ip, label,
+                                        features):
+            return None
+        print "... stream of %s failed, falling back to rsync" % disk['device']
+    suffix = ''
+    if vol_type != imageformat:
+        print "... %s type is '%s', converting to '%s'" % (disk['device'], vol_type,
+                                                         imageformat)
+        sourcecompute.convert_image(storagefile, vol_type, imageformat)
+        suffix = CONVERTED_SUFFIX
+    imagetar = sourcecompute.tar_volume("%s-%s" % (vmname, disk['device']), storagefile, suffix)
+    if suffix:
+        sourcecompute.clean_file(storagefile + suffix)
+    sourcecompute.rsync_volume(new_host_ip, imagetar, nocompress, label)
+    sourcecompute.clean_file(imagetar)
+    return imagetar
 
-class VirtualMachine(object):
-    '''Connection to a VM and methods for interaction'''
 
-    def __init__(self, vmip):
-        '''Connect to remote server'''
-        self.vmip = vmip
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        try:
-            self.ssh.connect(self.vmip, username='root', timeout=20)
-        except paramiko.SSHException:
-            password = getpass.getpass(prompt="Please enter password for %s: " % vmip)
-            self.ssh.connect(self.vmip, username='root', password=password, timeout=20)
+def add_data_volumes(cloud, newvm, new_host, disks):
+    '''Create and attach a data volume on the new VM for each migrated data
+    disk, recording the new volume ID on the disk
+    '''
+    pools = cloud.listStoragePools(ipaddress=new_host['ipaddress']).get('storagepool', [])
+    if not pools:
+        logging.error("No local storage pool found on %s", new_host['name'])
+        sys.exit(2)
+    diskoffering = cloud.local_disk_offering(new_host, pools[0])
 
-    def run_remote_command(self, command):
-        '''Run a remote command'''
-        try:
-            _, stdout, stderr = self.ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise RuntimeError(stderr.read())
-        except RuntimeError, error:
-            logging.exception("Failed to run remote command: %s", error)
-            sys.exit(2)
-        return
+    def on_done(context, jobquery):
+        '''Attach each volume once created'''
+        stage, disk = context
+        if stage == 'create':
+            disk['newid'] = jobquery['jobresult']['volume']['id']
+            request = cloud.attachVolume(id=disk['newid'], virtualmachineid=newvm['id'])
+            return request['jobid'], ('attach', disk)
+        return None
 
-    def close(self):
-        '''Close the SSH connection'''
-        self.ssh.close()
-        return
+    jobs = {}
+    for disk in disks:
+        # Round up so the copy always fits
+        size = max(1, (int(disk['volume']['size']) + 1024 ** 3 - 1) / 1024 ** 3)
+        request = cloud.createVolume(name=disk['volume']['name'],
+                                     diskOfferingId=diskoffering['id'], size=str(size),
+                                     zoneId=newvm['zoneid'], account=newvm['account'],
+                                     domainid=newvm['domainid'])
+        jobs[request['jobid']] = ('create', disk)
+    failed = cloud.wait_for_jobs(jobs, on_done)
+    for (stage, disk), errortext in failed:
+        logging.error("Failed to %s data volume for %s: %s", stage, disk['device'], errortext)
+    if failed:
+        sys.exit(2)
 
 
-def wait_for_ssh(ipaddress):
-    '''Wait for the node to return an ssh connection'''
-    while True:
-        try:
-            socket.create_connection((ipaddress, 22), 1)
-            return
-        except socket.error:
-            print ".",
-            sys.stdout.flush()
-            time.sleep(1)
+def dry_run(sourcecompute, disks, new_host, imageformat, nodestroy, transfer):
+    '''Print the image sizes, measured throughput and estimated timings of
+    a migration without changing anything
+    '''
+    for disk in disks:
+        disk['format'], disk['size'], disk['allocated'] = sourcecompute.image_info(disk['file'])
+        print "%-6s %-6s %8.1f GB allocated of %8.1f GB" % (
+            disk['device'], disk['format'], disk['allocated'] / 1024.0 ** 3,
+            disk['size'] / 1024.0 ** 3)
+    print "Probing throughput to %s" % new_host['name']
+    throughput = sourcecompute.probe_throughput(new_host['ipaddress'])
+    if throughput is None:
+        throughput = estimate.DEFAULT_THROUGHPUT
+        print "Probe failed, assuming %.0f MB/s" % (throughput / estimate.MB)
+    else:
+        print "Measured %.1f MB/s over %d MB (before rsync compression)" % (
+            throughput / estimate.MB, PROBE_BYTES / estimate.MB)
+    for disk in disks:
+        disk['stream'] = transfer == 'stream' or (transfer == 'auto' and
+                                                  disk['format'] != imageformat)
+    phases = estimate.phases(disks, imageformat, throughput, destroy=not nodestroy)
+    for phase, seconds in phases:
+        print "  %-16s %10s" % (phase, estimate.duration(seconds))
+    print "Total %s, expected downtime %s" % (
+        estimate.duration(sum(seconds for _, seconds in phases)),
+        estimate.duration(estimate.downtime(phases)))
 
 
 def main():
@@ -329,7 +218,7 @@ def main():
     cloud = CloudStack.cloud(vmname, config)
     if newhostname:
         newcloud = CloudStack.cloud(newhostname, config)
-        newzoneid = newcloud.fetchZone(newcloud.ZONE)['id']
+        newzoneid = newcloud.fetch_zone(newcloud.zone)['id']
     # Query for VM
     vms = cloud.fetch_vms(vmname)
     if not vms:
@@ -355,15 +244,10 @@ def main():
         sys.exit(2)
     else:
         old_host = hostlist[0]
-    # Get volume name, stop machine
+    # Get volume names, stop machine
     sourcecompute = ComputeNode(old_host['ipaddress'])
-    storagefile = sourcecompute.get_volume_name(oldvm['instancename'])
-    print "Stopping VM",
-    request = cloud.stopVirtualMachine(id=oldvm['id'])
-    cloud.wait_for_job(request['jobid'])
-    # Determine volume type and convert if necessary
-    print "Determining volume type"
-    vol_type = sourcecompute.get_volume_type(storagefile)
+    disks = map_volumes(cloud, oldvm, sourcecompute.get_disks(oldvm['instancename']))
+    storagefile = disks[0]['file']
     ## DEFAULT VOLUME TYPES PER VERSION
     img_map = {'4.4.2': 'raw',
                '4.9.3.0': 'qcow2'
@@ -373,20 +257,36 @@ def main():
     if not imageformat:
         logging.error("Unable to determine output image format for agent version %s", agent_vers)
         sys.exit(2)
-    if imageformat and vol_type != imageformat:
-        print "... type is '%s', converting to '%s'" % (vol_type, imageformat)
-        sourcecompute.convert_image(storagefile, vol_type, imageformat, nodestroy)
-    # Archive image file and rsync to destination host
-    print "Migrating root volume. Please be patient, this will take a few minutes."
-    print "... archiving image file"
-    imagetar = sourcecompute.tar_volume(oldvm['name'], storagefile)
-    print "... rsyncing image archive"
-    sourcecompute.rsync_volume(new_host['ipaddress'], imagetar, nocompress)
-    sourcecompute.clean_file(imagetar)
-    # Destroy old VM
+    destcompute = ComputeNode(new_host['ipaddress'])
+    transfer, features = check_transfer(sourcecompute, destcompute, args.transfer)
+    destcompute.close()
+    if args.dry_run:
+        dry_run(sourcecompute, disks, new_host, imageformat, nodestroy, transfer)
+        sourcecompute.close()
+        return
+    print "Stopping VM",
+    request = cloud.stopVirtualMachine(id=oldvm['id'])
+    cloud.wait_for_job(request['jobid'])
+    # Convert, archive and rsync every volume to the destination host at once
+    print "Migrating %d volume(s). Please be patient, this will take a few minutes." % len(disks)
+    multiple = len(disks) > 1
+    imagetars = run_parallel(
+        lambda disk: transfer_disk(sourcecompute, oldvm['name'], disk, new_host['ipaddress'],
+                                   imageformat, nocompress, transfer,
+                                   disk['device'] if multiple else None, features),
+        disks)
+    # Destroy old VM, keeping its data volumes detached until the new VM is up
+    oldcloud = cloud
+    detached = []
     if not nodestroy:
-        oldqcow = storagefile + '.ori'
-        sourcecompute.clean_file(oldqcow)
+        for disk in disks[1:]:
+            print "Detaching old data volume %s" % disk['volume']['name'],
+            request = cloud.detachVolume(id=disk['volume']['id'])
+            cloud.wait_for_job(request['jobid'])
+            detached.append(disk['volume'])
+        if detached:
+            logging.info("Old data volumes kept until the new VM is up: %s",
+                         ", ".join(volume['id'] for volume in detached))
         print "Destroying old VM",
         request = cloud.destroyVirtualMachine(id=oldvm['id'])
         cloud.wait_for_job(request['jobid'])
@@ -404,28 +304,28 @@ def main():
     # Rebuild VM on destination host
     print "\nDeploying new VM",
     if newhostname:
-        cloud = CloudStack.cloud(newhostname, config)
+        cloud = newcloud
         vmname = newhostname
-        ######## CONTINUE #########
-    account, shortname, domain, application = cloud.parseHostname(vmname)
+    account = cloud.account
+    shortname = CloudStack.HostName(vmname).vm_name
     template = oldvm['templatename']
-    templateid = cloud.fetchTemplate(template)['id']
-    if not templateid:
+    tmpl = cloud.fetch_template(template)
+    if not tmpl:
         print "Unable to lookup template ID for %s" % template
         sys.exit(2)
     req_dict = {
-        'templateid': templateid,
+        'templateid': tmpl['id'],
         'account': account,
         'name': shortname,
         'hostid': new_host['id']
     }
     if newhostname:
-        domainid = cloud.fetchDomain(domain)['id']
+        domainid = cloud.fetch_domain(cloud.domain)['id']
         req_dict['domainid'] = domainid
-        req_dict['networkids'] = cloud.fetchNetwork(domainid, "Application")['id']
-        req_dict['zoneid'] = cloud.fetchZone(cloud.ZONE)['id']
+        req_dict['networkids'] = cloud.fetch_network(domainid, "Application")['id']
+        req_dict['zoneid'] = newzoneid
         vmsize = oldvm['serviceofferingname']
-        req_dict['serviceofferingid'] = cloud.fetchServiceOffering(vmsize)['id']
+        req_dict['serviceofferingid'] = cloud.fetch_service_offering(vmsize)['id']
     else:
         req_dict['ipaddress'] = oldvm['nic'][0]['ipaddress']
         req_dict['domainid'] = oldvm['domainid']
@@ -435,17 +335,20 @@ def main():
     if debug:
         print req_dict
     request = cloud.deployVirtualMachine(**req_dict)
-    cloud.waitForJob(request['jobid'])
+    newvm = cloud.wait_for_job(request['jobid'])['jobresult']['virtualmachine']
     print "Node '%s' has been rebuilt on '%s'" % (vmname, new_host['name'])
-    vms = cloud.fetchVMs(vmname)
-    newvm = vms[0]
-    # Get new volume name, replace with copy
+    # Recreate data volumes, then replace every new volume with its copy
+    if disks[1:]:
+        print "Attaching %d data volume(s)" % len(disks[1:]),
+        add_data_volumes(cloud, newvm, new_host, disks[1:])
     destcompute = ComputeNode(new_host['ipaddress'])
-    print "Setting up migrated volume",
-    tmpfile = destcompute.get_volume_name(newvm['instancename'])
+    print "Setting up migrated volumes",
+    newdisks = map_volumes(cloud, newvm, destcompute.get_disks(newvm['instancename']))
+    newfiles = dict((disk['volume']['id'], disk['file']) for disk in newdisks)
+    tmpfile = newdisks[0]['file']
     request = cloud.stopVirtualMachine(id=newvm['id'])
-    cloud.waitForJob(request['jobid'])
-    destcompute.untar_volume(imagetar)
+    cloud.wait_for_job(request['jobid'])
+    run_parallel(destcompute.untar_volume, [imagetar for imagetar in imagetars if imagetar])
     # Replace network files if IP/hostname changed
     if newhostname:
         print "... copying dhcp leases"
@@ -453,20 +356,32 @@ def main():
         print "... validating hostname"
         destcompute.copy_hostname(tmpfile, storagefile)
     destcompute.replace_volume(tmpfile, storagefile)
-    # Restart new VM with the copied image file
+    for disk in disks[1:]:
+        destcompute.replace_volume(newfiles[disk['newid']], disk['file'])
+    # Restart new VM with the copied image files
     print "Starting new VM",
     request = cloud.startVirtualMachine(id=newvm['id'])
-    req_job = cloud.waitForJob(request['jobid'])
+    req_job = cloud.wait_for_job(request['jobid'])
     ipaddress = req_job['jobresult']['virtualmachine']['nic'][0]['ipaddress']
-    print "Waiting for node to ssh",
-    wait_for_ssh(ipaddress)
-    # Start chef-client
-    print "\nStarting Chef"
-    new_vm = VirtualMachine(ipaddress)
-    new_vm.run_chef()
-    new_vm.close()
+    # Reconfigure the node, with chef-client unless [Global] Bootstrap says otherwise
+    print "Waiting for node to ssh"
+    host = [(vmname, ipaddress)]
+    down = bootstrap.wait_for_ssh(host)
+    results = bootstrap.run(host if not down else [],
+                            bootstrap.commands(config, default=('chef-client',)))
+    if bootstrap.summary(results, down):
+        logging.error("Bootstrap of %s failed, the image archives are left on the node", vmname)
+        if detached:
+            logging.error("Old data volumes left detached: %s",
+                          ", ".join(volume['id'] for volume in detached))
+        sys.exit(2)
+    for volume in detached:
+        print "Removing old data volume %s" % volume['name']
+        oldcloud.deleteVolume(id=volume['id'])
     # Cleanup
-    destcompute.clean_file(imagetar)
+    for imagetar in imagetars:
+        if imagetar:
+            destcompute.clean_file(imagetar)
     destcompute.close()
     print "Completed"
 
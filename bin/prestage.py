@@ -0,0 +1,108 @@
+#!/usr/bin/env python2.7
+'''Copy a template onto the compute nodes of a site ahead of a bulk build,
+so the builds start from the copy in each host's storage pool instead of
+pulling the template from secondary storage. Hosts already holding the
+template (running a VM from it, or warmed recently by this script) are
+reported and skipped. Warmed hosts are recorded in ~/.cloud_prestage/<site>.json
+([Global] PrestageDir); primary storage cleanup removes copies no VM uses, so
+the record is only trusted for --max-age hours.
+'''
+
+import argparse
+import ConfigParser
+import logging
+import os
+import sys
+
+import CloudStack
+from CloudStack import prestage
+from CloudStack.estimate import duration
+
+
+def parse_arguments():
+    '''Parse arguments/options'''
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("site", help="The .cloud.cfg section to pre-stage")
+    parser.add_argument("--templatename",
+                        help="Template to copy (default: [Global] DefaultTemplate)")
+    parser.add_argument("--hosts", metavar="PATTERN",
+                        help="Only compute nodes whose name matches this pattern")
+    parser.add_argument("--size",
+                        help="Service offering for the throwaway VMs\n"
+                             "(default: the smallest local storage offering)")
+    parser.add_argument("--bandwidth", type=float, default=100.0,
+                        help="Template MB per second started across all hosts\n"
+                             "(default 100)")
+    parser.add_argument("--workers", type=int, default=prestage.WORKERS,
+                        help="Hosts warmed at once (default %d)" % prestage.WORKERS)
+    parser.add_argument("--max-age", type=float, default=prestage.STAGED_MAX_AGE / 3600.0,
+                        help="Hours a host recorded as warmed is trusted to hold\n"
+                             "the template (default %(default).0f, 0 to ignore the record)")
+    parser.add_argument("--check", action='store_true',
+                        help="Only report which hosts already hold the template")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    '''Main process that handles arguments, finds the cold hosts and warms
+    them
+    '''
+    logging.basicConfig(level=logging.INFO)
+    config = ConfigParser.RawConfigParser()
+    config.read(os.path.expanduser('~/.cloud.cfg'))
+    args = parse_arguments()
+    template = args.templatename or config.get('Global', 'DefaultTemplate')
+    cloudstack = CloudStack.cloud_env(args.site, config)
+    zoneid = cloudstack.fetch_zone(cloudstack.zone)['id']
+    tmpl = cloudstack.fetch_template(template)
+    if not tmpl:
+        logging.error("No such template - %s", template)
+        sys.exit(1)
+    hosts = prestage.target_hosts(cloudstack, zoneid, args.hosts)
+    if not hosts:
+        logging.error("No enabled compute nodes found")
+        sys.exit(2)
+    path = prestage.staged_path(args.site, config)
+    warm = prestage.warm_hosts(cloudstack, zoneid, tmpl['id'], path, args.max_age * 3600)
+    cold = [host for host in hosts if host['id'] not in warm]
+    for host in hosts:
+        if host['id'] in warm:
+            print "%-30s already warm" % host['name']
+    print "%d of %d hosts hold '%s', %d to warm" % (len(hosts) - len(cold), len(hosts),
+                                                    template, len(cold))
+    if args.check or not cold:
+        print "Completed"
+        return
+    if args.size:
+        offering = cloudstack.fetch_service_offering(args.size)
+        if not offering:
+            logging.error("No such service offering - %s", args.size)
+            sys.exit(1)
+    else:
+        offering = prestage.smallest_offering(cloudstack)
+    domainid = cloudstack.fetch_domain(cloudstack.domain)['id']
+    request = {'account': cloudstack.account,
+               'domainid': domainid,
+               'zoneid': zoneid,
+               'networkids': cloudstack.fetch_network(domainid, "Application")['id'],
+               'serviceofferingid': offering['id'],
+               'templateid': tmpl['id']}
+    nbytes = int(tmpl.get('physicalsize') or tmpl.get('size') or 0) or 1
+    failed = 0
+    for host, seconds, error in prestage.prestage(cloudstack, request, cold, nbytes,
+                                                  args.bandwidth * 1024 ** 2, args.workers):
+        if error:
+            failed += 1
+            print "%-30s failed after %s: %s" % (host['name'], duration(seconds), error)
+        else:
+            prestage.record_staged(path, tmpl['id'], host['id'])
+            print "%-30s warmed in %s" % (host['name'], duration(seconds))
+    if failed:
+        logging.error("%d of %d hosts could not be warmed", failed, len(cold))
+        sys.exit(2)
+    print "Completed"
+
+
+if __name__ == '__main__':
+    main()
@@ -7,33 +7,52 @@ which is evaluated for domain and environment. The corresponding config options
 
 import argparse
 import ConfigParser
-import getpass
 import logging
 import os
-import socket
 import sys
-import time
 import urllib2
 
 import CloudStack
-import paramiko
+from CloudStack import bootstrap
+from CloudStack.placement import Placer
+
+
+class ListSizes(argparse.Action):
+    '''Print the sizes available on every site and exit'''
+
+    def __init__(self, option_strings, dest, config=None, **kwargs):
+        self.config = config
+        super(ListSizes, self).__init__(option_strings, dest, nargs=0, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print "\n".join(CloudStack.cloudsizes(self.config))
+        parser.exit()
 
 
 def parse_arguments(config):
     '''Parse arguments and options'''
-    sizes = CloudStack.cloudsizes(config)
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("hostname",
-                        help="The FQDN of the host you are building")
-    parser.add_argument("size", help="\n".join(sizes))
+    parser.add_argument("hostname", nargs='+',
+                        help="The FQDN of the host(s) you are building")
+    parser.add_argument("size", help="Service offering name, see --list-sizes")
+    parser.add_argument("--list-sizes", action=ListSizes, config=config,
+                        help="List the sizes available on each site and exit")
     parser.add_argument("--ipaddress", help="Force an IP address")
     parser.add_argument("--computenode",
-                        help="Force a build on a specified compute node")
+                        help="Force a build on a specified compute node, or 'auto'\n"
+                             "to place by available CPU, memory and local storage")
     parser.add_argument("--templatename",
                         help="Specify a template name")
     parser.add_argument("--affinitygroup",
                         help="Add the VM to the provided Affinity Group")
+    parser.add_argument("--bootstrap", action='append', metavar='COMMAND',
+                        help="Command to run on the new VMs once ssh is up; repeat for\n"
+                             "several (default: [Global] Bootstrap in .cloud.cfg)")
+    parser.add_argument("--no-bootstrap", action='store_true',
+                        help="Skip the bootstrap commands")
+    parser.add_argument("--workers", type=int, default=bootstrap.WORKERS,
+                        help="VMs bootstrapped in parallel (default %d)" % bootstrap.WORKERS)
     args = parser.parse_args()
     return args
 
@@ -53,18 +72,22 @@ def assign_affinity(cloudstack, groupname, account, domainid):
     return
 
 
-def build_node(cloudstack, vmname, computenode, size, ipaddress, template, affinitygroup):
+def build_node(cloudstack, vmname, computenode, size, ipaddress, template, affinitygroup,
+               placer=None):
     '''Build a node, deploying a job request to the manager, waiting
-    for completion, then returning the IP
+    for completion, then returning the IP. With computenode 'auto' the host is
+    chosen by the placer, which is reused across a batch of builds.
     '''
     account = cloudstack.account
     domainid = cloudstack.fetch_domain(cloudstack.domain)['id']
     networkid = cloudstack.fetch_network(domainid, "Application")['id']
     zoneid = cloudstack.fetch_zone(cloudstack.zone)['id']
-    serviceid = cloudstack.fetch_service_offering(size)['id']
+    offering = cloudstack.fetch_service_offering(size)
+    serviceid = offering['id']
     # Evaluate the template
     try:
-        templateid = cloudstack.fetch_template(template)['id']
+        tmpl = cloudstack.fetch_template(template)
+        templateid = tmpl['id']
     except Exception:
         logging.error('No such template - %s', template)
         logging.error('Available templates:')
@@ -87,8 +110,18 @@ def build_node(cloudstack, vmname, computenode, size, ipaddress, template, affin
     if affinitygroup:
         assign_affinity(cloudstack, affinitygroup, account, domainid)
         req['affinitygroupnames'] = affinitygroup
+    # Place on the best fitting compute host
+    if computenode == 'auto':
+        if placer is None:
+            placer = Placer(cloudstack, zoneid)
+        host = placer.place(offering, tmpl.get('size', 0), affinitygroup)
+        if not host:
+            logging.error("No compute host has capacity for %s", size)
+            sys.exit(2)
+        req['hostid'] = host['id']
+        print "Placing build on {}".format(host['name'])
     # Force compute host
-    if computenode:
+    elif computenode:
         hostid = cloudstack.fetch_host(computenode, zoneid)['id']
         if not hostid:
             logging.error("No compute host found matching %s", computenode)
@@ -104,80 +137,55 @@ def build_node(cloudstack, vmname, computenode, size, ipaddress, template, affin
     return ipaddress
 
 
-def wait_for_ssh(ipaddr):
-    '''Wait for the node to return an ssh connection'''
-    while True:
-        try:
-            socket.create_connection((ipaddr, 22), 1)
-            print ""
-            time.sleep(2)
-            return
-        except socket.error:
-            print ".",
-            sys.stdout.flush()
-            time.sleep(1)
-
-
-class VirtualMachine(object):
-    '''Connection to a VM and methods for interaction'''
-
-    def __init__(self, vmip):
-        '''Connect to remote server'''
-        self.vmip = vmip
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        try:
-            self.ssh.connect(self.vmip, username='root', timeout=45)
-        except paramiko.SSHException:
-            password = getpass.getpass(prompt="Please enter password for %s: " % vmip)
-            self.ssh.connect(self.vmip, username='root', password=password, timeout=20)
-
-    def run_command(self, command):
-        '''Run a remote command on the VM'''
-        _, stdout, stderr = self.ssh.exec_command(command)
-        exit_status = stdout.channel.recv_exit_status()
-        if exit_status != 0:
-            logging.error("Failure on remote command: %s", stderr.read())
-            sys.exit(2)
-        return
-
-    def close(self):
-        '''Close ssh connection'''
-        self.ssh.close()
-        return
-
-
 def main():
-    '''Parse the options, build the node, and configure through Chef'''
+    '''Parse the options, build the nodes, and run the bootstrap commands'''
     # Setup logging
     logging.basicConfig(level=logging.INFO)
     # Parse the config and script parameters
     user_config = ConfigParser.ConfigParser()
     user_config.read(os.path.expanduser("~/.cloud.cfg"))
     args = parse_arguments(user_config)
-    hostname = args.hostname
+    hostnames = args.hostname
     size = args.size
     ipaddress = args.ipaddress
     computenode = args.computenode
     templatename = args.templatename
     affinitygroup = args.affinitygroup
-    # Return the proper Cloudstack connection (which Manager/Zone to use)
-    cloudstack = CloudStack.cloud(hostname, user_config)
+    if ipaddress and len(hostnames) > 1:
+        logging.error("Cannot force one IP address on multiple hosts")
+        sys.exit(1)
     # Define template
     if templatename:
         template = templatename
     else:
         template = user_config.get("Global", "DefaultTemplate")
-    # Build the node
-    vmname = CloudStack.HostName.vm_name
-    try:
-        node_ip = build_node(cloudstack, computenode, vmname, size,
-                             ipaddress, template, affinitygroup)
-    except urllib2.HTTPError, err:
-        logging.exception("Failed to request node build: %s", err)
-        sys.exit(1)
-    # Use node_ip + VirtualMachine to run a remote command
-    # For instance, connect to Puppet/Chef, run some post-provisioning script, etc
+    # Build the nodes, one placer per environment
+    placers = {}
+    built = []
+    for hostname in hostnames:
+        env = CloudStack.HostName(hostname).cs_env
+        cloudstack = CloudStack.cloud(hostname, user_config)
+        if computenode == 'auto' and env not in placers:
+            zoneid = cloudstack.fetch_zone(cloudstack.zone)['id']
+            placers[env] = Placer(cloudstack, zoneid)
+        vmname = CloudStack.HostName(hostname).vm_name
+        try:
+            node_ip = build_node(cloudstack, vmname, computenode, size, ipaddress,
+                                 template, affinitygroup, placers.get(env))
+        except urllib2.HTTPError, err:
+            logging.exception("Failed to request node build: %s", err)
+            sys.exit(1)
+        print "{} is available at {}".format(hostname, node_ip)
+        built.append((hostname, node_ip))
+    # Configure every node at once, e.g. with Chef or Puppet
+    commands = args.bootstrap or bootstrap.commands(user_config)
+    if commands and not args.no_bootstrap:
+        print "Waiting for ssh on {} node(s)".format(len(built))
+        down = bootstrap.wait_for_ssh(built)
+        results = bootstrap.run([host for host in built if host[0] not in down],
+                                commands, args.workers)
+        if bootstrap.summary(results, down):
+            sys.exit(1)
     print "Completed"
 
 
@@ -0,0 +1,173 @@
+#!/usr/bin/env python2.7
+'''Plan (and later execute) VM migrations that bring the compute nodes of a
+CloudStack site under a target utilization while moving as few bytes as possible.
+Moves are given a time estimate and scheduled into maintenance windows, with
+optional parallel lanes. The plan is written to a JSON file for review; run
+again with --execute to carry it out through migrate_node.py.
+'''
+
+import argparse
+import ConfigParser
+import logging
+import os
+import subprocess
+import sys
+import threading
+
+import CloudStack
+from CloudStack import estimate
+from CloudStack.bootstrap import say
+from CloudStack.rebalance import Planner, read_plan, write_plan
+
+
+def parse_arguments():
+    '''Parse arguments/options'''
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("site", nargs='?', help="The .cloud.cfg section to rebalance")
+    parser.add_argument("--target", type=float, default=0.8,
+                        help="Highest allowed host utilization (0-1, default 0.8)")
+    parser.add_argument("--domain",
+                        help="Domain appended to VM names for migrate_node.py\n"
+                             "(default: the site name)")
+    parser.add_argument("--output", default="rebalance.json",
+                        help="Plan file to write (default rebalance.json)")
+    parser.add_argument("--bandwidth", type=float,
+                        default=estimate.DEFAULT_THROUGHPUT / estimate.MB,
+                        help="Node to node throughput in MB/s for estimates\n"
+                             "(default %(default).0f; see migrate_node.py --dry-run)")
+    parser.add_argument("--window", type=float,
+                        help="Maintenance window length in hours; moves are packed into\n"
+                             "as few windows as possible")
+    parser.add_argument("--parallel", type=int, default=1,
+                        help="Migrations run at once within a window (default 1)")
+    parser.add_argument("--execute", metavar="PLAN",
+                        help="Run the moves in a previously written plan")
+    parser.add_argument("--only-window", type=int, metavar="N",
+                        help="With --execute, run only the moves of window N")
+    args = parser.parse_args()
+    if not args.site and not args.execute:
+        parser.error("a site is required unless --execute is given")
+    return args
+
+
+def make_plan(cloudstack, site, target, domain, filename, bandwidth, window, parallel):
+    '''Build, schedule and write a plan for the site's zone'''
+    zoneid = cloudstack.fetch_zone(cloudstack.zone)['id']
+    planner = Planner(cloudstack, zoneid)
+    moves = planner.plan(target)
+    for move in moves:
+        move['fqdn'] = "%s.%s" % (move['vm'], domain)
+        move['seconds'] = estimate.move_seconds(move['bytes'], bandwidth * estimate.MB)
+    moves = estimate.schedule(moves, parallel, window * 3600 if window else None)
+    plan = write_plan(filename, site, cloudstack.zone, target, moves)
+    for move in moves:
+        print "w%-3d %-30s %-20s -> %-20s %8.1f GB %10s" % (
+            move['window'], move['vm'], move['source'], move['destination'],
+            move['bytes'] / 1024.0 ** 3, estimate.duration(move['seconds']))
+    windows = {}
+    for move in moves:
+        end = move['start'] + move['seconds']
+        windows[move['window']] = max(windows.get(move['window'], 0), end)
+    for num in sorted(windows):
+        print "Window %d: makespan %s" % (num, estimate.duration(windows[num]))
+    print "%d moves, %.1f GB to transfer, plan written to %s" % (
+        len(moves), plan['bytes'] / 1024.0 ** 3, filename)
+
+
+def run_move(migrate, move, prefixed):
+    '''Run migrate_node.py for one move, returning its exit status. With
+    prefixed, output lines are labelled with the VM so lanes can share the
+    terminal.
+    '''
+    command = [sys.executable, migrate, move['fqdn'], move['destination']]
+    if not prefixed:
+        return subprocess.call(command)
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in iter(proc.stdout.readline, ''):
+        say(move['vm'], line.rstrip())
+    return proc.wait()
+
+
+def execute_plan(filename, only_window=None):
+    '''Run the moves of a plan with migrate_node.py window by window, each
+    lane in parallel. A move waits for the moves it is planned 'after' (those
+    sharing one of its hosts); a lane stops at its first failed or blocked
+    move, and execution stops after the window in which a move failed.
+    '''
+    plan = read_plan(filename)
+    migrate = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrate_node.py')
+    moves = [move for move in plan['moves']
+             if only_window is None or move.get('window', 0) == only_window]
+    if any('after' not in move for move in moves):
+        # Plans written before dependencies were recorded run one at a time,
+        # in file order
+        estimate.dependencies(plan['moves'])
+        for move in moves:
+            move['lane'] = 0
+            move['start'] = 0
+    for num in sorted(set(move.get('window', 0) for move in moves)):
+        lanes = {}
+        for move in moves:
+            if move.get('window', 0) == num:
+                lanes.setdefault(move.get('lane', 0), []).append(move)
+        for lane in lanes.values():
+            lane.sort(key=lambda move: (move.get('start', 0), move['id']))
+        # id: Event set once the move has finished, and the ids that succeeded
+        finished = dict((move['id'], threading.Event())
+                        for lane in lanes.values() for move in lane)
+        succeeded = set()
+        failed = []
+        print "Window %d: %d moves on %d lane(s)" % (num, len(finished), len(lanes))
+
+        def lane_worker(lane):
+            '''Run one lane's moves in order, stopping at the first failure'''
+            for move in lane:
+                deps = [dep for dep in move['after'] if dep in finished]
+                for dep in deps:
+                    finished[dep].wait()
+                if not succeeded.issuperset(deps):
+                    logging.error("Not migrating %s: an earlier move on %s or %s failed",
+                                  move['fqdn'], move['source'], move['destination'])
+                    failed.append(1)
+                    break
+                print "Migrating %s to %s" % (move['fqdn'], move['destination'])
+                status = run_move(migrate, move, len(lanes) > 1)
+                if status != 0:
+                    logging.error("Migration of %s failed (exit %d)", move['fqdn'], status)
+                    failed.append(status)
+                    break
+                succeeded.add(move['id'])
+                finished[move['id']].set()
+            for move in lane:
+                finished[move['id']].set()
+
+        threads = [threading.Thread(target=lane_worker, args=(lane,))
+                   for lane in lanes.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failed:
+            logging.error("Stopping after window %d", num)
+            sys.exit(failed[0])
+
+
+def main():
+    '''Main process that handles arguments, builds CloudStack object,
+    and plans or executes the rebalance
+    '''
+    logging.basicConfig(level=logging.INFO)
+    config = ConfigParser.RawConfigParser()
+    config.read(os.path.expanduser('~/.cloud.cfg'))
+    args = parse_arguments()
+    if args.execute:
+        execute_plan(args.execute, args.only_window)
+    else:
+        cloudstack = CloudStack.cloud_env(args.site, config)
+        make_plan(cloudstack, args.site, args.target, args.domain or args.site, args.output,
+                  args.bandwidth, args.window, args.parallel)
+    print "Completed"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python2.7
+'''Report local storage per compute node: allocated volume size, used and
+total pool capacity, and optionally the real filesystem usage, domain count
+and image allocation read over SSH.
+'''
+
+import argparse
+import ConfigParser
+import csv
+import json
+import logging
+import os
+import sys
+
+import CloudStack
+from CloudStack.fanout import sites as configured_sites
+from CloudStack.storage import add_disk_usage, storage_report
+
+COLUMNS = ('site', 'host', 'ipaddress', 'pools', 'volumes', 'allocated', 'used',
+           'capacity', 'disk_used', 'disk_size', 'domains', 'image_allocated')
+
+
+def parse_arguments():
+    '''Parse arguments/options'''
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("site", nargs='*',
+                        help="The .cloud.cfg sections to report on (default: all)")
+    parser.add_argument("--ssh", action='store_true',
+                        help="Also read on-disk usage and libvirt domain disks from each\n"
+                             "node over SSH")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="Concurrent SSH connections (default 16)")
+    parser.add_argument("--format", choices=('text', 'json', 'csv'), default='text',
+                        help="Output as a text table, JSON Lines or CSV")
+    args = parser.parse_args()
+    return args
+
+
+def gigabytes(value):
+    '''Format a byte count as GB for the text table'''
+    if value is None:
+        return '-'
+    return '%.0f' % (value / 1024.0 ** 3)
+
+
+def main():
+    '''Main process that handles arguments, builds CloudStack objects,
+    and prints the report for each site
+    '''
+    logging.basicConfig(level=logging.INFO)
+    config = ConfigParser.RawConfigParser()
+    config.read(os.path.expanduser('~/.cloud.cfg'))
+    args = parse_arguments()
+    sites = args.site or configured_sites(config)
+    writer = None
+    if args.format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(COLUMNS)
+    elif args.format == 'text':
+        print "%-10s %-24s %5s %7s %10s %10s %10s %10s %10s %7s %10s" % (
+            'SITE', 'HOST', 'POOLS', 'VOLUMES', 'ALLOC(GB)', 'USED(GB)', 'CAP(GB)',
+            'DISK(GB)', 'FS(GB)', 'DOMAINS', 'IMAGE(GB)')
+    for site in sites:
+        cloudstack = CloudStack.cloud_env(site, config)
+        zoneid = cloudstack.fetch_zone(cloudstack.zone)['id']
+        rows = storage_report(cloudstack, zoneid)
+        if args.ssh:
+            rows = add_disk_usage(rows, args.workers)
+        for row in rows:
+            row['site'] = site
+            if args.format == 'json':
+                print json.dumps(row, sort_keys=True)
+            elif args.format == 'csv':
+                writer.writerow([row[col] if row[col] is not None else '' for col in COLUMNS])
+            else:
+                print "%-10s %-24s %5d %7d %10s %10s %10s %10s %10s %7s %10s" % (
+                    site, row['host'], row['pools'], row['volumes'],
+                    gigabytes(row['allocated']), gigabytes(row['used']),
+                    gigabytes(row['capacity']), gigabytes(row['disk_used']),
+                    gigabytes(row['disk_size']),
+                    '-' if row['domains'] is None else row['domains'],
+                    gigabytes(row['image_allocated']))
+
+
+if __name__ == '__main__':
+    main()
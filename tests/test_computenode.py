@@ -0,0 +1,80 @@
+'''Tests for the output parsing and option building in CloudStack.computenode'''
+
+import unittest
+
+from CloudStack import computenode
+
+INVENTORY = '''<node>
+<domain type='kvm'>
+  <name>i-2-10-VM</name>
+  <devices>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2'/>
+      <source file='/var/lib/libvirt/images/web &amp; db&apos;s disk'/>
+      <target dev='vdb' bus='virtio'/>
+    </disk>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2'/>
+      <source file='/var/lib/libvirt/images/root'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+    <disk type='file' device='cdrom'>
+      <source file='/var/lib/libvirt/images/boot.iso'/>
+      <target dev='hdc' bus='ide'/>
+    </disk>
+  </devices>
+</domain>
+<domain type='kvm'>
+  <name>i-2-11-VM</name>
+  <devices>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='raw'/>
+      <source file='/var/lib/libvirt/images/gone'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+  </devices>
+</domain>
+</node>
+10737418240 2097152 512 /var/lib/libvirt/images/root
+5368709120 8 512 /var/lib/libvirt/images/web & db's disk
+1024 2 512 /var/lib/libvirt/images/boot.iso
+'''
+
+
+class DiskInventoryTest(unittest.TestCase):
+    '''parse_disk_inventory() joins the dumped XML with the stat lines'''
+
+    def setUp(self):
+        self.domains = computenode.parse_disk_inventory(INVENTORY)
+
+    def test_disks_in_target_order(self):
+        self.assertEqual(sorted(self.domains), ['i-2-10-VM', 'i-2-11-VM'])
+        self.assertEqual([disk['device'] for disk in self.domains['i-2-10-VM']],
+                         ['vda', 'vdb'])
+
+    def test_sizes(self):
+        root, data = self.domains['i-2-10-VM']
+        self.assertEqual((root['format'], root['size'], root['allocated']),
+                         ('qcow2', 10737418240, 1073741824))
+        self.assertEqual(data['file'], "/var/lib/libvirt/images/web & db's disk")
+        self.assertEqual((data['size'], data['allocated']), (5368709120, 4096))
+
+    def test_missing_file_has_no_size(self):
+        disk = self.domains['i-2-11-VM'][0]
+        self.assertEqual((disk['format'], disk['size'], disk['allocated']),
+                         ('raw', None, None))
+
+
+class ConvertOptionsTest(unittest.TestCase):
+    '''convert_options() only asks for what the node's qemu-img supports'''
+
+    def test_options(self):
+        self.assertEqual(computenode.convert_options(frozenset()), '')
+        self.assertEqual(computenode.convert_options(frozenset(['coroutines'])), '-m 8 ')
+        self.assertEqual(computenode.convert_options(frozenset(['coroutines', 'unordered'])),
+                         '-m 8 -W ')
+        self.assertEqual(computenode.convert_options(frozenset(['unordered'])), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
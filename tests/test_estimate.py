@@ -0,0 +1,71 @@
+'''Tests for the migration batch scheduler in CloudStack.estimate'''
+
+import unittest
+
+from CloudStack import estimate
+
+
+def move(vm, source, destination, seconds):
+    '''A planned move as the rebalance planner produces it'''
+    return {'vm': vm, 'source': source, 'destination': destination, 'seconds': seconds}
+
+
+def overlaps(first, second):
+    '''True if two scheduled moves run at the same time'''
+    if first['window'] != second['window']:
+        return False
+    return (first['start'] < second['start'] + second['seconds'] and
+            second['start'] < first['start'] + first['seconds'])
+
+
+class ScheduleTest(unittest.TestCase):
+    '''schedule() packs moves without breaking their host dependencies'''
+
+    def test_move_into_host_waits_for_move_out(self):
+        out = move('a', 'X', 'W', 100)
+        into = move('b', 'V', 'X', 500)
+        moves = estimate.schedule([out, into], lanes=2)
+        self.assertEqual([entry['vm'] for entry in moves], ['a', 'b'])
+        self.assertEqual(into['after'], [out['id']])
+        self.assertEqual(out['start'], 0)
+        self.assertEqual(into['start'], 100)
+
+    def test_independent_moves_share_the_start(self):
+        first = move('a', 'X', 'W', 100)
+        second = move('b', 'V', 'U', 500)
+        estimate.schedule([first, second], lanes=2)
+        self.assertEqual(second['after'], [])
+        self.assertEqual((first['start'], second['start']), (0, 0))
+        self.assertNotEqual(first['lane'], second['lane'])
+
+    def test_moves_sharing_a_host_never_overlap(self):
+        moves = [move('a', 'X', 'W', 300), move('b', 'Y', 'W', 200),
+                 move('c', 'V', 'X', 500), move('d', 'U', 'T', 400),
+                 move('e', 'W', 'T', 100)]
+        estimate.schedule(moves, lanes=3)
+        for first in moves:
+            for second in moves:
+                if first is second:
+                    continue
+                if set((first['source'], first['destination'])) & \
+                        set((second['source'], second['destination'])):
+                    self.assertFalse(overlaps(first, second),
+                                     '%s and %s overlap' % (first['vm'], second['vm']))
+
+    def test_dependency_in_next_window(self):
+        out = move('a', 'X', 'W', 300)
+        into = move('b', 'V', 'X', 300)
+        estimate.schedule([out, into], lanes=2, window=400)
+        self.assertEqual((out['window'], into['window']), (0, 1))
+        self.assertEqual(into['start'], 0)
+
+    def test_longest_first_within_window(self):
+        moves = [move('a', 'A', 'B', 100), move('b', 'C', 'D', 300),
+                 move('c', 'E', 'F', 200)]
+        ordered = estimate.schedule(moves, lanes=1)
+        self.assertEqual([entry['vm'] for entry in ordered], ['b', 'c', 'a'])
+        self.assertEqual([entry['start'] for entry in ordered], [0, 300, 500])
+
+
+if __name__ == '__main__':
+    unittest.main()
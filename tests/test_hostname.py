@@ -0,0 +1,40 @@
+'''Tests for FQDN parsing in CloudStack.hostname'''
+
+import unittest
+
+from CloudStack.hostname import HostName, group_by_env
+
+
+class HostNameTest(unittest.TestCase):
+    '''HostName splits a FQDN into name, site and environment'''
+
+    def test_parts(self):
+        hostname = HostName('webprod001.example.sea')
+        self.assertEqual((hostname.name, hostname.domain), ('webprod001', 'example.sea'))
+        self.assertEqual((hostname.site, hostname.cs_env, hostname.base_name),
+                         ('sea', 'sea', 'example'))
+        self.assertEqual(hostname.env, 'prod')
+
+    def test_unknown_site_and_env(self):
+        hostname = HostName('mail01.example.org')
+        self.assertEqual((hostname.site, hostname.env), ('', ''))
+        self.assertEqual(HostName('localhost').base_name, '')
+
+
+class GroupByEnvTest(unittest.TestCase):
+    '''group_by_env() keeps environments in first-seen order'''
+
+    def test_groups(self):
+        groups = group_by_env(['web01.example.joy', 'db01.example.sea', 'mail01.example.org',
+                               'web02.example.joy'])
+        self.assertEqual(list(groups), ['joy', 'sea', ''])
+        self.assertEqual([hostname.fqdn for hostname in groups['joy']],
+                         ['web01.example.joy', 'web02.example.joy'])
+        self.assertEqual([hostname.name for hostname in groups['']], ['mail01'])
+
+    def test_empty(self):
+        self.assertEqual(group_by_env([]), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
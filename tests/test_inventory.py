@@ -0,0 +1,112 @@
+'''Tests for the SQLite inventory mirror in CloudStack.inventory'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from CloudStack import inventory
+
+
+class FakeCloudStack(object):
+    '''Serves canned listings and events, counting the listings made'''
+
+    def __init__(self):
+        self.objects = {
+            'listVirtualMachines': [
+                {'id': 'v1', 'name': 'web01', 'instancename': 'i-2-10-VM', 'hostid': 'h1',
+                 'nic': [{'ipaddress': '10.0.0.10'}]},
+                {'id': 'v2', 'name': 'web02', 'instancename': 'i-2-11-VM', 'hostid': 'h2',
+                 'nic': [{'ipaddress': '10.0.0.11'}]}],
+            'listHosts': [{'id': 'h1', 'name': 'node01', 'ipaddress': '10.1.0.1'},
+                          {'id': 'h2', 'name': 'node02', 'ipaddress': '10.1.0.2'}],
+        }
+        self.events = []
+        self.listed = []
+
+    def list_all(self, command, key, **kwargs):
+        '''Every object of a list command'''
+        if command == 'listEvents':
+            return iter(self.events)
+        self.listed.append(command)
+        return iter(self.objects.get(command, []))
+
+    def listEvents(self, **kwargs):
+        '''The newest event, for the server's timezone'''
+        return {'event': [{'created': '2018-06-12T14:20:08+0000'}]}
+
+
+class InventoryTest(unittest.TestCase):
+    '''Sync per kind and indexed lookups'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cloudstack = FakeCloudStack()
+        self.store = inventory.Inventory(self.cloudstack,
+                                         os.path.join(self.directory, 'sea.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_ensure_fresh_syncs_only_that_kind(self):
+        self.store.ensure_fresh('vms', 300)
+        self.assertEqual(self.cloudstack.listed, ['listVirtualMachines'])
+        self.assertEqual(self.store.synced('hosts'), None)
+
+    def test_fresh_kind_is_not_listed_again(self):
+        self.store.ensure_fresh('vms', 300)
+        self.store.ensure_fresh('vms', 300)
+        self.assertEqual(self.cloudstack.listed, ['listVirtualMachines'])
+
+    def test_stale_kind_follows_events(self):
+        self.store.sync(kinds=['vms', 'hosts'])
+        del self.cloudstack.listed[:]
+        self.cloudstack.events = [{'type': 'HOST.UPDATE'}]
+        self.assertEqual(self.store.sync(kinds=['vms']), set())
+        self.assertEqual(self.store.sync(kinds=['hosts']), set(['hosts']))
+        self.assertEqual(self.cloudstack.listed, ['listHosts'])
+
+    def test_quiet_sync_moves_the_mark(self):
+        self.store.sync(kinds=['vms'])
+        before = self.store.synced('vms')
+        time.sleep(0.01)
+        self.assertEqual(self.store.sync(kinds=['vms']), set())
+        self.assertTrue(self.store.synced('vms') > before)
+
+    def test_full_sync_lists_everything(self):
+        self.assertEqual(self.store.sync(full=True), set(inventory.KINDS))
+
+    def test_lookups(self):
+        self.store.sync(kinds=['vms'])
+        self.assertEqual([vm['id'] for vm in self.store.vms_by_name('web01')], ['v1'])
+        self.assertEqual(self.store.vm_by_ip('10.0.0.11')['id'], 'v2')
+        self.assertEqual(self.store.vm_by_instance('i-2-10-VM')['name'], 'web01')
+        self.assertEqual([vm['id'] for vm in self.store.vms_on_host('h2')], ['v2'])
+        self.assertEqual(self.store.vm_by_ip('10.9.9.9'), None)
+        self.assertRaises(ValueError, self.store.find, 'vms', 'data', 'x')
+
+    def test_stale_data_served_on_errors(self):
+        self.store.sync(kinds=['vms'])
+
+        def failing(command, key, **kwargs):
+            '''The API is down'''
+            raise IOError('connection refused')
+        self.cloudstack.list_all = failing
+        self.store.ensure_fresh('vms', -1)
+        self.assertEqual(len(self.store.all('vms')), 2)
+        self.assertRaises(IOError, self.store.ensure_fresh, 'hosts', -1)
+
+
+class OffsetTest(unittest.TestCase):
+    '''_utc_offset() reads the zone of API timestamps'''
+
+    def test_offsets(self):
+        self.assertEqual(inventory._utc_offset('2018-06-12T14:20:08-0700'), -7 * 3600)
+        self.assertEqual(inventory._utc_offset('2018-06-12T14:20:08+05:30'), 19800)
+        self.assertEqual(inventory._utc_offset('2018-06-12 14:20:08'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
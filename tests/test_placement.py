@@ -0,0 +1,130 @@
+'''Tests for host scoring and affinity in CloudStack.placement'''
+
+import unittest
+
+from CloudStack import placement, records
+
+GB = 1024 ** 3
+
+
+def host(hostid, cpu, mem, state='Up', resourcestate='Enabled'):
+    '''A listHosts entry with 10000 MHz and 10 GB, allocated by fractions'''
+    return {'id': hostid, 'name': 'node-' + hostid, 'ipaddress': '10.1.0.' + hostid[1:],
+            'state': state, 'resourcestate': resourcestate,
+            'cpuwithoverprovisioning': '10000', 'cpuallocated': '%g%%' % (cpu * 100),
+            'memorytotal': 10 * GB, 'memoryallocated': int(mem * 10 * GB)}
+
+
+def offering(cores, memory, storagetype='shared'):
+    '''A service offering of 1000 MHz cores and memory in MB'''
+    return {'cpunumber': cores, 'cpuspeed': 1000, 'memory': memory,
+            'storagetype': storagetype}
+
+
+class FakeCloudStack(object):
+    '''Serves a zone of hosts, local pools and affinity groups'''
+
+    def __init__(self, hosts, pools=(), groups=(), vms=()):
+        self.hosts = hosts
+        self.pools = list(pools)
+        self.groups = list(groups)
+        self.vms = list(vms)
+
+    def list_cached(self, kind, **kwargs):
+        '''Hosts or storage pools, as records'''
+        objects = {'hosts': self.hosts, 'storagepools': self.pools}[kind]
+        return list(records.decode(kind, objects))
+
+    def list_records(self, kind, **kwargs):
+        '''VMs in the requested affinity group'''
+        return records.decode(kind, [vm for vm in self.vms
+                                     if kwargs.get('affinitygroupid') in vm['groups']])
+
+    def listAffinityGroups(self, **kwargs):
+        '''The group with the requested name'''
+        found = [group for group in self.groups if group['name'] == kwargs['name']]
+        return {'affinitygroup': found} if found else {}
+
+
+class ScoreTest(unittest.TestCase):
+    '''score() and place() prefer dense, even fits that have room'''
+
+    def test_unavailable_hosts_skipped(self):
+        placer = placement.Placer(FakeCloudStack([
+            host('h1', 0.1, 0.1, state='Down'),
+            host('h2', 0.1, 0.1, resourcestate='Maintenance'),
+            host('h3', 0.1, 0.1)]), 'z1')
+        self.assertEqual([each['id'] for each in placer.hosts], ['h3'])
+
+    def test_densest_fit_wins(self):
+        placer = placement.Placer(FakeCloudStack([host('h1', 0.1, 0.1),
+                                                  host('h2', 0.5, 0.5)]), 'z1')
+        self.assertEqual(placer.place(offering(1, 1024))['id'], 'h2')
+
+    def test_even_fit_beats_lopsided(self):
+        placer = placement.Placer(FakeCloudStack([host('h1', 0.7, 0.1),
+                                                  host('h2', 0.4, 0.4)]), 'z1')
+        self.assertEqual(placer.place(offering(1, 1024))['id'], 'h2')
+
+    def test_place_reserves_until_full(self):
+        placer = placement.Placer(FakeCloudStack([host('h1', 0.5, 0.0),
+                                                  host('h2', 0.3, 0.0)]), 'z1')
+        placed = [placer.place(offering(4, 1024)) for _ in range(3)]
+        self.assertEqual([each['id'] for each in placed[:2]], ['h1', 'h2'])
+        self.assertEqual(placed[2], None)
+        self.assertEqual(placer.cpu_used, [9000.0, 7000.0])
+
+    def test_local_disk_must_fit(self):
+        pools = [{'id': 'p1', 'name': 'local1', 'ipaddress': '10.1.0.1', 'scope': 'HOST',
+                  'disksizetotal': 100 * GB, 'disksizeallocated': 90 * GB},
+                 {'id': 'p2', 'name': 'local2', 'ipaddress': '10.1.0.2', 'scope': 'HOST',
+                  'disksizetotal': 100 * GB, 'disksizeallocated': 0}]
+        placer = placement.Placer(FakeCloudStack([host('h1', 0.5, 0.5),
+                                                  host('h2', 0.1, 0.1)], pools), 'z1')
+        self.assertEqual(placer.place(offering(1, 1024, 'local'), 20 * GB)['id'], 'h2')
+        self.assertEqual(placer.place(offering(1, 1024), 20 * GB)['id'], 'h1')
+        self.assertEqual(placer.disk_used, [90.0 * GB, 20.0 * GB])
+
+
+class AffinityTest(unittest.TestCase):
+    '''Affinity groups limit the hosts a VM may land on'''
+
+    def setUp(self):
+        self.hosts = [host('h1', 0.5, 0.5), host('h2', 0.3, 0.3), host('h3', 0.1, 0.1)]
+        self.vms = [{'id': 'v1', 'name': 'web01', 'hostid': 'h1', 'groups': ['g1', 'g2']}]
+
+    def placer(self, grouptype):
+        '''A Placer whose group 'web' holds web01 on h1'''
+        groups = [{'id': 'g1', 'name': 'web', 'type': grouptype, 'virtualmachineIds': ['v1']}]
+        return placement.Placer(FakeCloudStack(self.hosts, groups=groups, vms=self.vms), 'z1')
+
+    def test_anti_affinity_avoids_group_hosts(self):
+        placer = self.placer('host anti-affinity')
+        self.assertEqual(placer.place(offering(1, 1024), affinitygroup='web')['id'], 'h2')
+        self.assertEqual(placer.place(offering(1, 1024), affinitygroup='web')['id'], 'h3')
+        self.assertEqual(placer.place(offering(1, 1024), affinitygroup='web'), None)
+
+    def test_affinity_keeps_to_group_hosts(self):
+        placer = self.placer('host affinity')
+        self.assertEqual(placer.score(offering(1, 1024), affinitygroup='web')[0][1], 0)
+        self.assertEqual(len(placer.score(offering(1, 1024), affinitygroup='web')), 1)
+
+    def test_new_group_is_anti_affinity(self):
+        placer = placement.Placer(FakeCloudStack(self.hosts), 'z1')
+        first = placer.place(offering(1, 1024), affinitygroup='db')
+        second = placer.place(offering(1, 1024), affinitygroup='db')
+        self.assertEqual((first['id'], second['id']), ('h1', 'h2'))
+        self.assertEqual(placer.groups['db'], ('host anti-affinity', set(['h1', 'h2'])))
+
+
+class PercentTest(unittest.TestCase):
+    '''_percent() reads API percentage strings'''
+
+    def test_percent(self):
+        self.assertEqual(placement._percent('42.5%'), 0.425)
+        self.assertEqual(placement._percent(0), 0.0)
+        self.assertEqual(placement._percent('n/a'), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+'''Tests for error classification and the AIMD window in CloudStack.ratelimit'''
+
+import socket
+import time
+import unittest
+
+from CloudStack import ratelimit
+
+
+class ApiError(Exception):
+    '''An API error carrying an HTTP status, as the cs library raises'''
+
+    def __init__(self, code):
+        Exception.__init__(self, 'HTTP {} response from CloudStack'.format(code))
+        self.code = code
+
+
+class TransientTest(unittest.TestCase):
+    '''transient() separates overload from CloudStack's own answers'''
+
+    def test_overload_is_transient(self):
+        for code in (429, 502, 503, 504):
+            self.assertTrue(ratelimit.transient(ApiError(code)), code)
+
+    def test_cloudstack_errors_are_not(self):
+        for code in (431, 500, 530, 531, 533, 534, 535):
+            self.assertFalse(ratelimit.transient(ApiError(code)), code)
+
+    def test_connection_errors_are_transient(self):
+        self.assertTrue(ratelimit.transient(socket.error(104, 'Connection reset')))
+        self.assertTrue(ratelimit.transient(IOError('timed out')))
+        self.assertFalse(ratelimit.transient(ValueError('bad reply')))
+
+    def test_status_from_message(self):
+        self.assertEqual(ratelimit.status_code(Exception('HTTP 503 response')), 503)
+        self.assertEqual(ratelimit.status_code(Exception('no status')), None)
+
+
+class CallTest(unittest.TestCase):
+    '''call() retries only transient failures, and only once they congest'''
+
+    def setUp(self):
+        self.limiter = ratelimit.Limiter(rate=1000, burst=1000)
+        self.limiter.limit = 8.0
+        self.calls = []
+
+    def failing(self, error):
+        '''A func for call() that records each attempt and raises error'''
+        def func():
+            self.calls.append(1)
+            raise error
+        return func
+
+    def test_permission_denied_is_not_retried(self):
+        self.assertRaises(ApiError, ratelimit.call, self.limiter,
+                          self.failing(ApiError(531)), True, 4, 'listHosts')
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.limiter.limit, 8.0)
+        self.assertEqual(self.limiter.active, 0)
+
+    def test_throttling_is_retried(self):
+        original = ratelimit.BACKOFF
+        ratelimit.BACKOFF = 0.0
+        try:
+            self.assertRaises(ApiError, ratelimit.call, self.limiter,
+                              self.failing(ApiError(503)), True, 2, 'listHosts')
+        finally:
+            ratelimit.BACKOFF = original
+        self.assertEqual(len(self.calls), 3)
+        self.assertTrue(self.limiter.limit < 8.0)
+
+    def test_writes_are_not_retried(self):
+        self.assertRaises(ApiError, ratelimit.call, self.limiter,
+                          self.failing(ApiError(503)), False, 4, 'deployVirtualMachine')
+        self.assertEqual(len(self.calls), 1)
+
+
+class WindowTest(unittest.TestCase):
+    '''release() cuts the window once per burst of congestion'''
+
+    def setUp(self):
+        self.limiter = ratelimit.Limiter(rate=1000, burst=1000)
+        self.limiter.limit = 16.0
+
+    def finish(self, latency, congested=False, command='listHosts'):
+        '''Acquire and release one request'''
+        self.limiter.acquire()
+        self.limiter.release(latency, congested, command)
+
+    def test_burst_of_failures_halves_once(self):
+        # Requests in flight together all fail; they were sent before the cut
+        for _ in range(6):
+            self.finish(1.0, congested=True)
+        self.assertEqual(self.limiter.limit, 8.0)
+
+    def test_later_failure_halves_again(self):
+        self.finish(1.0, congested=True)
+        self.limiter.cut = time.time() - 10
+        self.finish(1.0, congested=True)
+        self.assertEqual(self.limiter.limit, 4.0)
+
+    def test_unmeasured_release_leaves_window(self):
+        self.limiter.acquire()
+        self.limiter.release(None, command='listHosts')
+        self.assertEqual(self.limiter.limit, 16.0)
+        self.assertEqual(self.limiter.best, {})
+
+    def test_baseline_is_per_command(self):
+        for _ in range(20):
+            self.finish(0.02, command='queryAsyncJobResult')
+        for _ in range(3):
+            self.finish(1.5, command='listVirtualMachines')
+        self.assertTrue(self.limiter.limit > 16.0)
+
+    def test_latency_spike_is_congestion(self):
+        self.finish(0.1)
+        self.finish(1.0)
+        self.assertTrue(self.limiter.limit < 16.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+'''Tests for the rebalance planner in CloudStack.rebalance'''
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from CloudStack import rebalance, records
+
+GB = 1024 ** 3
+
+
+def host(hostid, load):
+    '''A listHosts entry with 10000 MHz and 10 GB, both allocated by load'''
+    return {'id': hostid, 'name': 'node-' + hostid, 'ipaddress': '10.1.0.' + hostid[1:],
+            'state': 'Up', 'resourcestate': 'Enabled', 'cpuwithoverprovisioning': '10000',
+            'cpuallocated': '%g%%' % (load * 100), 'memorytotal': 10 * GB,
+            'memoryallocated': int(load * 10 * GB)}
+
+
+def vm(name, hostid, cores, state='Running'):
+    '''A listVirtualMachines entry of 1000 MHz cores with 1 GB each'''
+    return {'id': 'id-' + name, 'name': name, 'instancename': 'i-' + name, 'hostid': hostid,
+            'state': state, 'cpunumber': cores, 'cpuspeed': 1000, 'memory': cores * 1024}
+
+
+def volume(vmname, physicalsize, size=100 * GB, storagetype='local'):
+    '''A listVolumes entry attached to a VM'''
+    return {'id': 'vol-' + vmname, 'virtualmachineid': 'id-' + vmname, 'size': size,
+            'physicalsize': physicalsize, 'storagetype': storagetype}
+
+
+class FakeCloudStack(object):
+    '''Serves a zone of hosts, VMs and volumes as records'''
+
+    def __init__(self, hosts, vms, volumes):
+        self.objects = {'hosts': hosts, 'storagepools': [], 'vms': vms, 'volumes': volumes}
+
+    def list_cached(self, kind, **kwargs):
+        '''Every object of a kind'''
+        return list(records.decode(kind, self.objects[kind]))
+
+    list_records = list_cached
+
+
+class PlanTest(unittest.TestCase):
+    '''plan() sheds the cheapest clearing VM onto the best fitting host'''
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def planner(self, loads, volumes):
+        '''A Planner for node-h1 at 80% holding VMs a, b and c of 1, 2 and 4
+        cores, with the other hosts at the given loads
+        '''
+        hosts = [host('h1', 0.8)] + [host('h%d' % num, load)
+                                      for num, load in enumerate(loads, 2)]
+        vms = [vm('a', 'h1', 1), vm('b', 'h1', 2), vm('c', 'h1', 4),
+               vm('d', 'h1', 1, state='Stopped')]
+        return rebalance.Planner(FakeCloudStack(hosts, vms, volumes), 'z1')
+
+    def test_cheapest_clearing_vm_to_best_fit(self):
+        planner = self.planner([0.0, 0.5], [volume('a', 50 * GB), volume('b', 10 * GB),
+                                            volume('c', 100 * GB)])
+        moves = planner.plan(0.75)
+        self.assertEqual(moves, [{'vm': 'b', 'vmid': 'id-b', 'instancename': 'i-b',
+                                  'source': 'node-h1', 'destination': 'node-h3',
+                                  'bytes': 10 * GB}])
+        self.assertTrue(planner.utilization(0) <= 0.75)
+
+    def test_shared_volumes_cost_nothing(self):
+        planner = self.planner([0.0], [volume('a', 50 * GB), volume('b', 10 * GB),
+                                       volume('c', 100 * GB, storagetype='shared')])
+        self.assertEqual([move['vm'] for move in planner.plan(0.75)], ['c'])
+
+    def test_virtual_size_without_physical(self):
+        planner = self.planner([0.0], [volume('a', None, size=5 * GB), volume('b', 10 * GB),
+                                       volume('c', 100 * GB)])
+        self.assertEqual(planner.plan(0.75)[0]['bytes'], 5 * GB)
+
+    def test_under_target_moves_nothing(self):
+        self.assertEqual(self.planner([0.0], []).plan(0.9), [])
+
+    def test_no_room_moves_nothing(self):
+        planner = self.planner([0.7, 0.75], [])
+        self.assertEqual(planner.plan(0.75), [])
+        self.assertEqual(planner.vm_host, [0, 0, 0])
+
+    def test_stopped_vms_not_planned(self):
+        planner = self.planner([0.0], [])
+        self.assertEqual([virtm['name'] for virtm in planner.vms], ['a', 'b', 'c'])
+
+
+class PlanFileTest(unittest.TestCase):
+    '''write_plan() and read_plan() round trip a plan'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        filename = os.path.join(self.directory, 'plan.json')
+        moves = [{'vm': 'b', 'source': 'node-h1', 'destination': 'node-h3', 'bytes': 10}]
+        written = rebalance.write_plan(filename, 'sea', 'Production', 0.75, moves)
+        self.assertEqual(written['bytes'], 10)
+        self.assertEqual(rebalance.read_plan(filename), written)
+
+
+if __name__ == '__main__':
+    unittest.main()
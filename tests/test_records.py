@@ -0,0 +1,151 @@
+'''Tests for the compact listing records in CloudStack.records'''
+
+import gc
+import json
+import sys
+import unittest
+
+from CloudStack import records
+
+
+def payload(num):
+    '''A listVirtualMachines entry, decoded from JSON as the API client does'''
+    uid = '%08x-0000-4000-8000-%012x' % (num, num)
+    return json.loads(json.dumps({
+        'id': uid, 'name': 'web%03d' % num, 'instancename': 'i-2-%d-VM' % num,
+        'state': 'Running', 'hostid': 'h1', 'hostname': 'node01', 'zoneid': 'z1',
+        'zonename': 'Production', 'domainid': 'd1', 'domain': 'PROD', 'account': 'admin',
+        'cpunumber': 4, 'cpuspeed': 2000, 'memory': 8192, 'serviceofferingid': 'o1',
+        'serviceofferingname': 'm1.large', 'templateid': 't1', 'templatename': 'Ubuntu',
+        'created': '2018-06-12T14:20:08-0700', 'haenable': False, 'hypervisor': 'KVM',
+        'details': {'cpuOvercommitRatio': '4'}, 'tags': [], 'affinitygroup': [],
+        'nic': [{'id': uid, 'networkid': 'n1', 'ipaddress': '10.0.0.%d' % num,
+                 'macaddress': '06:00:00:00:00:%02x' % num, 'isdefault': True,
+                 'networkname': 'Application', 'traffictype': 'Guest'}],
+    }))
+
+
+def deep_size(obj, seen=None):
+    '''Bytes held by obj and everything it refers to, each object once'''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen)
+                    for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif isinstance(obj, records.Record):
+        for cls in type(obj).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if slot != '_client':
+                    size += deep_size(getattr(obj, slot, None), seen)
+    return size
+
+
+class FakeCloudStack(object):
+    '''Answers listVirtualMachines by ID, counting the calls'''
+
+    def __init__(self, objects):
+        self.objects = dict((obj['id'], obj) for obj in objects)
+        self.calls = 0
+
+    def listVirtualMachines(self, **kwargs):
+        '''The VM with the requested ID'''
+        self.calls += 1
+        found = self.objects.get(kwargs.get('id'))
+        return {'virtualmachine': [found]} if found else {}
+
+
+class RecordTest(unittest.TestCase):
+    '''Records read like the API dicts they replace'''
+
+    def setUp(self):
+        self.payload = payload(7)
+        self.client = FakeCloudStack([self.payload])
+        self.record = records.VM(self.payload, self.client)
+
+    def test_kept_fields(self):
+        self.assertEqual(self.record['name'], 'web007')
+        self.assertEqual(self.record.get('hostid'), 'h1')
+        self.assertTrue('zonename' in self.record)
+        self.assertEqual(self.client.calls, 0)
+
+    def test_get_default_for_missing_field(self):
+        record = records.VM({'id': 'v1'}, self.client)
+        self.assertEqual(record.get('hostid', 'none'), 'none')
+        self.assertEqual(record.get('displayname', 'none'), 'none')
+
+    def test_other_fields_fetched_once(self):
+        self.assertEqual(self.record['hypervisor'], 'KVM')
+        self.assertEqual(self.record.get('details')['cpuOvercommitRatio'], '4')
+        self.assertEqual(self.record.get('extra', 'none'), 'none')
+        self.assertEqual(self.client.calls, 1)
+
+    def test_full_record_needs_no_fetch(self):
+        record = records.VM(self.payload, self.client, full=True)
+        self.assertEqual(record['hypervisor'], 'KVM')
+        self.assertEqual(self.client.calls, 0)
+
+    def test_no_client_no_payload(self):
+        record = records.VM(self.payload)
+        self.assertRaises(KeyError, record.__getitem__, 'hypervisor')
+        self.assertEqual(record.get('hypervisor', 'none'), 'none')
+
+    def test_set_item(self):
+        self.record['state'] = 'Stopped'
+        self.record['tags'] = ['ssd']
+        self.assertEqual(self.record['state'], 'Stopped')
+        self.assertEqual(self.record['tags'], ['ssd'])
+
+    def test_nics(self):
+        nic = self.record['nic'][0]
+        self.assertTrue(isinstance(nic, records.Nic))
+        self.assertEqual(nic['ipaddress'], '10.0.0.7')
+        self.assertEqual(nic.get('isdefault'), True)
+        self.assertEqual(self.record.as_dict()['nic'][0]['macaddress'], '06:00:00:00:00:07')
+
+    def test_dump_and_load(self):
+        self.record.raw
+        sent = json.loads(json.dumps(self.record.dump()))
+        record = records.load(sent, self.client)
+        self.assertTrue(isinstance(record, records.VM))
+        self.assertEqual(record.as_dict(), self.record.as_dict())
+        self.assertEqual(record['hypervisor'], 'KVM')
+        self.assertEqual(self.client.calls, 1)
+
+    def test_load_without_payload_fetches(self):
+        record = records.load(json.loads(json.dumps(self.record.dump())), self.client)
+        self.assertEqual(record.get('hypervisor'), 'KVM')
+        self.assertEqual(self.client.calls, 1)
+
+
+class FootprintTest(unittest.TestCase):
+    '''Records hold a listing in a fraction of the space of its dicts'''
+
+    def setUp(self):
+        self.payloads = [payload(num) for num in range(300)]
+        self.records = list(records.decode('vms', self.payloads))
+
+    def test_text_is_compacted(self):
+        record = self.records[0]
+        self.assertTrue(type(record.name) is str)
+        self.assertTrue(record.zonename is self.records[1].zonename)
+        self.assertTrue(record._nics[0][2] is self.records[1]._nics[0][2])
+
+    def test_size_reduction(self):
+        dicts = deep_size(self.payloads)
+        compact = deep_size(self.records)
+        self.assertTrue(dicts > 5 * compact, '%d bytes as dicts, %d as records' %
+                        (dicts, compact))
+
+    def test_nics_not_tracked(self):
+        gc.collect()
+        self.assertFalse(gc.is_tracked(self.records[0]._nics))
+
+
+if __name__ == '__main__':
+    unittest.main()
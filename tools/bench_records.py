@@ -0,0 +1,131 @@
+#!/usr/bin/env python2.7
+'''Measure memory and full garbage collection time of a large VM listing
+held as API dicts versus compact records (CloudStack.records), failing when
+records do not cut them by the required factors. Each mode runs in its own
+process so their heaps do not mix. Pages are JSON decoded as the API client
+does, with payloads shaped like listVirtualMachines responses.
+'''
+
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from CloudStack import records
+
+PAGESIZE = 500
+
+
+def parse_arguments():
+    '''Parse arguments/options'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=50000,
+                        help="VMs in the listing (default 50000)")
+    parser.add_argument("--memory-factor", type=float, default=10.0,
+                        help="Least reduction in memory (default 10)")
+    parser.add_argument("--gc-factor", type=float, default=5.0,
+                        help="Least reduction in full GC time (default 5)")
+    parser.add_argument("--mode", choices=('dicts', 'records'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    return args
+
+
+def payload(num):
+    '''One listVirtualMachines entry'''
+    uid = '%08x-0000-4000-8000-%012x' % (num, num)
+    return {
+        'id': uid, 'name': 'web%05d' % num, 'displayname': 'web%05d' % num,
+        'account': 'admin', 'userid': uid, 'username': 'admin', 'domainid': uid,
+        'domain': 'PROD', 'created': '2018-06-12T14:20:08-0700', 'state': 'Running',
+        'haenable': False, 'groupid': uid, 'group': 'web', 'zoneid': uid,
+        'zonename': 'Production', 'hostid': uid, 'hostname': 'node%03d' % (num % 200),
+        'templateid': uid, 'templatename': 'Ubuntu 18.04.1 LTS',
+        'templatedisplaytext': 'Ubuntu 18.04.1 LTS 64-bit', 'passwordenabled': False,
+        'serviceofferingid': uid, 'serviceofferingname': 'm1.large', 'cpunumber': 4,
+        'cpuspeed': 2000, 'memory': 8192, 'cpuused': '3.2%', 'networkkbsread': num * 7,
+        'networkkbswrite': num * 3, 'diskkbsread': num * 11, 'diskkbswrite': num * 5,
+        'diskioread': num, 'diskiowrite': num, 'guestosid': uid, 'rootdeviceid': 0,
+        'rootdevicetype': 'ROOT', 'securitygroup': [], 'hypervisor': 'KVM',
+        'instancename': 'i-2-%d-VM' % num, 'tags': [], 'details': {'cpuOvercommitRatio': '4'},
+        'affinitygroup': [], 'displayvm': True, 'isdynamicallyscalable': False,
+        'ostypeid': uid, 'keypair': 'ops',
+        'nic': [{'id': uid, 'networkid': uid, 'networkname': 'Application',
+                 'netmask': '255.255.252.0', 'gateway': '10.0.0.1',
+                 'ipaddress': '10.0.%d.%d' % (num / 250 % 250, num % 250 + 2),
+                 'isolationuri': 'vlan://100', 'broadcasturi': 'vlan://100',
+                 'traffictype': 'Guest', 'type': 'Shared', 'isdefault': True,
+                 'macaddress': '06:00:00:%02x:%02x:%02x' % (num >> 16 & 255,
+                                                            num >> 8 & 255, num & 255)}],
+    }
+
+
+def pages(count):
+    '''Yield the listing one decoded page at a time'''
+    for start in xrange(0, count, PAGESIZE):
+        text = json.dumps({'count': count, 'virtualmachine':
+                           [payload(num) for num in xrange(start, min(count, start + PAGESIZE))]})
+        yield json.loads(text)['virtualmachine']
+
+
+def resident():
+    '''Resident set size of this process in bytes'''
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def measure(mode, count):
+    '''Hold the listing in one form, printing bytes used and GC seconds'''
+    gc.collect()
+    before = resident()
+    held = []
+    for page in pages(count):
+        if mode == 'records':
+            held.extend(records.decode('vms', page))
+        else:
+            held.extend(page)
+        del page
+    gc.collect()
+    used = resident() - before
+    started = time.time()
+    for _ in xrange(5):
+        gc.collect()
+    print json.dumps({'bytes': used, 'gc': (time.time() - started) / 5, 'held': len(held)})
+
+
+def run(mode, count):
+    '''Measure one mode in a child process'''
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      '--mode', mode, '--count', str(count)])
+    return json.loads(output)
+
+
+def main():
+    '''Compare both modes and check the reduction'''
+    args = parse_arguments()
+    if args.mode:
+        measure(args.mode, args.count)
+        return
+    dicts = run('dicts', args.count)
+    compact = run('records', args.count)
+    memory = dicts['bytes'] / float(max(compact['bytes'], 1))
+    gctime = dicts['gc'] / max(compact['gc'], 1e-6)
+    print "%d VMs" % args.count
+    print "%-8s %10.1f MB %10.1f ms gc" % ('dicts', dicts['bytes'] / 1024.0 ** 2,
+                                          dicts['gc'] * 1000)
+    print "%-8s %10.1f MB %10.1f ms gc" % ('records', compact['bytes'] / 1024.0 ** 2,
+                                          compact['gc'] * 1000)
+    print "Reduction: %.1fx memory, %.1fx gc time" % (memory, gctime)
+    if memory < args.memory_factor or gctime < args.gc_factor:
+        print "Below the %.0fx memory / %.0fx gc target" % (args.memory_factor, args.gc_factor)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
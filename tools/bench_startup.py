@@ -0,0 +1,61 @@
+#!/usr/bin/env python2.7
+'''Measure how long `cloudstack <command> --help` takes to start for each
+command, failing when the median exceeds the budget. Run from a checkout;
+the repository root is put on PYTHONPATH for the child processes.
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY = os.path.join(ROOT, 'bin', 'cloudstack')
+COMMANDS = ('provision', 'destroy', 'migrate', 'info', 'storage', 'storage-report',
+            'rebalance', 'inventory', 'locate', 'daemon', 'prestage')
+
+
+def parse_arguments():
+    '''Parse arguments/options'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10,
+                        help="Runs per command (default 10)")
+    parser.add_argument("--budget", type=float, default=80.0,
+                        help="Highest allowed median in milliseconds (default 80)")
+    args = parser.parse_args()
+    return args
+
+
+def median_ms(argv, runs, env):
+    '''Median wall time of a command in milliseconds'''
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in xrange(runs):
+            started = time.time()
+            subprocess.call(argv, stdout=devnull, stderr=devnull, env=env)
+            times.append((time.time() - started) * 1000)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    '''Time every command and compare against the budget'''
+    args = parse_arguments()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    baseline = median_ms([sys.executable, '-c', 'pass'], args.runs, env)
+    print "%-16s %8.1f ms" % ('(interpreter)', baseline)
+    over = []
+    for command in COMMANDS:
+        elapsed = median_ms([sys.executable, ENTRY, command, '--help'], args.runs, env)
+        print "%-16s %8.1f ms" % (command, elapsed)
+        if elapsed > args.budget:
+            over.append(command)
+    if over:
+        print "Over the %.0f ms budget: %s" % (args.budget, ", ".join(over))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()